@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# Timing benchmarks for the python tools used in the tutorials.
+# Usage: python benchmarks.py <benchmark> [options]
+import os, sys
+import argparse
+import shutil
+import tempfile
+import time
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+import coadd
+import combine
+import obslog
+from obstable import ObsLog
+
+def timed(func, *args, **kwargs):
+    # Return the time (in seconds) taken by a function call, and its result
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+def report(title, rows):
+    # Print a table of (description, time in seconds, normalization)
+    print(title)
+    for descr, t, n in rows:
+        print('  {:40s} {:10.3f} ms per {}'.format(descr, 1000*t/n[0], n[1]))
+
+#---------------------------------------------------------------------
+def make_raw_files(path, nfiles, ncards=300):
+    # Write files with primary headers similar in size to raw F2 data
+    header = fits.Header()
+    for kw, c in obslog.KW_MAP:
+        header[kw] = 'value'
+    for i in range(ncards - len(header)):
+        header['KEY{}'.format(i)] = (float(i), 'A comment for this keyword')
+    sci = np.zeros((64, 64), dtype=np.float32)
+    fileList = []
+    for i in range(nfiles):
+        fname = os.path.join(path, 'S20180101S{:04d}.fits'.format(i+1))
+        fits.HDUList([fits.PrimaryHDU(header=header),
+                      fits.ImageHDU(sci)]).writeto(fname)
+        fileList.append(fname)
+    return fileList
+
+def bench_headers(args):
+    # Per-file cost of harvesting the KW_MAP keywords
+    tmpdir = None
+    if args.path:
+        fileList = sorted([os.path.join(args.path, f)
+                           for f in os.listdir(args.path)
+                           if f.startswith('S') and f.endswith('.fits')])
+    else:
+        tmpdir = tempfile.mkdtemp()
+        fileList = make_raw_files(tmpdir, args.nfiles)
+    keywords = [kw for kw, c in obslog.KW_MAP]
+    try:
+        # Read everything once so all methods find the files in page cache
+        obslog.scan_files(fileList)
+        n = (len(fileList), 'file')
+        rows = []
+        t, _ = timed(lambda: [[fits.open(f)[0].header.get(kw, '')
+                              for kw in keywords] for f in fileList])
+        rows.append(('fits.open()[0].header', t, n))
+        t, _ = timed(lambda: [[fits.getheader(f, 0).get(kw, '')
+                              for kw in keywords] for f in fileList])
+        rows.append(('fits.getheader()', t, n))
+        t, _ = timed(lambda: [obslog.read_header(f, keywords)
+                              for f in fileList])
+        rows.append(('obslog.read_header()', t, n))
+        report('Reading KW_MAP keywords from {} files'.format(len(fileList)),
+               rows)
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+
+#---------------------------------------------------------------------
+def make_obslog(nrows, seed=0):
+    # Make a synthetic observation log with realistic column contents
+    rng = np.random.RandomState(seed)
+    nights = ['2018{:02d}{:02d}'.format(1 + i // 28, 1 + i % 28)
+              for i in range(max(nrows // 500, 1))]
+    night = np.sort(rng.randint(len(nights), size=nrows))
+    seqnum = np.arange(nrows) % 1000 + 1
+    choice = lambda values: np.array(values)[rng.randint(len(values),
+                                                         size=nrows)]
+    t = Table()
+    t['File'] = ['S{}S{:04d}'.format(nights[n], i)
+                 for n, i in zip(night, seqnum)]
+    t['Object'] = choice(['Dark', 'GCALflat', 'Ar', 'Twilight'] +
+                         ['Target{}'.format(i) for i in range(50)])
+    t['Filter'] = choice(['Y', 'J', 'H', 'Ks', 'JH', 'HK'])
+    t['Disperser'] = choice(['Open', 'JH', 'HK', 'R3K'])
+    t['Texp'] = choice([2., 5., 10., 15., 30., 60., 120., 300.])
+    t['Date'] = [nights[n] for n in night]
+    t['ObsType'] = choice(['DARK', 'FLAT', 'ARC', 'OBJECT'])
+    t['ObsClass'] = choice(['dayCal', 'partnerCal', 'acqCal', 'science'])
+    t['Mask'] = choice(['1pix-slit', '2pix-slit', '4pix-slit', 'mos1'])
+    t['GCAL Shutter'] = choice(['OPEN', 'CLOSED'])
+    t['RA Offset'] = rng.normal(scale=30, size=nrows)
+    t['Dec Offset'] = rng.normal(scale=30, size=nrows)
+    t['use_me'] = np.ones((nrows,), dtype=bool)
+    t.sort('File')
+    return t
+
+def scan_query(table, qd):
+    # The original ObsLog.query(), which compares every column in full
+    try:
+        date1, date2 = str(qd['Date']).split(':')
+    except ValueError:
+        good = table['Date'] == str(qd['Date'])
+    except KeyError:
+        good = np.array([True] * len(table))
+    else:
+        good = np.logical_and(table['Date'] >= date1, table['Date'] <= date2)
+    if 'first' in qd:
+        good &= table['File'] >= qd['first']
+    if 'last' in qd:
+        good &= table['File'] <= qd['last']
+    good &= np.logical_and.reduce([table[k]==v for k,v in qd.items()
+                                   if (k in table.colnames and k != 'Date')])
+    return table[good]
+
+def sample_queries(table, nqueries, seed=1):
+    # Make queries like those made by the select*() functions
+    rng = np.random.RandomState(seed)
+    queries = []
+    for i in range(nqueries):
+        row = table[rng.randint(len(table))]
+        qd = {'ObsType': row['ObsType'], 'Texp': row['Texp']}
+        if i % 2:
+            qd.update({'Filter': row['Filter'], 'Disperser': row['Disperser']})
+        if i % 3 == 1:
+            qd['Date'] = row['Date']
+        elif i % 3 == 2:
+            qd.update({'first': row['File'], 'last': table['File'][-1]})
+        queries.append(qd)
+    return queries
+
+def bench_queries(args):
+    # Compare ObsLog.query() with a full scan of every column
+    rows = []
+    for nrows in args.nrows:
+        table = make_obslog(nrows)
+        queries = sample_queries(table, args.nqueries)
+        t_load, obslog = timed(ObsLog, table)
+        table = obslog.table
+        t_scan, scanned = timed(lambda: [scan_query(table, qd)
+                                         for qd in queries])
+        t_query, queried = timed(lambda: [obslog.query(qd)
+                                          for qd in queries])
+        for qd, r1, r2 in zip(queries, scanned, queried):
+            if list(r1['File']) != list(r2['File']):
+                raise ValueError('Query results differ for {}'.format(qd))
+        n = (len(queries), 'query')
+        rows.extend([('{} rows: load'.format(nrows), t_load, (1, 'load')),
+                     ('{} rows: scan'.format(nrows), t_scan, n),
+                     ('{} rows: ObsLog.query()'.format(nrows), t_query, n)])
+    report('Querying the observation log', rows)
+
+#---------------------------------------------------------------------
+def strip_load(fname):
+    # The original ObsLog loader, which strips strings one value at a time
+    table = Table.read(fname)
+    table = table[table['use_me']]
+    for col in table.colnames:
+        try:
+            table[col] = [v.strip() for v in table[col]]
+        except AttributeError:
+            pass
+    return table
+
+def table_bytes(table):
+    # Memory used by the columns of a Table
+    return sum(table[col].nbytes for col in table.colnames)
+
+def obslog_bytes(obslog):
+    # Memory used by the table an ObsLog stores (with the categorical
+    # columns as codes), and by the distinct values of those columns
+    return (table_bytes(obslog._table),
+            sum(values.nbytes for values in obslog._values.values()))
+
+def bench_load(args):
+    # Compare the time taken to load a log, and the memory it then uses
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for nrows in args.nrows:
+            fname = os.path.join(tmpdir, 'obsLog.fits')
+            table = make_obslog(nrows)
+            for col in ('File', 'Object', 'Filter', 'Date', 'ObsType'):
+                table[col] = table[col].astype('U40')
+            table.write(fname, overwrite=True)
+            n = (1, 'load')
+            t_old, old = timed(strip_load, fname)
+            t_new, new = timed(ObsLog, fname)
+            columns, values = obslog_bytes(new)
+            report('Loading a {}-row observation log'.format(nrows),
+                   [('list comprehension strip', t_old, n),
+                    ('ObsLog()', t_new, n)])
+            for descr, nbytes in (('list comprehension columns',
+                                   table_bytes(old)),
+                                  ('ObsLog() decoded columns',
+                                   table_bytes(new.table)),
+                                  ('ObsLog() stored columns', columns),
+                                  ('ObsLog() categorical values', values)):
+                print('  {:40s} {:10.1f} kB'.format(descr, nbytes / 1024.))
+    finally:
+        shutil.rmtree(tmpdir)
+
+#---------------------------------------------------------------------
+def make_dark_files(path, nfiles, size, seed=0):
+    # Write prepared darks (with SCI, VAR, and DQ extensions) with read
+    # noise, hot pixels, bad pixels, and cosmic rays
+    rng = np.random.RandomState(seed)
+    dark = rng.exponential(5., size=(size, size)).astype(np.float32)
+    var = np.full((size, size), 100., dtype=np.float32)
+    dq = np.zeros((size, size), dtype=np.int16)
+    dq[rng.randint(size, size=size), rng.randint(size, size=size)] = 1
+    fileList = []
+    for i in range(nfiles):
+        sci = dark + rng.normal(scale=10., size=(size, size)).astype(
+            np.float32)
+        ncr = size * size // 10000
+        sci[rng.randint(size, size=ncr), rng.randint(size, size=ncr)] += 1e4
+        fname = os.path.join(path, 'pS20180101S{:04d}.fits'.format(i+1))
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(sci, name='SCI'),
+                      fits.ImageHDU(var, name='VAR'),
+                      fits.ImageHDU(dq, name='DQ')]).writeto(fname)
+        fileList.append(fname)
+    return fileList
+
+def bench_combine(args):
+    # Compare combine_frames() with gemcombine (if PyRAF is available) on
+    # stacks of synthetic darks
+    try:
+        from pyraf import iraf
+        from pyraf.iraf import gemini, gemtools
+    except Exception:
+        iraf = None
+    modes = [('median', 'none'), ('average', 'none'),
+             ('average', 'avsigclip')]
+    for nfiles in args.nfiles:
+        tmpdir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            fileList = make_dark_files(tmpdir, nfiles, args.size)
+            n = (nfiles, 'frame')
+            rows = []
+            for mode, reject in modes:
+                descr = '{}, reject={}'.format(mode, reject)
+                t, _ = timed(combine.combine_frames, fileList,
+                             os.path.join(tmpdir, 'MCdark_py'), combine=mode,
+                             reject=reject, fl_vardq='yes')
+                rows.append(('combine_frames() ' + descr, t, n))
+                if iraf is None:
+                    continue
+                iraf.chdir(tmpdir)
+                iraf.imdelete('MCdark_iraf.fits', verify='no')
+                t, _ = timed(gemtools.gemcombine,
+                             ','.join(os.path.basename(f) for f in fileList),
+                             'MCdark_iraf', combine=mode, reject=reject,
+                             fl_vardq='yes', logfile='gemcombine.log')
+                rows.append(('gemcombine ' + descr, t, n))
+            report('Combining {} {}x{} darks'.format(nfiles, args.size,
+                                                     args.size), rows)
+            if tracemalloc:
+                # The memory allocated, not counting the memory-mapped files
+                tracemalloc.start()
+                combine.combine_frames(fileList,
+                                       os.path.join(tmpdir, 'MCdark_py'),
+                                       reject='avsigclip', fl_vardq='yes')
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print('  {:40s} {:10.1f} MB'.format(
+                    'combine_frames() peak memory', peak / 1048576.))
+        finally:
+            if iraf is not None:
+                iraf.chdir(cwd)
+            shutil.rmtree(tmpdir)
+    if iraf is None:
+        print('PyRAF is not available, so gemcombine was not run')
+
+def make_science_files(path, nfiles, size, seed=0):
+    # Write reduced frames (with SCI, VAR, and DQ extensions) of a field of
+    # stars, dithered by up to 5% of their size, with a WCS
+    rng = np.random.RandomState(seed)
+    nstars = size * size // 50000
+    stars = rng.uniform(0, size, size=(nstars, 2))
+    var = np.full((size, size), 100., dtype=np.float32)
+    fileList = []
+    for i in range(nfiles):
+        dither = rng.randint(-size // 20, size // 20 + 1, size=2)
+        sci = rng.normal(scale=10., size=(size, size)).astype(np.float32)
+        for x, y in (stars - dither).astype(int):
+            sci[max(y-2, 0):y+3, max(x-2, 0):x+3] += 1000.
+        dq = np.zeros((size, size), dtype=np.int16)
+        dq[rng.randint(size, size=size), rng.randint(size, size=size)] = 1
+        header = fits.Header([('CTYPE1', 'RA---TAN'), ('CTYPE2', 'DEC--TAN'),
+                              ('CRVAL1', 150.), ('CRVAL2', 2.),
+                              ('CRPIX1', size / 2. - dither[0]),
+                              ('CRPIX2', size / 2. - dither[1]),
+                              ('CD1_1', -5e-5), ('CD2_2', 5e-5)])
+        fname = os.path.join(path, 'rfdpS20180101S{:04d}.fits'.format(i+1))
+        fits.HDUList([fits.PrimaryHDU(),
+                      fits.ImageHDU(sci, header=header, name='SCI'),
+                      fits.ImageHDU(var, name='VAR'),
+                      fits.ImageHDU(dq, name='DQ')]).writeto(fname)
+        fileList.append(fname)
+    return fileList
+
+def bench_coadd(args):
+    # Time coadd_frames() on dithered synthetic frames, with different
+    # numbers of threads
+    for nfiles in args.nfiles:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fileList = make_science_files(tmpdir, nfiles, args.size)
+            outfile = os.path.join(tmpdir, 'coadd')
+            rows = []
+            for nthreads in args.nthreads:
+                t, _ = timed(coadd.coadd_frames, fileList, outfile,
+                             nthreads=nthreads)
+                rows.append(('coadd_frames() {} threads'.format(nthreads), t,
+                             (nfiles, 'frame')))
+            t, _ = timed(coadd.coadd_frames, fileList, outfile,
+                         alignmethod='xcorr', nthreads=args.nthreads[-1])
+            rows.append(('coadd_frames() xcorr', t, (nfiles, 'frame')))
+            report('Coadding {} {}x{} frames'.format(nfiles, args.size,
+                                                     args.size), rows)
+            if tracemalloc:
+                tracemalloc.start()
+                coadd.coadd_frames(fileList, outfile,
+                                   nthreads=args.nthreads[-1])
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print('  {:40s} {:10.1f} MB'.format(
+                    'coadd_frames() peak memory', peak / 1048576.))
+        finally:
+            shutil.rmtree(tmpdir)
+
+########################################################################
+def benchmarks():
+    parser = argparse.ArgumentParser(description='Run timing benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+    p = subparsers.add_parser('headers', help='FITS header reading')
+    p.add_argument('path', nargs='?', help='Directory of raw files to read')
+    p.add_argument('-n', '--nfiles', type=int, default=500,
+                   help='Number of synthetic files if no directory is given')
+    p.set_defaults(func=bench_headers)
+    p = subparsers.add_parser('queries', help='Observation log queries')
+    p.add_argument('-n', '--nrows', type=int, nargs='+',
+                   default=[1000, 10000, 100000],
+                   help='Number of rows in the synthetic log(s)')
+    p.add_argument('-q', '--nqueries', type=int, default=200,
+                   help='Number of queries to make')
+    p.set_defaults(func=bench_queries)
+    p = subparsers.add_parser('load', help='Loading the observation log')
+    p.add_argument('-n', '--nrows', type=int, nargs='+',
+                   default=[1000, 10000, 100000],
+                   help='Number of rows in the synthetic log(s)')
+    p.set_defaults(func=bench_load)
+    p = subparsers.add_parser('combine', help='Combining darks')
+    p.add_argument('-n', '--nfiles', type=int, nargs='+', default=[5, 10, 20],
+                   help='Number of synthetic darks in each stack')
+    p.add_argument('-s', '--size', type=int, default=2048,
+                   help='Width and height of the synthetic darks')
+    p.set_defaults(func=bench_combine)
+    p = subparsers.add_parser('coadd', help='Coadding science frames')
+    p.add_argument('-n', '--nfiles', type=int, nargs='+', default=[9, 50],
+                   help='Number of synthetic frames in each coadd')
+    p.add_argument('-s', '--size', type=int, default=2048,
+                   help='Width and height of the synthetic frames')
+    p.add_argument('-t', '--nthreads', type=int, nargs='+',
+                   default=[1, coadd.NTHREADS],
+                   help='Numbers of threads to use')
+    p.set_defaults(func=bench_coadd)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    benchmarks()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# Coadding imaging frames in python, as an alternative to imcoadd.
+# This file must be in the same directory as the reduce_*.py scripts.
+import os
+import warnings
+from functools import partial
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from combine import TILE_SIZE, combine_tile, extension_header, is_yes
+from pipeline import traced
+
+# Number of tiles of the coadd to make at once, each in its own thread
+NTHREADS = cpu_count()
+
+# DQ flag for pixels of the coadd that aren't in any frame
+NO_DATA = 16
+
+def coadd_frames(infiles, outfile, alignmethod='wcs', reject='sigclip',
+                 lsigma=3., hsigma=3., fl_avg='yes', search=50,
+                 sci_ext='SCI', var_ext='VAR', dq_ext='DQ',
+                 nthreads=NTHREADS, **pars):
+    # Coadd reduced frames like imcoadd (with the same parameters, of
+    # which only these are used), shifting each by a whole number of
+    # pixels onto the first frame, and taking the mean (or, if fl_avg
+    # isn't set, the mean times the number of frames covering the pixel)
+    # of each pixel after rejecting values flagged in the DQ
+    # extensions and, if reject is 'sigclip' or 'avsigclip', outliers
+    # like combine_frames(). The offsets come from the WCS, or the
+    # RAOFFSET and DECOFFSE keywords if alignmethod is 'header', and with
+    # alignmethod 'xcorr' the WCS offsets are refined (by up to search
+    # pixels) by cross-correlating the frames. The frames are read
+    # through memory maps, a tile of rows of the coadd at a time in each
+    # thread, so apart from the coadd itself the memory needed is
+    # TILE_SIZE for each thread, unless there are too many frames for a
+    # single row to fit
+    if alignmethod not in ('wcs', 'header', 'xcorr'):
+        raise ValueError('Unsupported alignmethod option: {}'.format(
+            alignmethod))
+    if reject not in ('none', 'sigclip', 'avsigclip'):
+        raise ValueError('Unsupported reject option: {}'.format(reject))
+    infiles = [f if f.endswith('.fits') else f+'.fits' for f in infiles]
+    if not outfile.endswith('.fits'):
+        outfile += '.fits'
+    with traced('coadd_frames') as block:
+        hdulists = [fits.open(f, memmap=True) for f in infiles]
+        try:
+            # The data are looked at here, so the threads don't all try to
+            # map the same extensions at once
+            frames = [[extension_data(hdulist, ext)
+                       for ext in (sci_ext, var_ext, dq_ext)]
+                      for hdulist in hdulists]
+            if alignmethod == 'header':
+                offsets = header_offsets(hdulists, sci_ext)
+            else:
+                offsets = wcs_offsets(hdulists, sci_ext)
+            if alignmethod == 'xcorr':
+                offsets = xcorr_offsets(frames, offsets, int(search),
+                                        nthreads)
+            combine = partial(clipped_mean, reject=reject,
+                              lsigma=float(lsigma), hsigma=float(hsigma),
+                              avg=is_yes(fl_avg))
+            hdus = coadd_hdulists(hdulists, frames, offsets, combine,
+                                  (sci_ext, var_ext, dq_ext), nthreads)
+            hdus[0].header.add_history(
+                'Coadded {} images with coadd_frames (reject={})'.format(
+                    len(frames), reject))
+            hdus.writeto(outfile, overwrite=True)
+        finally:
+            for hdulist in hdulists:
+                hdulist.close()
+        block['read'] = sum(os.path.getsize(f) for f in infiles)
+        block['written'] = os.path.getsize(outfile)
+
+def extension_data(hdulist, ext):
+    # Return the data in an extension of an image, or None if there is no
+    # such extension
+    try:
+        return hdulist[ext].data
+    except KeyError:
+        return None
+
+def wcs_offsets(hdulists, sci_ext):
+    # Return the (x, y) offsets, in pixels, that put each frame onto the
+    # first, from the position of the centre of the first in each frame
+    wcs = [WCS(hdulist[sci_ext].header) for hdulist in hdulists]
+    ny, nx = hdulists[0][sci_ext].data.shape
+    centre = np.array([[(nx - 1) / 2., (ny - 1) / 2.]])
+    world = wcs[0].wcs_pix2world(centre, 0)
+    return np.array([centre[0] - w.wcs_world2pix(world, 0)[0] for w in wcs])
+
+def header_offsets(hdulists, sci_ext):
+    # Return the (x, y) offsets, in pixels, that put each frame onto the
+    # first, from the telescope offsets (in arcseconds) in their headers
+    # and the pixel scale and orientation of the first
+    cd = WCS(hdulists[0][sci_ext].header).pixel_scale_matrix
+    offsets = np.array([[hdulist[0].header['RAOFFSET'],
+                         hdulist[0].header['DECOFFSE']]
+                        for hdulist in hdulists]) / 3600.
+    return (offsets - offsets[0]).dot(np.linalg.inv(cd).T)
+
+def xcorr_offsets(frames, offsets, search, nthreads):
+    # Refine the offsets of the frames (SCI, VAR, DQ) by finding the peak
+    # of the cross-correlation of the sources in each with those in the
+    # first, within search pixels of the offsets given
+    reference = source_image(frames[0])
+    def refine(args):
+        frame, offset = args
+        return xcorr_offset(reference, source_image(frame), offset, search)
+    pool = ThreadPool(max(1, min(nthreads, len(frames) - 1)))
+    try:
+        return np.array([offsets[0]] + pool.map(refine, list(zip(
+            frames[1:], offsets[1:]))))
+    finally:
+        pool.close()
+        pool.join()
+
+def source_image(frame):
+    # Return an image of the sources in a frame (SCI, VAR, DQ): the pixels
+    # more than 5 times the noise above the background, less the
+    # background, and zero elsewhere
+    sci, var, dq = frame
+    data = np.array(sci, dtype=np.float32)
+    bad = ~np.isfinite(data)
+    if dq is not None:
+        bad |= dq != 0
+    values = data[~bad]
+    background = np.median(values)
+    sigma = 1.4826 * np.median(np.abs(values - background))
+    data -= background
+    data[bad | (data < 5 * sigma)] = 0
+    return data
+
+def xcorr_offset(reference, image, offset, search):
+    # Return the offset of an image from a reference within search pixels
+    # of a first guess, from the peak of their cross-correlation
+    guess = np.round(offset).astype(int)
+    pad = np.abs(guess) + search + 1
+    shape = (reference.shape[0] + pad[1], reference.shape[1] + pad[0])
+    xcorr = np.fft.irfft2(np.fft.rfft2(reference, shape) *
+                          np.conj(np.fft.rfft2(image, shape)), shape)
+    # The shifts that are searched, wrapped like the cross-correlation
+    dx = np.arange(guess[0] - search, guess[0] + search + 1)
+    dy = np.arange(guess[1] - search, guess[1] + search + 1)
+    window = xcorr[np.ix_(dy % shape[0], dx % shape[1])]
+    y, x = np.unravel_index(np.argmax(window), window.shape)
+    if window[y, x] <= 0:
+        # No sources in common
+        return offset
+    return np.array([dx[x], dy[y]], dtype=float)
+
+def merge_coadds(infiles, outfile, sci_ext='SCI', var_ext='VAR',
+                 dq_ext='DQ', nthreads=NTHREADS, **pars):
+    # Merge coadds of parts of a sequence of frames (e.g., from
+    # coadd_frames()) into one, lined up by their WCS, weighting each pixel
+    # by its inverse variance (or, if the coadds have no VAR extensions,
+    # by the number of frames in the coadd, from NCOMBINE) and leaving out
+    # pixels flagged in the DQ extensions
+    infiles = [f if f.endswith('.fits') else f+'.fits' for f in infiles]
+    if not outfile.endswith('.fits'):
+        outfile += '.fits'
+    with traced('merge_coadds') as block:
+        hdulists = [fits.open(f, memmap=True) for f in infiles]
+        try:
+            frames = [[extension_data(hdulist, ext)
+                       for ext in (sci_ext, var_ext, dq_ext)]
+                      for hdulist in hdulists]
+            ncombine = np.array([hdulist[0].header.get('NCOMBINE', 1)
+                                 for hdulist in hdulists], dtype=np.float32)
+            hdus = coadd_hdulists(hdulists, frames,
+                                  wcs_offsets(hdulists, sci_ext),
+                                  weighted_mean, (sci_ext, var_ext, dq_ext),
+                                  nthreads, weights=ncombine)
+            hdus[0].header['NCOMBINE'] = int(ncombine.sum())
+            hdus[0].header.add_history(
+                'Merged {} coadds with merge_coadds'.format(len(frames)))
+            hdus.writeto(outfile, overwrite=True)
+        finally:
+            for hdulist in hdulists:
+                hdulist.close()
+        block['read'] = sum(os.path.getsize(f) for f in infiles)
+        block['written'] = os.path.getsize(outfile)
+
+def coadd_hdulists(hdulists, frames, offsets, combine, exts, nthreads,
+                   weights=None):
+    # Coadd open frames (see coadd_frames()) with a function that combines
+    # a stack of tiles (see coadd_tile()), returning an HDUList with the
+    # headers of the first frame
+    shifts = np.round(offsets).astype(int)
+    sizes = np.array([sci.shape[::-1] for sci, var, dq in frames])
+    origin = shifts.min(axis=0)
+    nx, ny = (shifts + sizes).max(axis=0) - origin
+    # Where each frame goes in the coadd
+    shifts -= origin
+    sci = np.empty((ny, nx), dtype=np.float32)
+    var = np.empty((ny, nx), dtype=np.float32)
+    dq = np.empty((ny, nx), dtype=np.int16)
+    # As in combine_hdulists(), but with at least one tile per thread
+    nrows = max(1, int(TILE_SIZE * 1048576) // (len(frames) * nx * 40))
+    nrows = min(nrows, max(1, -(-ny // nthreads)))
+    def coadd(rows):
+        sci[rows], var[rows], dq[rows] = coadd_tile(
+            frames, shifts, rows, nx, combine, weights)
+    tiles = [slice(y0, min(y0 + nrows, ny)) for y0 in range(0, ny, nrows)]
+    # The warnings filters are shared by the threads, so they are set here
+    # rather than only by combine_tile()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if nthreads > 1 and len(tiles) > 1:
+            pool = ThreadPool(min(nthreads, len(tiles)))
+            try:
+                pool.map(coadd, tiles)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for rows in tiles:
+                coadd(rows)
+    sci_ext, var_ext, dq_ext = exts
+    phu = hdulists[0][0].header.copy()
+    phu['NCOMBINE'] = (len(frames), 'Number of images combined')
+    header = extension_header(hdulists[0], sci_ext)
+    for axis in (1, 2):
+        kw = 'CRPIX{}'.format(axis)
+        if kw in header:
+            header[kw] += shifts[0][axis-1]
+    hdus = [fits.PrimaryHDU(header=phu),
+            fits.ImageHDU(sci, header=header, name=sci_ext),
+            fits.ImageHDU(var, name=var_ext),
+            fits.ImageHDU(dq, name=dq_ext)]
+    return fits.HDUList(hdus)
+
+def coadd_tile(frames, shifts, rows, nx, combine, weights=None):
+    # Coadd the frames that overlap some rows of the coadd, returning the
+    # coadded tile, its variance, and DQ. The values of the frames are put
+    # in a stack of tiles (frame, row, column), with NaN outside each
+    # frame, and combined with combine(tile, tile_var, tile_dq), which
+    # returns NaN for pixels with no values. If the frames have weights,
+    # those of the frames in the stack are passed to combine() too
+    overlap = [i for i, (sci, var, dq) in enumerate(frames)
+               if shifts[i][1] < rows.stop and
+               shifts[i][1] + sci.shape[0] > rows.start]
+    nrows = rows.stop - rows.start
+    if not overlap:
+        return 0, 0, NO_DATA
+    tile = np.full((len(overlap), nrows, nx), np.nan, dtype=np.float32)
+    tile_var = np.full(tile.shape, np.nan, dtype=np.float32)
+    tile_dq = np.zeros(tile.shape, dtype=np.int16)
+    for n, i in enumerate(overlap):
+        sci, var, dq = frames[i]
+        x0, y0 = shifts[i]
+        # The rows of the frame in the tile
+        y1, y2 = max(rows.start - y0, 0), min(rows.stop - y0, sci.shape[0])
+        out = (n, slice(y0 + y1 - rows.start, y0 + y2 - rows.start),
+               slice(x0, x0 + sci.shape[1]))
+        tile[out] = sci[y1:y2]
+        if var is not None:
+            tile_var[out] = var[y1:y2]
+        if dq is not None:
+            tile_dq[out] = dq[y1:y2]
+    if any(frames[i][1] is None for i in overlap):
+        tile_var = None
+    if weights is None:
+        sci, var, dq = combine(tile, tile_var, tile_dq)
+    else:
+        sci, var, dq = combine(tile, tile_var, tile_dq, weights[overlap])
+    none = np.isnan(sci)
+    sci[none] = 0
+    var[none] = 0
+    dq[none] |= NO_DATA
+    return sci, var, dq
+
+def clipped_mean(tile, tile_var, tile_dq, reject, lsigma, hsigma, avg):
+    # Combine a stack of tiles like combine_frames(), taking the mean (or
+    # the mean times the number of frames covering the pixel, if avg is
+    # false)
+    sci, var, dq = combine_tile(tile, tile_var, tile_dq, 'average', reject,
+                                lsigma, hsigma)
+    if not avg:
+        ncover = (~np.isnan(tile)).sum(axis=0).reshape(sci.shape)
+        sci *= ncover
+        var *= ncover**2
+    return sci, var, dq
+
+def weighted_mean(tile, tile_var, tile_dq, nframes=None):
+    # Combine a stack of tiles, taking the mean of the unflagged values of
+    # each pixel weighted by their inverse variances (or, without them, by
+    # the number of frames in each tile of the stack, if nframes is given,
+    # and otherwise equally). Pixels with no such values get the
+    # unweighted mean of all their values, except those of pixels with no
+    # data, and all their DQ flags
+    tile[(tile_dq & NO_DATA) != 0] = np.nan
+    valid = ~np.isnan(tile)
+    good = valid & (tile_dq == 0)
+    if tile_var is not None:
+        good &= tile_var > 0
+        weights = np.where(good, 1 / np.where(good, tile_var, 1), 0)
+    elif nframes is not None:
+        weights = np.where(good, np.reshape(nframes, (-1, 1, 1)), 0)
+    else:
+        weights = good.astype(np.float32)
+    total = weights.sum(axis=0)
+    sci = (np.where(good, tile, 0) * weights).sum(axis=0) / total
+    if tile_var is not None:
+        var = 1 / total
+    else:
+        # The variance of a single frame from the weighted scatter of the
+        # values (as in combine_tile(), for equal weights), divided by the
+        # total weight
+        ngood = good.sum(axis=0)
+        scatter = (np.where(good, tile - sci, 0)**2 * weights).sum(axis=0)
+        var = scatter / (ngood - 1) / total
+    none = total == 0
+    sci[none] = np.nanmean(tile[:, none], axis=0)
+    var[none | ~np.isfinite(var)] = 0
+    dq = np.where(none, np.bitwise_or.reduce(np.where(valid, tile_dq, 0),
+                                             axis=0), 0).astype(np.int16)
+    return sci.astype(np.float32), var.astype(np.float32), dq
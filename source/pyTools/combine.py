@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# Combining images in python, as an alternative to gemcombine.
+# This file must be in the same directory as the reduce_*.py scripts.
+import os
+import warnings
+import numpy as np
+from astropy.io import fits
+from pipeline import traced
+
+# Memory (in MB) to use for each tile of rows of the stack of images; the
+# memory needed doesn't depend on how many images there are
+TILE_SIZE = 64
+
+def is_yes(value):
+    # Interpret the value of an IRAF boolean parameter
+    return value is True or str(value).lower() in ('yes', 'y', 'true')
+
+def combine_frames(infiles, outfile, combine='average', reject='avsigclip',
+                   lsigma=3., hsigma=3., fl_vardq='no', sci_ext='SCI',
+                   var_ext='VAR', dq_ext='DQ', **pars):
+    # Combine MEF images like gemcombine (with the same parameters, of
+    # which only these are used), taking the median or mean of each pixel
+    # after rejecting values flagged in the DQ extensions and, if reject
+    # is 'sigclip' or 'avsigclip', values more than lsigma (hsigma) times
+    # the standard deviation below (above) the median. The variance and
+    # DQ are propagated if fl_vardq is set. The images are read through
+    # memory maps a tile of rows at a time
+    if combine not in ('average', 'median'):
+        raise ValueError('Unsupported combine option: {}'.format(combine))
+    if reject not in ('none', 'sigclip', 'avsigclip'):
+        raise ValueError('Unsupported reject option: {}'.format(reject))
+    infiles = [f if f.endswith('.fits') else f+'.fits' for f in infiles]
+    if not outfile.endswith('.fits'):
+        outfile += '.fits'
+    with traced('combine_frames') as block:
+        hdulists = [fits.open(f, memmap=True) for f in infiles]
+        try:
+            hdus = combine_hdulists(hdulists, combine, reject, float(lsigma),
+                                    float(hsigma), is_yes(fl_vardq),
+                                    sci_ext, var_ext, dq_ext)
+            hdus.writeto(outfile, overwrite=True)
+        finally:
+            for hdulist in hdulists:
+                hdulist.close()
+        block['read'] = sum(os.path.getsize(f) for f in infiles)
+        block['written'] = os.path.getsize(outfile)
+
+def combine_hdulists(hdulists, combine, reject, lsigma, hsigma, vardq,
+                     sci_ext, var_ext, dq_ext):
+    # Combine open MEF images (see combine_frames()), returning an HDUList
+    # with the headers of the first image
+    scis = extension_data(hdulists, sci_ext)
+    variances = extension_data(hdulists, var_ext) if vardq else None
+    dqs = extension_data(hdulists, dq_ext)
+    nimg, (ny, nx) = len(scis), scis[0].shape
+    sci = np.empty((ny, nx), dtype=np.float32)
+    var = np.empty((ny, nx), dtype=np.float32)
+    dq = np.zeros((ny, nx), dtype=np.int16)
+    # Each image needs about 40 bytes per pixel of the tile: for the tile
+    # itself, a copy with the rejected values set to NaN, its variance and
+    # DQ, and the arrays used while rejecting values
+    nrows = max(1, int(TILE_SIZE * 1048576) // (nimg * nx * 40))
+    for y0 in range(0, ny, nrows):
+        rows = slice(y0, min(y0 + nrows, ny))
+        tile = np.array([data[rows] for data in scis], dtype=np.float32)
+        tile_var = (np.array([data[rows] for data in variances],
+                             dtype=np.float32)
+                    if variances is not None else None)
+        tile_dq = (np.array([data[rows] for data in dqs])
+                   if dqs is not None else None)
+        sci[rows], var[rows], dq[rows] = combine_tile(
+            tile, tile_var, tile_dq, combine, reject, lsigma, hsigma)
+    phu = hdulists[0][0].header.copy()
+    phu['NCOMBINE'] = (nimg, 'Number of images combined')
+    phu.add_history('Combined {} images with combine_frames ({}, '
+                    'reject={})'.format(nimg, combine, reject))
+    hdus = [fits.PrimaryHDU(header=phu),
+            fits.ImageHDU(sci, header=extension_header(hdulists[0], sci_ext),
+                          name=sci_ext)]
+    if vardq:
+        hdus.extend([
+            fits.ImageHDU(var, header=extension_header(hdulists[0], var_ext),
+                          name=var_ext),
+            fits.ImageHDU(dq, header=extension_header(hdulists[0], dq_ext),
+                          name=dq_ext)])
+    return fits.HDUList(hdus)
+
+def extension_data(hdulists, ext):
+    # Return the data in an extension of each image, or None if any of the
+    # images doesn't have it
+    try:
+        return [hdulist[ext].data for hdulist in hdulists]
+    except KeyError:
+        return None
+
+def extension_header(hdulist, ext):
+    # Return a copy of the header of an extension, without the keywords
+    # for scaling its data, or None if there is no such extension
+    try:
+        header = hdulist[ext].header.copy()
+    except KeyError:
+        return None
+    for kw in ('BZERO', 'BSCALE'):
+        if kw in header:
+            del header[kw]
+    return header
+
+def combine_tile(tile, tile_var, tile_dq, combine, reject, lsigma, hsigma):
+    # Combine a stack of tiles (image, row, column), returning the combined
+    # tile, its variance, and DQ. A pixel is only flagged in the DQ (with
+    # all the flags of its inputs) if none of its values could be used, in
+    # which case all of them are combined
+    nimg, nrows, nx = tile.shape
+    tile = tile.reshape(nimg, -1)
+    if tile_var is not None:
+        tile_var = tile_var.reshape(nimg, -1)
+    data = tile.copy()
+    if tile_dq is not None:
+        tile_dq = tile_dq.reshape(nimg, -1)
+        data[tile_dq != 0] = np.nan
+    with warnings.catch_warnings():
+        # Pixels with no values left are dealt with afterwards
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if reject != 'none':
+            sigma_clip(data, lsigma, hsigma,
+                       nx if reject == 'avsigclip' else None)
+        used = ~np.isnan(data)
+        nused = used.sum(axis=0)
+        if combine == 'median':
+            sci = nan_median(data)
+        else:
+            sci = np.nanmean(data, axis=0)
+        if tile_var is not None:
+            var = np.where(used, tile_var, 0).sum(axis=0) / nused**2
+        else:
+            var = np.nanvar(data, axis=0, ddof=1) / nused
+    # The variance of a median is larger than that of a mean by pi/2
+    if combine == 'median':
+        var *= np.pi / 2
+    none = nused == 0
+    if none.any():
+        # Values that don't exist (e.g., outside a frame in a coadd) are NaN
+        # in the tile itself, and stay NaN if there are no others
+        values = tile[:, none]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            sci[none] = (np.nanmedian(values, axis=0)
+                         if combine == 'median'
+                         else np.nanmean(values, axis=0))
+            if tile_var is not None:
+                var[none] = (np.nanmean(tile_var[:, none], axis=0) /
+                             (~np.isnan(values)).sum(axis=0))
+    var[~np.isfinite(var)] = 0
+    if tile_dq is not None:
+        dq = np.where(none, np.bitwise_or.reduce(tile_dq, axis=0), 0)
+    else:
+        dq = np.zeros(none.shape, dtype=np.int16)
+    shape = (nrows, nx)
+    return sci.reshape(shape), var.reshape(shape), dq.reshape(shape)
+
+def nan_median(data):
+    # Return the median of each column of a 2D array, ignoring NaNs (which
+    # np.sort() puts at the end), more quickly than np.nanmedian()
+    data = np.sort(data, axis=0)
+    n = (~np.isnan(data)).sum(axis=0)
+    cols = np.arange(data.shape[1])
+    return (data[(n - 1) // 2, cols] + data[n // 2, cols]) / 2
+
+def sigma_clip(data, lsigma, hsigma, pooled=None):
+    # Reject (set to NaN) values in a stack of images (image, pixel) more
+    # than lsigma (hsigma) times the standard deviation below (above) the
+    # median of each pixel, until none are left to reject. The standard
+    # deviation for each value is that of the other values, so one outlier
+    # can't hide itself in a small stack. If pooled is the length of the
+    # image rows (like avsigclip), it is at least the typical standard
+    # deviation of the pixels in the same row, which is less noisy when
+    # there are only a few images. After the first pass, only the pixels
+    # that have had values rejected are looked at again
+    pixels = slice(None)
+    floor = None
+    # Values are compared with the variance, scaled by the limit squared
+    scale = hsigma**2 if lsigma == hsigma else None
+    while True:
+        values = data[:, pixels]
+        dev = values - nan_median(values)
+        valid = ~np.isnan(dev)
+        dev[~valid] = 0
+        n = valid.sum(axis=0)
+        dev2 = dev * dev
+        total, squares = dev.sum(axis=0), dev2.sum(axis=0)
+        if pooled and floor is None:
+            # The median of the variances of the pixels in each row, scaled
+            # to the mean for a chi-squared distribution with n-1 degrees
+            # of freedom
+            k = np.maximum(n - 1, 1)
+            floor = np.repeat(nan_median(
+                (np.where(n > 1, squares / k, np.nan) /
+                 (1 - 2. / (9 * k))**3).reshape(-1, pooled).T), pooled)
+        var = squares - dev2
+        other = total - dev
+        other *= other
+        other /= n - 1
+        var -= other
+        var /= n - 2
+        np.maximum(var, 0 if floor is None else floor[pixels], out=var)
+        var *= scale if scale else np.where(dev < 0, lsigma**2, hsigma**2)
+        reject = (dev2 > var) & (n > 2)
+        rejected = reject.any(axis=0)
+        if not rejected.any():
+            return
+        values[reject] = np.nan
+        data[:, pixels] = values
+        pixels = np.arange(data.shape[1])[pixels][rejected]
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+# Reducing imaging frames and making skies in python, as an alternative to
+# running gemarith, nireduce, and nisky.
+# This file must be in the same directory as the reduce_*.py scripts.
+import os
+import time
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from astropy.io import fits
+from combine import TILE_SIZE, combine_tile, extension_header, is_yes
+from pipeline import traced
+
+# Number of frames to reduce at once, each in its own thread
+NTHREADS = cpu_count()
+
+# DQ flag used internally for pixels masked as being on objects
+OBJECT_FLAG = 16384
+
+def section_slices(section):
+    # Turn an IRAF image section ('[x1:x2,y1:y2]') into a tuple of slices
+    # for indexing a numpy array, which is the whole array if there is none
+    if not section:
+        return (slice(None), slice(None))
+    (x1, x2), (y1, y2) = [[int(value) for value in axis.split(':')]
+                          for axis in section.strip('[]').split(',')]
+    return (slice(y1 - 1, y2), slice(x1 - 1, x2))
+
+def read_image(fname, sci_ext='SCI', var_ext='VAR', dq_ext='DQ'):
+    # Read the primary header, and the SCI, VAR, and DQ data (the last two
+    # of which may be None) of a MEF image
+    if not fname.endswith('.fits'):
+        fname += '.fits'
+    image = []
+    with fits.open(fname) as hdulist:
+        for ext, dtype in ((sci_ext, np.float32), (var_ext, np.float32),
+                           (dq_ext, np.int16)):
+            try:
+                image.append(np.array(hdulist[ext].data, dtype=dtype))
+            except KeyError:
+                image.append(None)
+        return [hdulist[0].header, hdulist[sci_ext].header] + image
+
+def reduce_frames(infiles, outfiles, dark=None, flat=None, sky=None,
+                  fl_scalesky='yes', fl_autosky='no', skylevel=0.,
+                  statsec='', sci_ext='SCI', var_ext='VAR', dq_ext='DQ',
+                  nthreads=NTHREADS, **pars):
+    # Reduce prepared frames like gemarith and nireduce (with the same
+    # parameters, of which only these are used), writing only the final
+    # frames: subtract the dark, divide by the flat, and subtract the sky,
+    # scaled to the median of each frame in statsec if fl_scalesky is set,
+    # then add skylevel (or the median of the sky, if fl_autosky is set).
+    # Any of the calibrations can be None, to leave out that step, and sky
+    # can be a list of skies, one for each frame. The variance and DQ are
+    # propagated where the frames have them
+    exts = (sci_ext, var_ext, dq_ext)
+    skies = sky if isinstance(sky, list) else [sky] * len(infiles)
+    with traced('reduce_frames') as block:
+        # A sky for each frame is read by the thread reducing the frame
+        cals = [None if cal is None or isinstance(cal, list)
+                else read_image(cal, *exts)[2:] for cal in (dark, flat, sky)]
+        section = section_slices(statsec)
+        args = [(infile, outfile, cals, (dark, flat, frame_sky), section,
+                 is_yes(fl_scalesky), is_yes(fl_autosky), float(skylevel),
+                 exts)
+                for infile, outfile, frame_sky in zip(infiles, outfiles,
+                                                      skies)]
+        if nthreads > 1 and len(args) > 1:
+            pool = ThreadPool(min(nthreads, len(args)))
+            try:
+                sizes = pool.map(lambda args: reduce_frame(*args), args)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            sizes = [reduce_frame(*a) for a in args]
+        block['read'] = sum(size[0] for size in sizes) + sum(
+            os.path.getsize(cal if cal.endswith('.fits') else cal+'.fits')
+            for cal in set([dark, flat] + skies) if cal is not None)
+        block['written'] = sum(size[1] for size in sizes)
+
+def reduce_frame(infile, outfile, cals, names, section, scalesky, autosky,
+                 skylevel, exts):
+    # Reduce one frame (see reduce_frames()) with the data of the dark,
+    # flat, and sky (which are read here if only their names are given),
+    # returning the sizes of the files read and written
+    phu, sci_header, sci, var, dq = read_image(infile, *exts)
+    cals = [read_image(name, *exts)[2:] if cal is None and name is not None
+            else cal for cal, name in zip(cals, names)]
+    dark_sci, dark_var, dark_dq = cals[0] or (None, None, None)
+    flat_sci, flat_var, flat_dq = cals[1] or (None, None, None)
+    sky_sci, sky_var, sky_dq = cals[2] or (None, None, None)
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())
+    if dark_sci is not None:
+        sci -= dark_sci
+        if var is not None and dark_var is not None:
+            var += dark_var
+        if dq is not None and dark_dq is not None:
+            dq |= dark_dq
+        phu['GEMARITH'] = (timestamp, 'UT Time stamp for GEMARITH')
+    if flat_sci is not None:
+        sci, var = divide_flat(sci, var, flat_sci, flat_var)
+        if dq is not None and flat_dq is not None:
+            dq |= flat_dq
+        phu['FLATIMAG'] = (names[1], 'Flat field image used')
+    if sky_sci is not None:
+        if autosky:
+            skylevel = np.median(good_values(cals[2], section))
+        scale = 1.
+        if scalesky:
+            scale = (np.median(good_values((sci, None, dq), section)) /
+                     np.median(good_values(cals[2], section)))
+        sci -= scale * sky_sci
+        sci += skylevel
+        if var is not None and sky_var is not None:
+            var += scale**2 * sky_var
+        if dq is not None and sky_dq is not None:
+            dq |= sky_dq
+        phu['SKYIMAGE'] = (names[2], 'Sky image used')
+    if flat_sci is not None or sky_sci is not None:
+        phu['NIREDUCE'] = (timestamp, 'UT Time stamp for NIREDUCE')
+    hdus = [fits.PrimaryHDU(header=phu),
+            fits.ImageHDU(sci, header=sci_header, name=exts[0])]
+    if var is not None:
+        hdus.append(fits.ImageHDU(var, name=exts[1]))
+    if dq is not None:
+        hdus.append(fits.ImageHDU(dq, name=exts[2]))
+    if not outfile.endswith('.fits'):
+        outfile += '.fits'
+    fits.HDUList(hdus).writeto(outfile, overwrite=True)
+    if not infile.endswith('.fits'):
+        infile += '.fits'
+    return os.path.getsize(infile), os.path.getsize(outfile)
+
+def divide_flat(sci, var, flat_sci, flat_var):
+    # Divide an image and its variance (which may be None) by a flat,
+    # returning new arrays, which are zero where the flat is
+    good = flat_sci != 0
+    sci = np.divide(sci, flat_sci, out=np.zeros_like(sci), where=good)
+    if var is not None:
+        var = np.divide(var, flat_sci**2, out=np.zeros_like(var), where=good)
+        if flat_var is not None:
+            var += np.divide(sci**2 * flat_var, flat_sci**2,
+                             out=np.zeros_like(var), where=good)
+    return sci, var
+
+def good_values(image, section):
+    # Return the values in a section of an image (SCI, VAR, DQ) that aren't
+    # flagged in its DQ
+    sci, var, dq = image
+    values = sci[section]
+    if dq is not None:
+        values = values[dq[section] == 0]
+    return values[np.isfinite(values)]
+
+def make_sky(infiles, outfile, dark=None, flat=None, window=None, **pars):
+    # Make a sky from dithered frames like nisky followed by nireduce
+    # (with the same parameters, of which those of make_skies() are
+    # used), subtracting a dark from the frames first and dividing the
+    # sky by a flat, if they are given. If window is a number, a sky is
+    # made for each frame instead, from that many of the frames nearest
+    # to it in the list, and outfile is a list of their names
+    n = len(infiles)
+    if window:
+        windows = [sorted(sorted(range(n), key=lambda j: abs(j - i))[
+            1:int(window)+1]) for i in range(n)]
+        outputs = list(zip(outfile, windows))
+    else:
+        windows = [list(range(n))] * n
+        outputs = [(outfile, windows[0])]
+    make_skies(infiles, windows, outputs, dark, flat, **pars)
+
+def make_skies(infiles, windows, outputs, dark=None, flat=None,
+               combtype='median', rejtype='avsigclip', lsigma=3., hsigma=3.,
+               statsec='', threshold=4.5, ngrow=3, niter=2, sci_ext='SCI',
+               var_ext='VAR', dq_ext='DQ', **pars):
+    # Make skies from frames, each the median (or mean, if combtype is
+    # 'average') of a list of them, given by the indices of the frames,
+    # after scaling them to the same median in statsec and rejecting
+    # flagged values and outliers like combine_frames(). Objects are
+    # masked by making the sky of each frame from the frames in its
+    # window, and masking pixels more than threshold times the noise
+    # above it (and ngrow pixels around them), niter times. outputs is
+    # a list of (outfile, indices) pairs. The frames are read through
+    # memory maps a tile of rows at a time. The masks are made as they
+    # are needed, and each is forgotten once the last mask or sky made
+    # from it has been made, so with small windows only the masks of the
+    # frames near the current one are kept in memory
+    if combtype not in ('average', 'median'):
+        raise ValueError('Unsupported combtype option: {}'.format(combtype))
+    if rejtype not in ('none', 'sigclip', 'avsigclip'):
+        raise ValueError('Unsupported rejtype option: {}'.format(rejtype))
+    exts = (sci_ext, var_ext, dq_ext)
+    combine = (combtype, rejtype, float(lsigma), float(hsigma))
+    section = section_slices(statsec)
+    infiles = [f if f.endswith('.fits') else f+'.fits' for f in infiles]
+    with traced('make_skies') as block:
+        cals = [None if cal is None else read_image(cal, *exts)[2:]
+                for cal in (dark, flat)]
+        hdulists = [fits.open(f, memmap=True) for f in infiles]
+        niter = int(niter)
+        # The masks (and scales) of the frames after each iteration, with
+        # no masks before the first, and how many masks of the next
+        # iteration (or outputs, after the last) will be made from each.
+        # The mask of a frame is made from those of its window and its
+        # own (for its scale)
+        masks = [{} for level in range(niter + 1)]
+        scales = [{} for level in range(niter + 1)]
+        uses = [{} for level in range(niter + 1)]
+        for outfile, window in outputs:
+            for j in window:
+                uses[niter][j] = uses[niter].get(j, 0) + 1
+        for level in range(niter, 1, -1):
+            for i in uses[level]:
+                for j in list(windows[i]) + [i]:
+                    uses[level-1][j] = uses[level-1].get(j, 0) + 1
+        # The last sky made for each iteration (for the masks of frames
+        # with the same window)
+        last = {}
+
+        def get_mask(level, i):
+            # Return a frame's mask after an iteration, making it (and
+            # its scale) if it hasn't been made yet
+            if level == 0 or i in masks[level]:
+                return masks[level].get(i)
+            sky = get_sky(level - 1, windows[i])
+            mask = object_mask(hdulists[i], get_scale(level - 1, i), sky[0],
+                               section, cals[0], float(threshold),
+                               int(ngrow), exts)
+            masks[level][i] = mask
+            scales[level][i] = frame_scale(hdulists[i], mask, section,
+                                           cals[0], exts)
+            release(level - 1, list(windows[i]) + [i])
+            return mask
+
+        def get_scale(level, i):
+            # Return a frame's scale after an iteration
+            if i not in scales[level]:
+                if level:
+                    get_mask(level, i)
+                else:
+                    scales[0][i] = frame_scale(hdulists[i], None, section,
+                                               cals[0], exts)
+            return scales[level][i]
+
+        def get_sky(level, window, keep=True):
+            # Return the sky made from some frames after an iteration
+            if keep and last.get(level, (None,))[0] == window:
+                return last[level][1]
+            window_masks = dict((j, get_mask(level, j)) for j in window)
+            window_scales = dict((j, get_scale(level, j)) for j in window)
+            sky = combine_sky(hdulists, window, window_scales, window_masks,
+                              cals[0], combine, exts)
+            if keep:
+                last[level] = (window, sky)
+            return sky
+
+        def release(level, window):
+            # Forget the masks that have been used for the last time
+            for j in window:
+                if level:
+                    uses[level][j] -= 1
+                    if not uses[level][j]:
+                        del masks[level][j]
+
+        try:
+            written = 0
+            for outfile, window in outputs:
+                if not outfile.endswith('.fits'):
+                    outfile += '.fits'
+                # write_sky() changes the sky, so it isn't kept
+                sky = get_sky(niter, window, keep=False)
+                write_sky(outfile, hdulists[window[0]], sky, window,
+                          np.mean([get_scale(niter, j) for j in window]),
+                          cals[1], (dark, flat), exts)
+                release(niter, window)
+                written += os.path.getsize(outfile)
+        finally:
+            for hdulist in hdulists:
+                hdulist.close()
+        block['read'] = sum(os.path.getsize(f) for f in infiles)
+        block['written'] = written
+
+def read_rows(hdulist, rows, dark, exts):
+    # Return the SCI, VAR (or None), and DQ data of some rows of a MEF
+    # frame, as new arrays, with a dark (SCI, VAR, DQ) subtracted if it
+    # isn't None
+    sci_ext, var_ext, dq_ext = exts
+    sci = np.array(hdulist[sci_ext].data[rows], dtype=np.float32)
+    try:
+        var = np.array(hdulist[var_ext].data[rows], dtype=np.float32)
+    except KeyError:
+        var = None
+    try:
+        dq = np.array(hdulist[dq_ext].data[rows], dtype=np.int16)
+    except KeyError:
+        dq = np.zeros(sci.shape, dtype=np.int16)
+    if dark is not None:
+        dark_sci, dark_var, dark_dq = dark
+        sci -= dark_sci[rows]
+        if var is not None and dark_var is not None:
+            var += dark_var[rows]
+        if dark_dq is not None:
+            dq |= dark_dq[rows]
+    return sci, var, dq
+
+def frame_scale(hdulist, mask, section, dark, exts):
+    # Return the median of the unflagged and unmasked (if mask isn't
+    # None) pixels in a section of a frame
+    sci, var, dq = read_rows(hdulist, section[0], dark, exts)
+    if mask is not None:
+        dq[mask[section[0]]] |= OBJECT_FLAG
+    return np.median(good_values((sci, None, dq), (slice(None), section[1])))
+
+def combine_sky(hdulists, window, scales, masks, dark, combine, exts):
+    # Combine some of the frames, given by their indices, after dividing
+    # each by its scale (and masking it, if its mask isn't None), where
+    # scales and masks are indexed by frame, returning the SCI, VAR, and
+    # DQ of the sky
+    nimg = len(window)
+    ny, nx = hdulists[0][exts[0]].data.shape
+    sky = [np.empty((ny, nx), dtype=np.float32),
+           np.empty((ny, nx), dtype=np.float32),
+           np.zeros((ny, nx), dtype=np.int16)]
+    # As in combine_hdulists()
+    nrows = max(1, int(TILE_SIZE * 1048576) // (nimg * nx * 40))
+    for y0 in range(0, ny, nrows):
+        rows = slice(y0, min(y0 + nrows, ny))
+        frames = [read_rows(hdulists[i], rows, dark, exts) for i in window]
+        tile = np.array([sci / scales[i]
+                         for (sci, var, dq), i in zip(frames, window)],
+                        dtype=np.float32)
+        tile_var = (np.array([var / scales[i]**2
+                              for (sci, var, dq), i in zip(frames, window)],
+                             dtype=np.float32)
+                    if frames[0][1] is not None else None)
+        tile_dq = np.array([dq for sci, var, dq in frames])
+        for dq, i in zip(tile_dq, window):
+            if masks[i] is not None:
+                dq[masks[i][rows]] |= OBJECT_FLAG
+        tile_sky = combine_tile(tile, tile_var, tile_dq, *combine)
+        for data, tile_data in zip(sky, tile_sky):
+            data[rows] = tile_data
+    sky[2] &= ~OBJECT_FLAG
+    return sky
+
+def object_mask(hdulist, scale, sky, section, dark, threshold, ngrow, exts):
+    # Return a mask of the pixels of a frame more than threshold times the
+    # noise (from the median absolute deviation in the section) above a
+    # sky, grown by ngrow pixels
+    sci, var, dq = read_rows(hdulist, slice(None), dark, exts)
+    sci /= scale
+    sci -= sky[0]
+    values = good_values((sci, None, dq), section)
+    sigma = 1.4826 * np.median(np.abs(values - np.median(values)))
+    return grow_mask(sci > threshold * sigma, ngrow)
+
+def grow_mask(mask, ngrow):
+    # Return a mask with ngrow pixels around each masked pixel also masked
+    for axis in (0, 1):
+        grown = mask.copy()
+        for shift in range(1, min(ngrow, mask.shape[axis] - 1) + 1):
+            head, tail = [slice(None)] * 2, [slice(None)] * 2
+            head[axis], tail[axis] = slice(None, -shift), slice(shift, None)
+            grown[tuple(head)] |= mask[tuple(tail)]
+            grown[tuple(tail)] |= mask[tuple(head)]
+        mask = grown
+    return mask
+
+def write_sky(outfile, hdulist, sky, window, scale, flat, names, exts):
+    # Write a sky (SCI, VAR, DQ, scaled to one), scaled to the mean scale
+    # of its frames and divided by a flat (if it isn't None), with the
+    # headers of one of the frames. The VAR and DQ are only written if the
+    # frames have variances
+    sci, var, dq = sky
+    sci *= scale
+    var *= scale**2
+    phu = hdulist[0].header.copy()
+    phu['NCOMBINE'] = (len(window), 'Number of images combined')
+    phu.add_history('Sky made from {} images with make_skies()'.format(
+        len(window)))
+    if flat is not None:
+        flat_sci, flat_var, flat_dq = flat
+        sci, var = divide_flat(sci, var, flat_sci, flat_var)
+        if flat_dq is not None:
+            dq |= flat_dq
+        phu['FLATIMAG'] = (names[1], 'Flat field image used')
+    if names[0] is not None:
+        phu['DARKIMAG'] = (names[0], 'Dark image subtracted')
+    sci_ext, var_ext, dq_ext = exts
+    hdus = [fits.PrimaryHDU(header=phu),
+            fits.ImageHDU(sci, header=extension_header(hdulist, sci_ext),
+                          name=sci_ext)]
+    if extension_header(hdulist, var_ext) is not None:
+        hdus.extend([
+            fits.ImageHDU(var, header=extension_header(hdulist, var_ext),
+                          name=var_ext),
+            fits.ImageHDU(dq, header=extension_header(hdulist, dq_ext),
+                          name=dq_ext)])
+    fits.HDUList(hdus).writeto(outfile, overwrite=True)
@@ -2,8 +2,12 @@
 # RAShaw.astro@gmail.com 2017-Jan-22
 import os, sys
 import argparse
+import sqlite3
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+import numpy as np
 from astropy.io import fits
-from astropy.table import Table
+from astropy.table import Table, Column, MaskedColumn, vstack
 
 # Mapping of data header keywords to DB field names and DB types
 KW_MAP = [('OBJECT',   'Object'),
@@ -31,22 +35,116 @@ KW_MAP = [('OBJECT',   'Object'),
           ('AIRMASS',  'Airmass'),
 ]
 
-def obsLog(args):
-    """Construct an observation log from header keywords in FITS files."""
+# Logs with these extensions are written as SQLite databases, with
+# indexes on the columns most often used in queries
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+SQLITE_INDEXES = ('ObsType', 'Texp', 'Filter', 'Disperser', 'Mask', 'Date',
+                  'File')
+SQL_TYPES = {'f': 'REAL', 'i': 'INTEGER', 'u': 'INTEGER', 'b': 'INTEGER'}
+SQL_DTYPES = {'REAL': (float, 0.), 'INTEGER': (int, 0), 'TEXT': (str, '')}
 
-    descr_text = 'Construct an observation log from a directory of data files'
-    parser = argparse.ArgumentParser(description=descr_text)
-    parser.add_argument('dbFile', type=str, help='Name of file to create')
-    args = parser.parse_args()
+FITS_BLOCK = 2880
+FITS_CARD = 80
+
+def parse_value(text):
+    """Convert the value field of a header card to a python object.
+
+    Raises ValueError for anything that isn't a simple string, logical,
+    integer, or float value, so that the caller can use astropy instead.
+    """
+    text = text.strip()
+    if text.startswith("'"):
+        # String: a doubled quote is an escaped quote, a single one ends it
+        value, i = '', 1
+        while True:
+            j = text.index("'", i)
+            value += text[i:j]
+            if text[j+1:j+2] != "'":
+                break
+            value += "'"
+            i = j + 2
+        value = value.rstrip()
+        if value.endswith('&'):  # CONTINUE card(s) follow
+            raise ValueError('Long string value')
+        return value
+    text = text.split('/')[0].strip()
+    if text == 'T':
+        return True
+    if text == 'F':
+        return False
+    try:
+        return int(text)
+    except ValueError:
+        return float(text.replace('D', 'E'))
+
+def read_header(fname, keywords):
+    """Extract some keyword values from a FITS file's primary header.
+
+    This reads the 2880-byte header blocks directly until the END card,
+    only parsing the cards of the requested keywords, and is much
+    faster than having astropy construct the full header. A dict of the
+    values found is returned; ValueError is raised if the file doesn't
+    look like a simple FITS file.
+    """
+    wanted = set(keywords)
+    values = {}
+    with open(fname, 'rb') as f:
+        block = f.read(FITS_BLOCK)
+        if not block.startswith(b'SIMPLE  ='):
+            raise ValueError('{} is not a FITS file'.format(fname))
+        while len(block) == FITS_BLOCK:
+            if not isinstance(block, str):  # python 3
+                block = block.decode('ascii')
+            for i in range(0, FITS_BLOCK, FITS_CARD):
+                kw = block[i:i+8].rstrip()
+                if kw == 'END':
+                    return values
+                # Only the first instance of a keyword counts (like astropy)
+                if (kw in wanted and kw not in values and
+                        block[i+8:i+10] == '= '):
+                    values[kw] = parse_value(block[i+10:i+FITS_CARD])
+            block = f.read(FITS_BLOCK)
+    raise ValueError('No END card in {}'.format(fname))
 
+def get_metadata(fname):
+    """Return the values of the KW_MAP keywords from a file's primary header."""
+    try:
+        hd0 = read_header(fname, [kw for kw, c in KW_MAP])
+    except ValueError:
+        # Let astropy deal with anything unusual. getheader() stops
+        # reading after the primary header and closes the file
+        hd0 = fits.getheader(fname, 0)
+    return [hd0.get(kw, '') for kw, c in KW_MAP]
+
+def scan_files(fileList, nproc=1, threads=False):
+    """Harvest metadata from many files, using a pool of nproc workers.
+
+    No more workers are started than there are files to read.
+    """
+    nproc = min(nproc, len(fileList))
+    if nproc < 2:
+        return [get_metadata(fname) for fname in fileList]
+    pool = ThreadPool(nproc) if threads else Pool(nproc)
+    try:
+        # Results are returned in the same order as the input list
+        return pool.map(get_metadata, fileList,
+                        chunksize=len(fileList) // (4*nproc) + 1)
+    finally:
+        pool.close()
+        pool.join()
+
+def file_stats(fileList):
+    """Return the size and modification time of each file."""
+    stats = [os.stat(fname) for fname in fileList]
+    return [st.st_size for st in stats], [st.st_mtime for st in stats]
+
+def make_table(fileList, metadata, sizes, mtimes):
+    """Construct the observation log Table from the harvested metadata."""
     colnames = ['File'] + [kw[1] for kw in KW_MAP]
     table_data = dict([(c, []) for c in colnames])
-    fileList = sorted([f for f in os.listdir('.') if f.startswith('S')
-                      and f.endswith('.fits') and len(f)==19])
-    for fname in fileList:
-        hd0 = fits.open(fname)[0].header
-        for kw, c in KW_MAP:
-            table_data[c].append(hd0.get(kw, ''))
+    for fname, values in zip(fileList, metadata):
+        for (kw, c), value in zip(KW_MAP, values):
+            table_data[c].append(value)
         table_data['File'].append(fname.replace('./','').replace('.fits',''))
 
     # Tweak some data
@@ -55,11 +153,156 @@ def obsLog(args):
     table_data['Date'] = [f[1:9] for f in table_data['File']]
 
     t = Table(names=colnames, data=[table_data[c] for c in colnames])
+    # Record what was read, so an update can tell if the file has changed
+    t['Size'] = sizes
+    t['MTime'] = mtimes
     t['use_me'] = [True] * len(t)
+    return t
+
+def update_table(old, fileList, nproc=1, threads=False):
+    """Bring an existing log up to date, only reading new or changed files.
+
+    Rows are matched on filename, size, and modification time. Rows for
+    files no longer present are dropped, and use_me flags are preserved
+    for all files already in the log.
+    """
+    sizes, mtimes = file_stats(fileList)
+    names = [fname.replace('.fits', '') for fname in fileList]
+    stats = dict(zip(names, zip(sizes, mtimes)))
+    if 'MTime' in old.colnames:
+        unchanged = [stats.get(f) == (size, mtime) for f, size, mtime in
+                     zip(old['File'], old['Size'], old['MTime'])]
+    else:  # made before sizes and times were recorded
+        unchanged = [False] * len(old)
+    keep = old[unchanged]
+    kept = set(keep['File'])
+    todo = [i for i, f in enumerate(names) if f not in kept]
+
+    new = make_table([fileList[i] for i in todo],
+                     scan_files([fileList[i] for i in todo],
+                                nproc=nproc, threads=threads),
+                     [sizes[i] for i in todo], [mtimes[i] for i in todo])
+    t = stack_tables(keep, new)
+    t.sort('File')
 
-    if os.path.exists(args.dbFile):
-        os.remove(args.dbFile)
-    t.write(args.dbFile, format='fits')
+    use_me = dict(zip(old['File'], old['use_me']))
+    t['use_me'] = [use_me.get(f, True) for f in t['File']]
+    return t
+
+def stack_tables(keep, new):
+    """Stack the rows kept from an existing log and those of new files.
+
+    A column whose values have different types in the two (e.g., for a
+    keyword that is missing from some files) is made again from all its
+    values, as make_table() would if all the files were read at once.
+    """
+    if not len(keep):
+        return new
+    if not len(new):
+        return keep
+    for c in new.colnames:
+        kinds = set('S' if t[c].dtype.kind in 'SU' else t[c].dtype.kind
+                    for t in (keep, new))
+        if c not in keep.colnames or len(kinds) == 1 or kinds <= set('biuf'):
+            continue
+        values = [column_values(t[c]) for t in (keep, new)]
+        column = np.array(values[0] + values[1])
+        keep.replace_column(c, Column(column[:len(keep)], name=c))
+        new.replace_column(c, Column(column[len(keep):], name=c))
+    return vstack([keep, new])
+
+def column_values(column):
+    """Return the values in a column as they were read from the headers."""
+    values = column.tolist()
+    # Missing (masked) values were missing keywords
+    return [v.decode('ascii') if isinstance(v, bytes) else
+            '' if v is None else v for v in values]
+
+def is_sqlite(dbFile):
+    """Determine whether a log should be/is stored as an SQLite database."""
+    return os.path.splitext(dbFile)[1] in SQLITE_EXTENSIONS
+
+def write_sqlite(t, dbFile):
+    """Write the observation log as an indexed SQLite database."""
+    colnames = t.colnames
+    columns = ', '.join('"{}" {}'.format(c, SQL_TYPES.get(t[c].dtype.kind,
+                                                          'TEXT'))
+                        for c in colnames)
+    data = []
+    for c in colnames:
+        values = t[c].tolist()  # masked values become None (i.e., NULL)
+        if t[c].dtype.kind in 'SU':
+            values = [v if v is None else v.strip() for v in values]
+        data.append(values)
+    db = sqlite3.connect(dbFile)
+    with db:
+        db.execute('CREATE TABLE obslog ({})'.format(columns))
+        db.executemany('INSERT INTO obslog VALUES ({})'.format(
+            ','.join('?' * len(colnames))), zip(*data))
+        for c in SQLITE_INDEXES:
+            db.execute('CREATE INDEX "idx_{0}" ON obslog ("{0}")'.format(c))
+    db.close()
+
+def read_sqlite(dbFile):
+    """Read an observation log from an SQLite database into a Table."""
+    db = sqlite3.connect(dbFile)
+    try:
+        cursor = db.execute('SELECT * FROM obslog ORDER BY "File"')
+        rows = cursor.fetchall()
+        sql_types = dict((row[1], row[2]) for row in
+                         db.execute('PRAGMA table_info(obslog)'))
+    finally:
+        db.close()
+    names = [d[0] for d in cursor.description]
+    t = Table(masked=any(v is None for row in rows for v in row))
+    for i, c in enumerate(names):
+        dtype, fill = SQL_DTYPES.get(sql_types[c], (str, ''))
+        values = [row[i] for row in rows]
+        t[c] = MaskedColumn([fill if v is None else v for v in values],
+                            dtype=dtype, mask=[v is None for v in values])
+    t['use_me'] = t['use_me'].astype(bool)
+    return t
+
+def read_log(dbFile):
+    """Read an existing observation log in either format."""
+    return read_sqlite(dbFile) if is_sqlite(dbFile) else Table.read(dbFile)
+
+def write_log(t, dbFile):
+    """Write the log in a format determined by the file extension."""
+    # Replace the old log in one step, so it can be read at any time
+    tmpFile = dbFile+'.tmp'
+    if os.path.exists(tmpFile):
+        os.remove(tmpFile)
+    if is_sqlite(dbFile):
+        write_sqlite(t, tmpFile)
+    else:
+        t.write(tmpFile, format='fits')
+    os.rename(tmpFile, dbFile)
+
+def obsLog(args):
+    """Construct an observation log from header keywords in FITS files."""
+
+    descr_text = 'Construct an observation log from a directory of data files'
+    parser = argparse.ArgumentParser(description=descr_text)
+    parser.add_argument('dbFile', type=str, help='Name of file to create '
+                        '(.db/.sqlite/.sqlite3 for an SQLite database)')
+    parser.add_argument('-j', '--nproc', type=int, default=cpu_count(),
+                        help='Number of files to read in parallel')
+    parser.add_argument('--threads', action='store_true',
+                        help='Use threads rather than processes')
+    parser.add_argument('-u', '--update', action='store_true',
+                        help='Only add new or changed files to an existing log')
+    args = parser.parse_args()
+
+    fileList = sorted([f for f in os.listdir('.') if f.startswith('S')
+                      and f.endswith('.fits') and len(f)==19])
+    if args.update and os.path.exists(args.dbFile):
+        t = update_table(read_log(args.dbFile), fileList,
+                         nproc=args.nproc, threads=args.threads)
+    else:
+        metadata = scan_files(fileList, nproc=args.nproc, threads=args.threads)
+        t = make_table(fileList, metadata, *file_stats(fileList))
+    write_log(t, args.dbFile)
 
 if __name__ == '__main__':
     obsLog(sys.argv)
@@ -0,0 +1,700 @@
+# The ObsLog class used by the reduction scripts to select files from an
+# observation log (made by obslog.py), in either FITS or SQLite format
+import os
+import sqlite3
+from collections import OrderedDict
+from itertools import islice
+import numpy as np
+from astropy.table import Column, Table, Row, vstack
+
+# numpy types and values for NULLs when reading an SQLite log
+SQL_DTYPES = {'REAL': (float, np.nan), 'INTEGER': (int, 0), 'TEXT': (str, '')}
+
+# Names of the log looked for in the raw data directory, in order
+LOG_NAMES = ('obslog.fits', 'obslog.db', 'obslog.sqlite', 'obslog.sqlite3')
+
+def find_log(path):
+    # Return the name of the observation log in a directory: a FITS log
+    # if there is one, otherwise an SQLite one
+    for name in LOG_NAMES:
+        fname = os.path.join(path, name)
+        if os.path.exists(fname):
+            return fname
+    return os.path.join(path, LOG_NAMES[0])
+
+def is_sqlite(fname):
+    # Determine whether the file is an SQLite database (e.g., from obslog.py)
+    with open(fname, 'rb') as f:
+        return f.read(16) == b'SQLite format 3\x00'
+
+def compact_strings(values):
+    # Strip spaces from an array of strings and store it with the smallest
+    # possible itemsize, as bytes rather than unicode if it's all ASCII
+    values = np.char.strip(np.asarray(values))
+    if values.dtype.kind == 'U':
+        try:
+            values = np.char.encode(values, 'ascii')
+        except UnicodeEncodeError:
+            pass
+    width = np.char.str_len(values).max() if len(values) else 1
+    return values.astype('{}{}'.format(values.dtype.kind, max(width, 1)))
+
+def native_strings(values):
+    # Convert an array of bytes to (unicode) str in python 3
+    if values.dtype.kind == 'S' and str is not bytes:
+        return np.char.decode(values, 'ascii')
+    return values
+
+def frame_number(fname):
+    # Turn a filename (e.g., S20180101S0001) into an integer that increases
+    # by one from each frame to the next one taken on the same night
+    try:
+        return int(fname[1:9]) * 100000 + int(fname[10:])
+    except ValueError:
+        return -1
+
+def time_of_day(text):
+    # Convert a time string (HH:MM:SS.S) to seconds, or NaN if invalid
+    try:
+        h, m, sec = text.split(':')
+        return 3600 * int(h) + 60 * int(m) + float(sec)
+    except (AttributeError, ValueError):
+        return np.nan
+
+def day_numbers(dates):
+    # Convert a list of dates (YYYYMMDD) to integer numbers of days
+    return np.array(['{}-{}-{}'.format(d[:4], d[4:6], d[6:8]) for d in dates],
+                    dtype='datetime64[D]').astype(np.int64)
+
+def night_times(frames, days, tod):
+    # Return the time each frame was taken, in seconds, from its frame
+    # number, the day of the start of its night, and its UT time of day.
+    # The UT time may pass midnight during the night, so go through each
+    # night in frame order and add a day whenever the time goes back.
+    # Missing times are taken from the previous frame
+    order = np.lexsort((frames, days))
+    tod, nights = tod[order], days[order]
+    n = np.arange(len(tod))
+    tod = tod[np.maximum.accumulate(np.where(np.isnan(tod), 0, n))]
+    tod[np.isnan(tod)] = 0
+    new_night = np.ones((len(tod),), dtype=bool)
+    new_night[1:] = nights[1:] != nights[:-1]
+    wraps = np.cumsum(np.r_[False, tod[1:] < tod[:-1]] & ~new_night)
+    wraps -= wraps[np.maximum.accumulate(np.where(new_night, n, 0))]
+    times = np.empty((len(tod),), dtype=float)
+    times[order] = 86400. * (nights + wraps) + tod
+    return times
+
+def outwards(times, t0, max_dt=None):
+    # Generate the indices of an array of sorted times in order of their
+    # distance from t0, stopping at any more than max_dt from it
+    j = np.searchsorted(times, t0)
+    i = j - 1
+    while True:
+        if i >= 0 and (j >= len(times) or t0 - times[i] <= times[j] - t0):
+            k, i = i, i - 1
+        elif j < len(times):
+            k, j = j, j + 1
+        else:
+            return
+        if max_dt is not None and abs(times[k] - t0) > max_dt:
+            return
+        yield k
+
+class Observation(Row):
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __getitem__(self, item):
+        return self._table[item][self._index]
+
+class ObsLog(object):
+    # SQL equivalent of the rows selected by select() when loading a FITS
+    # log. Subclasses can change both to exclude other files from the log
+    sql_filter = '"use_me"'
+    # Maximum number of query results to remember
+    cache_size = 256
+    # Logs with fewer rows than this are searched by comparing every value,
+    # since building the indexes would take longer than the queries
+    scan_size = 100
+    # Columns with few distinct values, which are stored as integer codes
+    # (indexes into a sorted array of the distinct values) when the log is
+    # loaded, to save memory and make it quick to find matching rows
+    categorical = ('ObsType', 'ObsClass', 'Object', 'Filter', 'Disperser',
+                   'Mask', 'Read Mode', 'GCAL Shutter', 'Decker', 'Date',
+                   'Texp')
+
+    def __init__(self, fname):
+        self._db = None
+        self._table = None
+        self._values = {}
+        self.cache_hits = self.cache_misses = 0
+        if not isinstance(fname, Table) and is_sqlite(fname):
+            # Queries will be done in SQL and use the database indexes
+            self._db = sqlite3.connect(fname)
+            self._columns = [row[1:3] for row in
+                             self._db.execute('PRAGMA table_info(obslog)')]
+            self.invalidate()
+            return
+        # Load observation log and select the rows to use
+        obslog = fname if isinstance(fname, Table) else Table.read(fname)
+        obslog = obslog[self.select(obslog)]
+        # Strip spaces from string fields and store them compactly
+        for col in obslog.colnames:
+            if obslog[col].dtype.kind in 'SU':
+                obslog[col] = compact_strings(obslog[col])
+        self._load(obslog)
+
+    def select(self, obslog):
+        # Return a boolean array of the rows of a table to keep in the log
+        return np.asarray(obslog['use_me'], dtype=bool)
+
+    @property
+    def table(self):
+        # A copy of the whole log as a Table, so editing it does not change
+        # the log (use set_field() for that). A database is only read in
+        # its entirety if this is needed. Otherwise it is made by decoding
+        # the categorical columns
+        if not self._db:
+            return self._decode(np.arange(len(self._table)))
+        self._check_state()
+        if self._table is None:
+            self._table = self._sql_select([], [])
+        return self._table.copy()
+
+    @table.setter
+    def table(self, table):
+        # Replace the log with a copy of a table
+        self._load(Table(table, copy=True))
+
+    def _load(self, table):
+        # Use a table (which is not copied) as the log
+        self._db = None
+        self._table = Table(table, copy=False)
+        self._values = {}
+        for col in self.categorical:
+            if col in table.colnames:
+                self._encode(col, table[col])
+        self.invalidate()
+
+    def invalidate(self):
+        # Forget all query results and indexes. This happens automatically
+        # if the table is replaced, values are changed with set_field(), or
+        # another connection modifies an SQLite log
+        self._cache = OrderedDict()
+        self._indexes = {}
+        if self._db:
+            self._table = None  # reload from the database if needed
+            self._rows = {}
+            self._state = self._get_state()
+        else:
+            # Row number of each file, for fast lookups
+            self._rows = dict(zip(self._table['File'].tolist(),
+                                  range(len(self._table))))
+
+    def set_field(self, fnames, field, value):
+        # Set a field (e.g., use_me) to a value for a list of files. With
+        # an SQLite log, the change is written to the database
+        if self._db:
+            with self._db:
+                for i in range(0, len(fnames), 500):
+                    chunk = fnames[i:i+500]
+                    sql = 'UPDATE obslog SET "{}" = ? WHERE "File" IN ({})'
+                    self._db.execute(
+                        sql.format(field, ','.join(['?'] * len(chunk))),
+                        [value.item() if isinstance(value, np.generic) else
+                         value] + list(chunk))
+            self.invalidate()
+            return
+        missing = [f for f in fnames if f not in self._rows]
+        if missing:
+            raise ValueError('{} not found in Observation Log'.format(
+                ', '.join(missing)))
+        rows = [self._rows[f] for f in fnames]
+        if field in self._values:
+            # The value may not be one of the codes, so encode it afresh
+            values = native_strings(self._column(field)).tolist()
+            for row in rows:
+                values[row] = value
+            self._encode(field, values)
+        else:
+            self._table[field][rows] = value
+        if field in ('File', 'Date', 'Time'):
+            self.invalidate()  # the row, frame and time indexes use these
+            return
+        # Only the query results, the decoded log and this field's indexes
+        # are out of date
+        self._cache.clear()
+        self._indexes.pop('decoded', None)
+        for key in list(self._indexes):
+            if isinstance(key, tuple) and key[0] == field:
+                del self._indexes[key]
+
+    def cache_info(self):
+        # Return statistics on the use of the query cache
+        return {'hits': self.cache_hits, 'misses': self.cache_misses,
+                'size': len(self._cache), 'maxsize': self.cache_size}
+
+    def __getitem__(self, fname):
+        # Return table row for a specific filename
+        if self._db:
+            table, rows = self._sql_files([fname])
+        else:
+            table, rows = self._table, self._rows
+        try:
+            row = rows[fname]
+        except KeyError:
+            raise ValueError('{} not found in Observation Log'.format(fname))
+        if self._db:
+            return Observation(table, row)
+        return Observation(self._decode([row]), 0)
+
+    def lookup(self, fnames, params=None):
+        # Return the table rows (or only the requested field(s)) for a
+        # list of filenames, in the same order
+        if self._db:
+            table, rows = self._sql_files(fnames)
+        else:
+            table, rows = self._table, self._rows
+        missing = [f for f in fnames if f not in rows]
+        if missing:
+            raise ValueError('{} not found in Observation Log'.format(
+                ', '.join(missing)))
+        rows = [rows[f] for f in fnames]
+        result = self._decode(rows) if not self._db else table[rows]
+        return result if params is None else result[params]
+
+    def query(self, qd):
+        # Return obslog rows that match all requirements, as a new table
+        if self._db:
+            return self._cached(self._sql_query, qd).copy()
+        return self._decoded()[self._cached(self._query_rows, qd)]
+
+    def file_query(self, qd):
+        # Return a list of filenames matching the query
+        if self._db:
+            return self._cached(self._sql_query, qd)['File'].tolist()
+        return self._table['File'][self._cached(self._query_rows,
+                                                qd)].tolist()
+
+    def _query_rows(self, qd):
+        # Return the numbers of the rows that match all requirements.
+        # Each constraint gives an array of matching rows; these are
+        # intersected, starting with the smallest
+        matches = []
+        # Deal with date ranges but don't alter the query dictionary
+        if 'Date' in qd:
+            dates = str(qd['Date']).split(':')
+            if len(dates) == 2:
+                matches.append(self._range('Date', *dates))
+            else:
+                matches.append(self._match('Date', dates[0]))
+        # Specific observation range
+        if 'first' in qd or 'last' in qd:
+            matches.append(self._range('File', qd.get('first'),
+                                       qd.get('last')))
+        # Other constraints
+        matches.extend([self._match(k, v) for k, v in qd.items()
+                        if (k in self._table.colnames and k != 'Date')])
+        if matches:
+            matches.sort(key=len)
+            rows = matches[0]
+            for match in matches[1:]:
+                rows = np.intersect1d(rows, match, assume_unique=True)
+            rows = np.sort(rows)
+        else:
+            rows = np.arange(len(self._table))
+        # Files may have been deselected since the log was loaded
+        if 'use_me' not in qd:
+            rows = rows[np.asarray(self._table['use_me'])[rows]]
+        return rows
+
+    def groupby(self, params, **qd):
+        # Return a list of (configuration, filenames) pairs, one for each
+        # unique combination of values of the params among the rows that
+        # match the query, sorted by configuration, with filenames sorted
+        rows = self.query(qd)
+        if len(rows) == 0:
+            return []
+        # Encode each field as integers, sort the rows by these codes (and
+        # then filename), and split wherever any of the codes changes
+        values, codes = [], []
+        for param in params:
+            param_values, param_codes = np.unique(np.asarray(rows[param]),
+                                                  return_inverse=True)
+            values.append(native_strings(param_values).tolist())
+            codes.append(param_codes.ravel())
+        order = np.lexsort([np.asarray(rows['File'])] + codes[::-1])
+        codes = np.array([c[order] for c in codes])
+        starts = np.flatnonzero(np.any(np.diff(codes, axis=1), axis=0)) + 1
+        files = native_strings(np.asarray(rows['File'])[order])
+        return [(tuple(v[c] for v, c in zip(values, codes[:, i])),
+                 files[i:j].tolist())
+                for i, j in zip([0]+starts.tolist(),
+                                starts.tolist()+[len(order)])]
+
+    def nearest(self, qd, to, n=1, max_dt=None):
+        # Return up to n files matching the query that were taken closest
+        # in time to the file "to" (but no more than max_dt seconds from
+        # it, if given), nearest first. "to" itself is never returned
+        if self._db:
+            return self._sql_nearest(qd, to, n, max_dt)
+        match_rows, match_times = self._cached(self._time_order, qd)
+        row = self._frame_rows([to])[0]
+        # Work outwards from where "to" would go in the time-sorted matches
+        found = list(islice((match_rows[k] for k in
+                             outwards(match_times, self._times()[row], max_dt)
+                             if match_rows[k] != row), n))
+        return self._table['File'][found].tolist()
+
+    def adjacent(self, qd, to, offsets=(-1, 1)):
+        # Return the files matching the query that were taken on the same
+        # night as the file "to", with sequence numbers differing from it
+        # by each of the offsets in turn (if such files exist)
+        if self._db:
+            return self._sql_adjacent(qd, to, offsets)
+        match_rows, match_frames = self._cached(self._frame_order, qd)
+        frames = self._frames()[0][self._frame_rows([to])[0]] + np.asarray(
+            offsets, dtype=np.int64)
+        if len(match_frames) == 0:
+            return []
+        i = np.minimum(np.searchsorted(match_frames, frames),
+                       len(match_frames) - 1)
+        found = match_rows[i[match_frames[i] == frames]]
+        return self._table['File'][found].tolist()
+
+    def contiguous(self, fnames):
+        # Split a list of files into lists of consecutive frames
+        if len(fnames) == 0:
+            return []
+        if self._db:
+            # Frame numbers come from the filenames, so only check that
+            # the files are in the log
+            self.lookup(fnames, 'File')
+            frames = np.array([frame_number(f) for f in fnames])
+        else:
+            frames = self._frames()[0][self._frame_rows(fnames)]
+        starts = (np.flatnonzero(np.diff(frames) != 1) + 1).tolist()
+        return [list(fnames[i:j]) for i, j in zip([0]+starts,
+                                                   starts+[len(fnames)])]
+
+    def _time_order(self, qd):
+        # Return the rows matching the query sorted by the time they were
+        # taken (and then by frame number), and those times
+        times, frames = self._times(), self._frames()[0]
+        match_rows = self._query_rows(qd)
+        match_rows = match_rows[np.lexsort((frames[match_rows],
+                                            times[match_rows]))]
+        return match_rows, times[match_rows]
+
+    def _frame_order(self, qd):
+        # Return the rows matching the query sorted by frame number, and
+        # those frame numbers
+        frames = self._frames()[0]
+        match_rows = self._query_rows(qd)
+        match_rows = match_rows[np.argsort(frames[match_rows],
+                                           kind='mergesort')]
+        return match_rows, frames[match_rows]
+
+    def _cached(self, func, qd):
+        # Return func(qd), using a previous result if the same query has
+        # been made (and the log hasn't changed since)
+        self._check_state()
+        key = self._cache_key(qd)
+        if key is not None:
+            key = (func.__name__,) + key
+        try:
+            result = self._cache.pop(key)
+        except KeyError:  # new (or unhashable) query
+            self.cache_misses += 1
+            result = func(qd)
+            if key is None or self.cache_size < 1:
+                return result
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)  # least recently used
+        else:
+            self.cache_hits += 1
+        self._cache[key] = result  # now the most recently used
+        return result
+
+    def _cache_key(self, qd):
+        # Turn a query into something hashable, ignoring irrelevant items
+        colnames = (dict(self._columns) if self._db else
+                    self._table.colnames)
+        key = tuple(sorted([(k, v.item() if isinstance(v, np.generic) else v)
+                            for k, v in qd.items()
+                            if k in colnames or k in ('first', 'last')],
+                           key=lambda item: item[0]))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _get_state(self):
+        # Return something that changes if another connection modifies
+        # the database
+        return self._db.execute('PRAGMA data_version').fetchone()
+
+    def _check_state(self):
+        # Discard cached results and indexes if the database has been
+        # modified. Otherwise the log can only be changed by its methods
+        if self._db and self._get_state() != self._state:
+            self.invalidate()
+
+    def _encode(self, col, values):
+        # Store a categorical column as integer codes, and its distinct
+        # values in sorted order
+        values = np.asarray(values)
+        if values.dtype.kind in 'SU':
+            values = compact_strings(values)
+        values, codes = np.unique(values, return_inverse=True)
+        self._values[col] = values
+        self._table.replace_column(col, Column(codes.ravel().astype(
+            np.min_scalar_type(len(values))), name=col))
+
+    def _decode(self, rows):
+        # Return a copy of some rows of the stored table, with the values
+        # of the categorical columns in place of their codes
+        table = self._table
+        return Table([self._values[col][table[col].data[rows]]
+                      if col in self._values else table[col].data[rows]
+                      for col in table.colnames],
+                     names=table.colnames, copy=False)
+
+    def _decoded(self):
+        # Return the stored table with the categorical columns decoded,
+        # from which the rows matching each query are taken
+        key = 'decoded'
+        try:
+            return self._indexes[key]
+        except KeyError:
+            self._indexes[key] = self._decode(slice(None))
+            return self._indexes[key]
+
+    def _column(self, col):
+        # Return the values in a column of the stored table
+        if col in self._values:
+            return self._values[col][np.asarray(self._table[col])]
+        return np.asarray(self._table[col])
+
+    def _codes(self, col):
+        # Return a list of the distinct values in a column, and an array
+        # of integer codes giving which of these is in each row
+        key = (col, 'codes')
+        try:
+            return self._indexes[key]
+        except KeyError:
+            if col in self._values:
+                values = self._values[col]
+                codes = np.asarray(self._table[col])
+            else:
+                values, codes = np.unique(self._column(col),
+                                          return_inverse=True)
+                codes = codes.ravel().astype(np.min_scalar_type(len(values)))
+            self._indexes[key] = (native_strings(values).tolist(), codes)
+            return self._indexes[key]
+
+    def _index(self, col):
+        # Return a dict mapping each value in a column to an array of the
+        # rows having that value, making it the first time it's needed
+        key = (col, 'index')
+        try:
+            return self._indexes[key]
+        except KeyError:
+            values, codes = self._codes(col)
+            rows = np.argsort(codes, kind='mergesort')
+            splits = np.cumsum(np.bincount(codes, minlength=len(values)))
+            self._indexes[key] = dict(zip(values,
+                                          np.split(rows, splits[:-1])))
+            return self._indexes[key]
+
+    def _sorted(self, col):
+        # Return a column's values (or, for a categorical column, its
+        # codes) in sorted order, and the rows they are in
+        key = (col, 'sorted')
+        try:
+            return self._indexes[key]
+        except KeyError:
+            values = (self._codes(col)[1] if col in self._values else
+                      native_strings(self._column(col)))
+            rows = np.argsort(values, kind='mergesort')
+            self._indexes[key] = (values[rows], rows)
+            return self._indexes[key]
+
+    def _frames(self):
+        # Return the frame number of each file (see frame_number()), and
+        # a dict of the row of each file
+        key = 'frames'
+        try:
+            return self._indexes[key]
+        except KeyError:
+            files = native_strings(self._column('File')).tolist()
+            frames = np.array([frame_number(f) for f in files],
+                              dtype=np.int64)
+            self._indexes[key] = (frames, self._rows)
+            return self._indexes[key]
+
+    def _frame_rows(self, fnames):
+        # Return the rows of a list of files, for the time/frame indexes
+        rows = self._frames()[1]
+        missing = [f for f in fnames if f not in rows]
+        if missing:
+            raise ValueError('{} not found in Observation Log'.format(
+                ', '.join(missing)))
+        return [rows[f] for f in fnames]
+
+    def _times(self):
+        # Return the time each file was taken, in seconds
+        key = 'times'
+        try:
+            return self._indexes[key]
+        except KeyError:
+            # Only convert each distinct date once
+            dates, codes = self._codes('Date')
+            times = night_times(self._frames()[0], day_numbers(dates)[codes],
+                                self._times_of_day(self._table))
+            self._indexes[key] = times
+            return times
+
+    def _times_of_day(self, table):
+        # Return the UT time of day of each row of a table, in seconds
+        if 'Time' in table.colnames:
+            return np.array([time_of_day(t) for t in
+                             native_strings(np.asarray(table['Time']))],
+                            dtype=float)
+        return np.full((len(table),), np.nan)
+
+    def _match(self, col, value):
+        # Return the rows where the column has the specified value
+        if len(self._table) < self.scan_size:
+            return np.flatnonzero(native_strings(self._column(col)) == value)
+        try:
+            return self._index(col).get(value, np.array([], dtype=int))
+        except TypeError:  # unhashable value
+            return np.flatnonzero(self._column(col) == value)
+
+    def _range(self, col, lower=None, upper=None):
+        # Return the rows where the column lies between two values (inclusive)
+        if len(self._table) < self.scan_size:
+            values = native_strings(self._column(col))
+            good = np.ones(len(values), dtype=bool)
+            if lower is not None:
+                good &= values >= lower
+            if upper is not None:
+                good &= values <= upper
+            return np.flatnonzero(good)
+        values, rows = self._sorted(col)
+        if col in self._values:
+            # The codes are in the same order as the values they stand for
+            keys = self._codes(col)[0]
+            i = (0 if lower is None else np.searchsorted(
+                values, np.searchsorted(keys, lower, 'left'), 'left'))
+            j = (len(values) if upper is None else np.searchsorted(
+                values, np.searchsorted(keys, upper, 'right'), 'left'))
+            return rows[i:j]
+        i = 0 if lower is None else np.searchsorted(values, lower, 'left')
+        j = (len(values) if upper is None else
+             np.searchsorted(values, upper, 'right'))
+        return rows[i:j]
+
+    def _sql_query(self, qd):
+        # Return the rows that match a query dictionary
+        return self._sql_select(*self._sql_where(qd))
+
+    def _sql_where(self, qd):
+        # Turn a query dictionary into SQL conditions and their values
+        where, values = [], []
+        if 'Date' in qd:
+            dates = str(qd['Date']).split(':')
+            if len(dates) == 2:
+                where.append('"Date" BETWEEN ? AND ?')
+            else:
+                where.append('"Date" = ?')
+            values.extend(dates)
+        if 'first' in qd:
+            where.append('"File" >= ?')
+            values.append(qd['first'])
+        if 'last' in qd:
+            where.append('"File" <= ?')
+            values.append(qd['last'])
+        for k, v in qd.items():
+            if k in dict(self._columns) and k != 'Date':
+                where.append('"{}" = ?'.format(k))
+                values.append(v)
+        return where, values
+
+    def _sql_nearest(self, qd, to, n, max_dt):
+        # nearest() for a database. The times of the matching files (and
+        # "to") are found from all the files taken on the same nights,
+        # which are selected using the Date index
+        matches = self._cached(self._sql_query, qd)
+        date = str(self[to]['Date'])
+        nights = set(matches['Date'].tolist())
+        if max_dt is not None:
+            # Each night's times lie within two days of its start, so
+            # nights further away can't have any files close enough
+            day0 = day_numbers([date])[0]
+            days = dict(zip(nights, day_numbers(nights)))
+            nights = [d for d in nights if abs(days[d] - day0) <=
+                      max_dt // 86400 + 2]
+        dates = sorted(set(nights) | set([date]))
+        tables = []
+        for i in range(0, len(dates), 500):
+            chunk = dates[i:i+500]
+            tables.append(self._sql_select(['"Date" IN ({})'.format(
+                ','.join(['?'] * len(chunk)))], chunk))
+        table = vstack(tables) if len(tables) > 1 else tables[0]
+        files = table['File'].tolist()
+        times = dict(zip(files, night_times(
+            np.array([frame_number(f) for f in files], dtype=np.int64),
+            day_numbers(table['Date'].tolist()), self._times_of_day(table))))
+        # Sort the matches by time (and then frame number), as _time_order()
+        match_files = [f for f in matches['File'].tolist() if f in times]
+        match_files.sort(key=lambda f: (times[f], frame_number(f)))
+        match_times = np.array([times[f] for f in match_files])
+        return list(islice((match_files[k] for k in
+                            outwards(match_times, times[to], max_dt)
+                            if match_files[k] != to), n))
+
+    def _sql_adjacent(self, qd, to, offsets):
+        # adjacent() for a database, looking only at the matching files
+        # from the same night, which are selected using the File index
+        self.lookup([to], 'File')
+        where, values = self._sql_where(qd)
+        table = self._sql_select(where + ['"File" BETWEEN ? AND ?'],
+                                 values + [to[:10], to[:10] + '~'])
+        frames = dict((frame_number(f), f) for f in table['File'].tolist())
+        return [frames[frame_number(to) + offset] for offset in offsets
+                if frame_number(to) + offset in frames]
+
+    def _sql_files(self, fnames):
+        # Return the rows for the given files, and a dict of their row numbers
+        fnames = sorted(set(fnames))
+        tables = []
+        # Avoid exceeding SQLite's limit on the number of parameters
+        for i in range(0, len(fnames), 500):
+            chunk = fnames[i:i+500]
+            tables.append(self._sql_select(['"File" IN ({})'.format(
+                ','.join(['?'] * len(chunk)))], chunk))
+        if not tables:
+            tables.append(self._sql_select(['0'], []))
+        table = vstack(tables) if len(tables) > 1 else tables[0]
+        return table, dict(zip(table['File'].tolist(), range(len(table))))
+
+    def _sql_select(self, where, values):
+        # Return the rows satisfying all the SQL conditions as a Table
+        sql = 'SELECT * FROM obslog WHERE {} ORDER BY "File"'.format(
+            ' AND '.join(['({})'.format(w) for w in [self.sql_filter]+where]))
+        # sqlite3 can't handle numpy scalars
+        values = [v.item() if isinstance(v, np.generic) else v
+                  for v in values]
+        rows = self._db.execute(sql, values).fetchall()
+        table = Table()
+        for i, (col, sql_type) in enumerate(self._columns):
+            dtype, null = SQL_DTYPES.get(sql_type, (str, ''))
+            table[col] = np.array([null if row[i] is None else row[i]
+                                   for row in rows], dtype=dtype)
+        table['use_me'] = table['use_me'].astype(bool)
+        return table
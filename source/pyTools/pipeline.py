@@ -0,0 +1,1130 @@
+#!/usr/bin/env python
+# Tools for running the steps of the tutorial reductions concurrently.
+# This file must be in the same directory as the reduce_*.py scripts.
+import os, sys
+import copy
+import errno
+import hashlib
+import json
+import resource
+import shutil
+import stat
+import time
+import traceback
+import types
+import yaml
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing import Pipe, Process
+try:
+    from multiprocessing.connection import wait
+    string_types = str
+except ImportError:  # python 2
+    string_types = basestring
+
+    def wait(conns, timeout):
+        # Return the connections that have something to read (or have been
+        # closed at the other end), waiting for up to timeout seconds
+        end = time.time() + timeout
+        while True:
+            ready = [conn for conn in conns if conn.poll()]
+            if ready or time.time() > end:
+                return ready
+            time.sleep(0.01)
+
+# Subdirectory of the working directory for the workers' scratch space
+SCRATCH_DIR = 'scratch'
+# Extensions that are not part of the name of a calibration
+FILE_EXTENSIONS = ('.fits', '.pl')
+# Record of the steps that have been run, so they aren't run again
+MEMO_FILE = 'steps.json'
+# Timings of the steps and IRAF tasks, from the last run
+TRACE_FILE = 'trace.json'
+# Directory for prepared frames kept between steps, and its size in MB
+# (the least recently used frames are deleted to keep within it)
+FRAME_CACHE_DIR = 'frames'
+FRAME_CACHE_SIZE = 10000
+# Workers are replaced after running this many jobs, or once they have
+# used this much memory (in MB), in case the IRAF tasks leak
+WORKER_MAX_TASKS = 200
+WORKER_MAX_MEMORY = 2048
+
+def file_key(name):
+    # Turn a filename used in a reduction dictionary into the name of the
+    # file it refers to (no directory, image section, or extension)
+    name = os.path.basename(name.split('[')[0])
+    root, ext = os.path.splitext(name)
+    return root if ext in FILE_EXTENSIONS else name
+
+def file_names(values):
+    # Return all the strings in a list of values and lists of values
+    names = []
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            names.extend(file_names(value))
+        elif isinstance(value, string_types):
+            names.append(value)
+    return names
+
+def find_file(name, paths=()):
+    # Return the path to the file that a name refers to, looking in the
+    # working directory and then the other directories, or None
+    for path in ('',)+tuple(paths):
+        for fname in (name,)+tuple(name+ext for ext in FILE_EXTENSIONS):
+            fname = os.path.join(path, fname)
+            if os.path.isfile(fname):
+                return fname
+
+def file_signature(fname):
+    # Return the size and modification time of a file, or None
+    if fname is None:
+        return None
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+def remove_files(names):
+    # Delete the files that names (without extensions) refer to in the
+    # working directory
+    for name in names:
+        for fname in (name,)+tuple(name+ext for ext in FILE_EXTENSIONS):
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+def source_files(module):
+    # Return the source files of a module and of the modules in the same
+    # directory that it uses, directly or through each other, or none if
+    # the module doesn't come from a file (e.g., code typed interactively)
+    path = getattr(module, '__file__', None)
+    if path is None:
+        return []
+    directory = os.path.dirname(os.path.abspath(path))
+    found = OrderedDict()
+    todo = [module]
+    while todo:
+        module = todo.pop()
+        path = getattr(module, '__file__', None)
+        if path is None:
+            continue
+        path = os.path.abspath(os.path.splitext(path)[0]+'.py')
+        if (path in found or os.path.dirname(path) != directory or
+                not os.path.isfile(path)):
+            continue
+        found[path] = module
+        for value in list(vars(module).values()):
+            if not isinstance(value, types.ModuleType):
+                value = sys.modules.get(getattr(value, '__module__', None))
+            if value is not None:
+                todo.append(value)
+    return sorted(found)
+
+def canonical(value):
+    # Return a string representation of a value, for hashing or comparing
+    return json.dumps(value, sort_keys=True, default=str)
+
+#---------------------------------------------------------------------
+# Frames (e.g., prepared raw frames) that can be reused by later steps
+# are kept in the frame cache, and hard-linked into the directory where
+# they are needed
+
+def cache_key(values, files=(), paths=()):
+    # Hash some values and the sizes and modification times of some files
+    sigs = [file_signature(find_file(name, paths)) for name in files if name]
+    return hashlib.sha1(canonical([values, sigs]).encode('utf-8')
+                        ).hexdigest()[:16]
+
+def frame_cache():
+    # Return the path to the frame cache, in the main working directory
+    return os.path.join(_worker.get('workdir', os.getcwd()), FRAME_CACHE_DIR)
+
+def cached_frames(names, keys, func):
+    # Make the images in the list names by calling func(indices), where
+    # indices are the positions in names of the images to make, except for
+    # those with copies made with the same keys in the frame cache, which
+    # are used instead. The images are then kept in the cache. The images
+    # are all made by one call where possible; if that fails, they are made
+    # one at a time, so the ones that can't be made can be reported. The
+    # images are copied to and from the cache, rather than linked, so that
+    # editing an image in place (e.g., with hedit) doesn't change the cache
+    cache = frame_cache()
+    fnames = [name if name.endswith('.fits') else name+'.fits'
+              for name in names]
+    entries = [os.path.join(cache, '{}_{}'.format(key, fname))
+               for key, fname in zip(keys, fnames)]
+    for fname in fnames:
+        if os.path.lexists(fname):
+            os.remove(fname)
+    failed = OrderedDict()
+    todo = list(range(len(names)))
+    while todo:
+        # Make the images that aren't in the cache, unless another process
+        # is already making them, in which case wait for it
+        make, wait = [], []
+        for i in todo:
+            if not copy_entry(entries[i], fnames[i]):  # not in the cache
+                if not lock_entry(entries[i]):
+                    wait.append(i)
+                elif copy_entry(entries[i], fnames[i]):  # made meanwhile
+                    os.remove(entries[i]+'.lock')
+                else:
+                    make.append(i)
+        try:
+            errors = call_batch(func, make, fnames)
+            for i in make:
+                if i in errors:
+                    failed[names[i]] = errors[i]
+                else:
+                    store_entry(fnames[i], entries[i])
+        finally:
+            for i in make:
+                os.remove(entries[i]+'.lock')
+        if wait:
+            time.sleep(0.5)
+        todo = wait
+    for entry in entries:
+        if os.path.exists(entry):
+            with open(entry+'.used', 'a'):
+                os.utime(entry+'.used', None)
+    if os.path.isdir(cache):
+        trim_frame_cache(cache, FRAME_CACHE_SIZE)
+    if failed:
+        sys.stderr.write(''.join(failed.values()))
+        raise RuntimeError('Failed to make {}'.format(', '.join(failed)))
+
+def call_batch(func, indices, fnames):
+    # Call func(indices) to make the files fnames[i] for i in indices, and
+    # if that fails, call it for each index in turn. Return the errors for
+    # the files that weren't made, by index
+    if not indices:
+        return {}
+    try:
+        func(indices)
+    except Exception:
+        if len(indices) == 1:
+            return {indices[0]: traceback.format_exc()}
+        errors = {}
+        for i in indices:
+            if os.path.lexists(fnames[i]):
+                os.remove(fnames[i])
+            errors.update(call_batch(func, [i], fnames))
+        return errors
+    return dict((i, '{} was not made\n'.format(fnames[i]))
+                for i in indices if not os.path.exists(fnames[i]))
+
+def copy_entry(entry, fname):
+    # Copy a frame out of the cache, returning whether it was there. The
+    # copy keeps the modification time of the entry (see same_copy())
+    try:
+        shutil.copy2(entry, fname)
+    except (IOError, OSError):
+        if os.path.lexists(fname):
+            os.remove(fname)
+        return False
+    return True
+
+def store_entry(fname, entry):
+    # Copy a frame into the cache. Until the copy is complete it has a
+    # temporary name, so other processes never use part of it
+    shutil.copy2(fname, entry+'.tmp')
+    os.rename(entry+'.tmp', entry)
+
+def same_copy(fname, entry):
+    # Determine whether a file is an unedited copy of a cache entry, from
+    # its size and modification time (which copy2() may round slightly)
+    sig1, sig2 = file_signature(fname), file_signature(entry)
+    return (sig1 is not None and sig2 is not None and sig1[0] == sig2[0]
+            and abs(sig1[1] - sig2[1]) < 0.01)
+
+def lock_entry(entry):
+    # Try to take the lock for making a frame cache entry, returning
+    # whether it was taken. A lock left by a process that has died is
+    # removed, so that the next try can succeed
+    lock = entry+'.lock'
+    try:
+        os.makedirs(os.path.dirname(lock))
+    except OSError:  # it already exists
+        pass
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        try:
+            with open(lock, 'r') as f:
+                pid = int(f.read())
+            os.kill(pid, 0)
+        except (IOError, ValueError):  # gone, or the pid isn't written yet
+            pass
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                os.remove(lock)
+        return False
+    os.write(fd, str(os.getpid()).encode('ascii'))
+    os.close(fd)
+    return True
+
+def trim_frame_cache(cache, size):
+    # Delete the least recently used frames until the cache is no larger
+    # than size MB
+    entries = []
+    total = 0
+    for name in os.listdir(cache):
+        if not name.endswith('.fits'):
+            continue
+        entry = os.path.join(cache, name)
+        try:
+            st = os.stat(entry)
+        except OSError:
+            continue
+        total += st.st_size
+        # When the frame was last used, or else when it was made
+        used = (file_signature(entry+'.used') or [0, st.st_mtime])[1]
+        entries.append((used, entry, st.st_size))
+    entries.sort()
+    for used, entry, nbytes in entries:
+        if total <= size * 1048576:
+            break
+        for fname in (entry, entry+'.used'):
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+        total -= nbytes
+
+def release_frames():
+    # Delete the copies of cached frames from the working directory,
+    # unless they have been edited (the frames stay in the cache)
+    cache = frame_cache()
+    if not os.path.isdir(cache):
+        return
+    for name in os.listdir(cache):
+        if not name.endswith('.fits'):
+            continue
+        fname = name.split('_', 1)[1]
+        if same_copy(fname, os.path.join(cache, name)):
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+
+#---------------------------------------------------------------------
+# The entries of the configuration files used by the step being run
+_step_config = {}
+
+# Parsed configuration files, with the signatures of the files
+_config_cache = {}
+
+def parsed_config(fname):
+    # Return the contents of a YAML configuration file, which is only
+    # parsed again if the file has changed. This is shared between all
+    # callers, so must not be modified
+    sig = file_signature(fname)
+    cached = _config_cache.get(fname)
+    if cached is None or cached[0] != sig:
+        with open(fname, 'r') as yf:
+            cached = _config_cache[fname] = (sig, yaml.safe_load(yf))
+    return cached[1]
+
+def load_config(fname):
+    # Read a YAML configuration file, returning a copy that can be changed
+    return copy.deepcopy(parsed_config(fname))
+
+def read_config(fname, *keys):
+    # Read entries from a YAML configuration file, returning a list of
+    # copies that can be changed, and note them as used by the step being
+    # run, so that it is run again if they change
+    config = parsed_config(fname)
+    used = _step_config.setdefault(fname, {})
+    for key in keys:
+        used[key] = canonical(config[key])
+    return [copy.deepcopy(config[key]) for key in keys]
+
+def load_memo():
+    # Read the record of the steps that have been run
+    try:
+        with open(MEMO_FILE, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def save_memo(memo):
+    # Write the record of the steps that have been run
+    with open(MEMO_FILE+'.tmp', 'w') as f:
+        json.dump(memo, f, indent=1, sort_keys=True)
+    os.rename(MEMO_FILE+'.tmp', MEMO_FILE)
+
+#---------------------------------------------------------------------
+# Each step, and each IRAF task run by the reduction (but not the tasks
+# that those tasks run), is timed and recorded as an event in the trace.
+# Worker processes send their events back with the results of their jobs.
+# The events recorded or received by this process, and the blocks of code
+# being timed (the first for everything outside them), with the bytes of
+# FITS files read and written by the events within them
+_trace = {'on': True, 'events': [], 'open': [{'read': 0, 'written': 0}],
+          'task': False, 'iraf': False}
+
+# Kinds of events for which the CPU time and memory of the processes
+# started by this one (e.g., by PyRAF) are included. Finding these means
+# reading /proc, so is only done for the steps, not for each IRAF task
+TREE_EVENTS = ('step', 'init')
+
+@contextmanager
+def traced(name, cat='function', **args):
+    # Record the wall-clock time and CPU time taken by a block of code, the
+    # most memory used by the end of it, and the FITS bytes read and
+    # written within it, as an event in the trace (with any args given)
+    block = {'read': 0, 'written': 0}
+    if not _trace['on']:
+        yield block
+        return
+    tree = cat in TREE_EVENTS
+    _trace['open'].append(block)
+    start, cpu = time.time(), _cpu_time(tree)
+    try:
+        yield block
+    finally:
+        end = time.time()
+        _trace['open'].pop()
+        args.update(block, cpu=round(_cpu_time(tree)-cpu, 3),
+                    maxrss=round(_peak_memory(tree), 1))
+        _add_trace([{'name': name, 'cat': cat, 'ph': 'X',
+                     'ts': int(start*1e6), 'dur': int((end-start)*1e6),
+                     'pid': os.getpid(), 'tid': os.getpid(),
+                     'args': args}], block['read'], block['written'])
+
+def _add_trace(events, read=0, written=0):
+    # Add events to the trace, counting the bytes read and written by them
+    # towards the innermost block of code being timed
+    _trace['events'].extend(events)
+    block = _trace['open'][-1]
+    block['read'] += read
+    block['written'] += written
+
+def _take_trace():
+    # Return (and forget) the events recorded by this process, with the
+    # bytes read and written by them, to be sent to the parent process
+    block = _trace['open'][0]
+    trace = (_trace['events'], block['read'], block['written'])
+    _trace['events'] = []
+    block.update(read=0, written=0)
+    return trace
+
+def _trace_iraf():
+    # Record each IRAF task run by the reduction in the trace, once PyRAF
+    # has been loaded
+    iraftask = sys.modules.get('pyraf.iraftask')
+    if not _trace['on'] or _trace['iraf'] or iraftask is None:
+        return
+    run = iraftask.IrafTask.run
+
+    def traced_run(task, *args, **kw):
+        if _trace['task']:  # run by another task
+            return run(task, *args, **kw)
+        values = file_names(list(args)+list(kw.values()))
+        paths = [value for value in values if os.path.isdir(value)]
+        inputs = set(find_file(name.split('[')[0].strip(), paths)
+                     for value in values for name in value.split(','))
+        inputs.discard(None)
+        outputs = _task_outputs(task, values, kw)
+        before = _file_signatures(outputs)
+        with traced(task.getName(), 'task') as block:
+            block['read'] = sum(os.path.getsize(fname) for fname in inputs)
+            _trace['task'] = True
+            try:
+                return run(task, *args, **kw)
+            finally:
+                _trace['task'] = False
+                block['written'] = sum(sig[0] for fname, sig
+                                       in _file_signatures(outputs).items()
+                                       if before.get(fname) != sig)
+    iraftask.IrafTask.run = traced_run
+    _trace['iraf'] = True
+
+def _task_outputs(task, values, kw):
+    # Return the names of the files an IRAF task might write: those named
+    # by its arguments or parameters (which include its output images),
+    # and those names with each of its prefix parameters (e.g., outprefix)
+    # added, for tasks that name their outputs after their inputs
+    pars = {}
+    try:
+        pars.update((par.name, par.value) for par in task.getParList())
+    except AttributeError:
+        pass
+    pars.update(kw)
+    names = set(name.split('[')[0].strip() for value in
+                values + file_names(list(pars.values()))
+                for name in value.split(','))
+    names.discard('')
+    prefixes = [value for key, value in pars.items() if 'prefix' in key
+                and isinstance(value, string_types) and value.strip()]
+    return names | set(prefix.strip()+os.path.basename(name)
+                       for prefix in prefixes for name in names)
+
+def _file_signatures(names):
+    # Return the size and modification time of each of the named files
+    # that exists in the working directory
+    sigs = {}
+    for name in names:
+        fname = find_file(name)
+        if fname is not None:
+            sigs[fname] = file_signature(fname)
+    return sigs
+
+def _processes(pid='self'):
+    # Return the IDs of the descendants of a process (on Linux), e.g., the
+    # IRAF processes started by PyRAF
+    pids = []
+    try:
+        for tid in os.listdir('/proc/{}/task'.format(pid)):
+            with open('/proc/{}/task/{}/children'.format(pid, tid)) as f:
+                for child in f.read().split():
+                    pids.append(child)
+                    pids.extend(_processes(child))
+    except (IOError, OSError):
+        pass
+    return pids
+
+def _cpu_time(tree=True):
+    # Return the CPU time in seconds used by this process and all its
+    # descendants, including (if tree is true) any that are still running
+    t = os.times()
+    total = t[0] + t[1] + t[2] + t[3]
+    if not tree:
+        return total
+    tick = float(os.sysconf('SC_CLK_TCK')) if hasattr(os, 'sysconf') else 1.
+    for pid in _processes():
+        try:
+            with open('/proc/{}/stat'.format(pid)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError, IndexError):
+            continue
+        total += sum(int(field) for field in fields[11:15]) / tick
+    return total
+
+def _peak_memory(tree=True):
+    # Return the most memory (in MB) used by this process or (if tree is
+    # true) any of its descendants that are still running
+    peak = _memory_used()
+    if not tree:
+        return peak
+    for pid in _processes():
+        try:
+            with open('/proc/{}/status'.format(pid)) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        peak = max(peak, int(line.split()[1]) / 1024.)
+        except (IOError, OSError, ValueError):
+            pass
+    return peak
+
+def write_trace(fname):
+    # Write the events in the trace to a file that can be viewed with
+    # chrome://tracing or https://ui.perfetto.dev, and show a summary
+    events = sorted(_trace['events'], key=lambda event: event['ts'])
+    if not events:
+        return
+    start = events[0]['ts']
+    for event in events:
+        event['ts'] -= start
+    with open(fname, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    sys.stdout.write('\n'.join(trace_summary(events))+'\n')
+    sys.stdout.write('Timings written to {}\n'.format(fname))
+
+def trace_summary(events):
+    # Return a table of the time taken by each kind of step and IRAF task,
+    # with their CPU time, peak memory, and FITS data read and written in
+    # MB, most costly first
+    totals = {}
+    for event in events:
+        args = event['args']
+        total = totals.setdefault((event['cat'], event['name']),
+                                  [0, 0., 0., 0., 0., 0.])
+        total[0] += 1
+        total[1] += event['dur'] / 1e6
+        total[2] += args['cpu']
+        total[3] = max(total[3], args['maxrss'])
+        total[4] += args['read'] / 1048576.
+        total[5] += args['written'] / 1048576.
+    fmt = '{:<9} {:<24} {:>6} {:>10} {:>10} {:>8} {:>9} {:>9}'
+    lines = [fmt.format('', 'name', 'calls', 'time (s)', 'CPU (s)',
+                        'peak MB', 'read MB', 'wrote MB')]
+    fmt = '{:<9} {:<24} {:>6d} {:>10.1f} {:>10.1f} {:>8.0f} {:>9.1f} {:>9.1f}'
+    for (cat, name), total in sorted(totals.items(),
+                                     key=lambda item: -item[1][1]):
+        lines.append(fmt.format(cat, name, *total))
+    return lines
+
+#---------------------------------------------------------------------
+class Scheduler(object):
+    """Run the steps of a reduction in dependency order.
+
+    Steps are added in the order in which they would be run serially,
+    each with the names of the files it needs and makes. A step waits
+    for the last earlier step to make each file it needs, and a step
+    that makes a file also waits for all earlier steps that use it.
+    Steps that don't depend on each other can then be run at the same
+    time, each in a separate process with its own scratch directory.
+
+    A step is skipped if it has been run before with the same code,
+    arguments, configuration entries, and input files (or, for files
+    made by other steps, the same inputs to those steps), and the files
+    it made have not changed since. Otherwise, those files are deleted
+    before it is run. Input files that aren't made by any step are
+    looked for in the working directory and then in paths.
+    """
+    def __init__(self, paths=()):
+        self.steps = []
+        self.depends = []
+        self.inputs = []
+        self.makes = []
+        self.paths = tuple(paths)
+        self._maker = {}
+        self._users = {}
+        self._memo = {}
+        self._keys = {}
+        self._address = {}
+        self._sources = {}
+
+    def add(self, func, args=(), kwargs=None, needs=(), makes=(),
+            label=None):
+        # Add a call to func(*args, **kwargs) to the schedule
+        step = len(self.steps)
+        needs = set(file_key(name) for name in needs)
+        makes = set(file_key(name) for name in makes)
+        depends = set()
+        # A file that the step makes (e.g., a bad pixel mask that it
+        # remakes) isn't an input, or the step would never be up to date
+        self.inputs.append(dict((name, self._maker.get(name))
+                                for name in needs - makes if name))
+        self.makes.append(makes)
+        for name in needs | makes:
+            if name in self._maker:
+                depends.add(self._maker[name])
+        for name in makes:
+            depends.update(self._users.get(name, ()))
+        for name in needs:
+            self._users.setdefault(name, set()).add(step)
+        for name in makes:
+            self._maker[name] = step
+            self._users[name] = set()
+        depends.discard(step)
+        self.steps.append((func, tuple(args), kwargs or {},
+                           label or func.__name__))
+        self.depends.append(depends)
+        return step
+
+    def add_stage(self, func, red_dict, makes=(), **kwargs):
+        # Add a step for each entry in a reduction dictionary, which makes
+        # the output file (and any files listed under the "makes" keys)
+        # and needs all the other files in the entry
+        for outfile, file_dict in red_dict.items():
+            self.add(func, ({outfile: file_dict},), kwargs,
+                     needs=file_names(file_dict.values()),
+                     makes=[outfile]+[file_dict[k] for k in makes
+                                      if k in file_dict],
+                     label=outfile)
+
+    def outputs(self):
+        # Return the names of all the files that will be made
+        return set(self._maker)
+
+    def run(self, nproc=1, init=None, nprep=1, redo=False, trace=True):
+        # Run all the steps, in order if nproc=1, otherwise as soon as the
+        # steps they depend on have finished, using nproc processes. The
+        # init function is called before the first step in each process.
+        # If the steps are run in order, their map_frames() calls can use
+        # nprep processes. If redo=True, no steps are skipped. If
+        # trace=True, the steps and IRAF tasks are timed, and the timings
+        # written to TRACE_FILE
+        if (nproc > 1 or nprep > 1) and not can_fork():
+            nproc = nprep = 1
+        self._memo = load_memo()
+        self._redo = redo
+        _trace.update(on=trace, events=[])
+        scratch = os.path.abspath(SCRATCH_DIR)
+        try:
+            if nproc <= 1:
+                start_frame_pool(nprep, init)
+            if nproc > 1:
+                self._run_parallel(nproc, init, scratch)
+            else:
+                for step, (func, args, kwargs, label) in enumerate(self.steps):
+                    if not self._needs_running(step):
+                        continue
+                    if init:
+                        with traced(init.__name__, 'init'):
+                            init()
+                        init = None
+                    self._finished(step, _call_step(func, args, kwargs,
+                                                    label))
+        finally:
+            stop_frame_pool()
+            shutil.rmtree(scratch, ignore_errors=True)
+            if trace:
+                write_trace(TRACE_FILE)
+
+    def _run_parallel(self, nproc, init, scratch):
+        waiting = [set(depends) for depends in self.depends]
+        dependents = [[] for step in self.steps]
+        for step, depends in enumerate(self.depends):
+            for other in depends:
+                dependents[other].append(step)
+        ready = [step for step, depends in enumerate(waiting) if not depends]
+        running = 0
+        failed = []
+        pool = WorkerPool(nproc, init, scratch)
+        try:
+            while running or (ready and not failed):
+                # Don't start anything new once something has failed
+                while ready and not failed:
+                    step = ready.pop(0)
+                    if self._needs_running(step):
+                        func, args, kwargs, label = self.steps[step]
+                        pool.submit(step, _run_step,
+                                    (step, func, args, kwargs, label))
+                        running += 1
+                        continue
+                    for other in dependents[step]:
+                        waiting[other].discard(step)
+                        if not waiting[other]:
+                            ready.append(other)
+                if not running:
+                    break
+                step, error, config = pool.get()
+                running -= 1
+                if error:
+                    failed.append((self.steps[step][3], error))
+                    continue
+                self._finished(step, config)
+                for other in dependents[step]:
+                    waiting[other].discard(step)
+                    if not waiting[other]:
+                        ready.append(other)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        if failed:
+            for label, error in failed:
+                sys.stderr.write('Error making {}:\n{}'.format(label, error))
+            raise RuntimeError('Failed to make {}'.format(
+                ', '.join(label for label, error in failed)))
+
+    def _key(self, step):
+        # Hash everything that a step depends on, apart from the
+        # configuration entries it uses (which are only known once it
+        # has been run)
+        func, args, kwargs, label = self.steps[step]
+        inputs = []
+        for name, maker in sorted(self.inputs[step].items()):
+            if maker is None:
+                inputs.append([name, file_signature(
+                    find_file(name, self.paths))])
+            else:
+                inputs.append([name, self._address[maker]])
+        h = hashlib.sha1(canonical([getattr(func, '__module__', None),
+                                    func.__name__, args, kwargs,
+                                    inputs]).encode('utf-8'))
+        h.update(self._source_key(func).encode('utf-8'))
+        return h.hexdigest()
+
+    def _source_key(self, func):
+        # Hash the code a step runs: the source of the module it is in and
+        # of the modules alongside it that it uses (e.g., the helpers in
+        # this one), or else just the function's own bytecode
+        name = getattr(func, '__module__', None)
+        if name not in self._sources:
+            files = source_files(sys.modules.get(name))
+            h = hashlib.sha1()
+            for fname in files:
+                with open(fname, 'rb') as f:
+                    h.update(f.read())
+            self._sources[name] = h.hexdigest() if files else None
+        if self._sources[name] is not None:
+            return self._sources[name]
+        code = getattr(func, '__code__', None)
+        if code is None:
+            return ''
+        h = hashlib.sha1(code.co_code)
+        h.update(repr([c for c in code.co_consts
+                       if not isinstance(c, types.CodeType)]).encode('utf-8'))
+        return h.hexdigest()
+
+    def _needs_running(self, step):
+        # Return whether a step has to be run. If it doesn't, it is
+        # treated as if it had just been run
+        label = self.steps[step][3]
+        self._keys[step] = key = self._key(step)
+        record = self._memo.get(label)
+        if self._redo or not up_to_date(record, key):
+            # The tasks won't overwrite the files it made before
+            remove_files(self.makes[step])
+            return True
+        sys.stdout.write('{} is up to date\n'.format(label))
+        self._address[step] = step_address(key, record['config'])
+        return False
+
+    def _finished(self, step, config):
+        # Record that a step has been run, with the configuration entries
+        # it used and the files it made
+        key = self._keys[step]
+        label = self.steps[step][3]
+        self._address[step] = step_address(key, config)
+        # A file remade by a later step is checked by that step instead
+        files = [find_file(name) for name in self.makes[step]
+                 if self._maker[name] == step]
+        if None in files:
+            # There's no way to tell later if its files have changed
+            self._memo.pop(label, None)
+        else:
+            self._memo[label] = {'key': key, 'config': config,
+                                 'files': dict((fname, file_signature(fname))
+                                               for fname in files)}
+        save_memo(self._memo)
+
+def up_to_date(record, key):
+    # Return whether a record of a step that has been run is for the same
+    # key, and the files it made and configuration entries it used have
+    # not changed since
+    if record is None or record['key'] != key:
+        return False
+    for fname, sig in record['files'].items():
+        if file_signature(fname) != sig:
+            return False
+    for fname, used in record['config'].items():
+        try:
+            config = parsed_config(fname)
+        except (IOError, OSError):
+            return False
+        for k, value in used.items():
+            if k not in config or canonical(config[k]) != value:
+                return False
+    return True
+
+def step_address(key, config):
+    # Hash the key of a step and the configuration entries it used, which
+    # identifies the files it makes
+    return hashlib.sha1((key+canonical(config)).encode('utf-8')).hexdigest()
+
+#---------------------------------------------------------------------
+class WorkerPool(object):
+    """A pool of long-lived processes for running IRAF tasks.
+
+    Each worker calls the init function (which loads PyRAF and the IRAF
+    packages) before its first job and keeps everything loaded for the
+    jobs that follow. Jobs are sent to idle workers one at a time, over
+    a separate pipe for each worker, so a worker that dies can't affect
+    the others: it is replaced and its job reported as failed. A worker
+    that has run too many jobs or grown too large is also replaced,
+    after its current job.
+    """
+    def __init__(self, nproc, init=None, scratch=None,
+                 maxtasks=WORKER_MAX_TASKS, maxmem=WORKER_MAX_MEMORY):
+        self.nproc = nproc
+        self._args = (os.getcwd(), os.path.abspath(scratch or SCRATCH_DIR),
+                      init, maxtasks, maxmem)
+        self._workers = {}
+        self._idle = []
+        self._jobs = {}
+        self._waiting = []
+        for i in range(nproc):
+            self._start()
+
+    def _start(self):
+        # Start a worker process, which waits for jobs on its pipe
+        conn, child_conn = Pipe()
+        process = Process(target=_serve, args=(child_conn,)+self._args)
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        self._workers[process.pid] = (process, conn)
+        self._idle.append(process.pid)
+
+    def _stop(self, pid):
+        # Forget about a worker process that has exited (or is exiting)
+        process, conn = self._workers.pop(pid)
+        process.join()
+        conn.close()
+        if pid in self._idle:
+            self._idle.remove(pid)
+        return process.exitcode
+
+    def _dispatch(self):
+        # Send waiting jobs to idle workers
+        while self._waiting and self._idle:
+            pid = self._idle.pop(0)
+            job = self._waiting.pop(0)
+            self._workers[pid][1].send(job)
+            self._jobs[pid] = job[0]
+
+    def submit(self, jobid, func, args=()):
+        # Queue a call to func(*args), identified by jobid
+        self._waiting.append((jobid, func, tuple(args)))
+        self._dispatch()
+
+    def get(self):
+        # Wait for any job to finish and return (jobid, error, value), where
+        # error is the traceback if the job failed
+        while True:
+            pids = dict((conn, pid) for pid, (process, conn)
+                        in self._workers.items())
+            # A timeout allows python 2 to be interrupted while waiting
+            for conn in wait(list(pids), 1):
+                pid = pids[conn]
+                try:
+                    jobid, error, value, retiring, trace = conn.recv()
+                except EOFError:  # the worker has died
+                    jobid = self._jobs.pop(pid, None)
+                    error = 'Worker process died (exit code {})\n'.format(
+                        self._stop(pid))
+                    value, retiring = None, True
+                else:
+                    del self._jobs[pid]
+                    _add_trace(*trace)
+                    if retiring:
+                        self._stop(pid)
+                    else:
+                        self._idle.append(pid)
+                if retiring:
+                    self._start()
+                self._dispatch()
+                if jobid is not None:
+                    return jobid, error, value
+
+    def map(self, func, arglist):
+        # Return [func(*args) for args in arglist]
+        for i, args in enumerate(arglist):
+            self.submit(i, func, args)
+        values = [None] * len(arglist)
+        errors = []
+        for i in range(len(arglist)):
+            jobid, error, values[jobid] = self.get()
+            if error:
+                errors.append(error)
+        if errors:
+            sys.stderr.write(''.join(errors))
+            raise RuntimeError('{} of {} jobs failed'.format(len(errors),
+                                                            len(arglist)))
+        return values
+
+    def close(self):
+        # Tell the workers to exit once they have finished their jobs
+        for process, conn in self._workers.values():
+            conn.send(None)
+
+    def terminate(self):
+        # Stop the workers immediately
+        for process, conn in self._workers.values():
+            process.terminate()
+
+    def join(self):
+        # Wait for the workers to exit
+        for pid in list(self._workers):
+            self._stop(pid)
+
+#---------------------------------------------------------------------
+# A pool of processes for running the same IRAF tasks on many frames
+_frame_pool = {}
+
+def can_fork():
+    # New processes can't safely share the IRAF processes that PyRAF has
+    # already started (e.g., in an interactive PyRAF session)
+    if sys.modules.get('pyraf') is not None:
+        sys.stderr.write('PyRAF is already loaded: running serially\n')
+        return False
+    return True
+
+def start_frame_pool(nproc, init=None):
+    # Start the processes used by map_frames(), each with its own IRAF
+    # parameter directory. The init function is called in each process
+    # before it does anything else
+    if nproc > 1:
+        _frame_pool['pool'] = WorkerPool(nproc, init)
+        _frame_pool['pid'] = os.getpid()
+
+def stop_frame_pool():
+    # Shut down the processes used by map_frames()
+    pool = _frame_pool.pop('pool', None)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+def map_frames(func, arglist):
+    # Return [func(*args) for args in arglist], with the calls shared
+    # between the frame pool processes if they were started by this
+    # process. Each call must only make files that the others don't use
+    pool = _frame_pool.get('pool')
+    if pool is None or _frame_pool['pid'] != os.getpid() or len(arglist) < 2:
+        return [func(*args) for args in arglist]
+    return pool.map(_run_frame, [(os.getcwd(), func, args)
+                                 for args in arglist])
+
+def frame_batches(items):
+    # Split a list into one batch for each frame pool process (or a single
+    # batch if there is no pool), e.g., to run a task once on each batch
+    pool = _frame_pool.get('pool')
+    if pool is None or _frame_pool['pid'] != os.getpid():
+        nbatch = 1
+    else:
+        nbatch = pool.nproc
+    nbatch = min(nbatch, len(items))
+    return [items[i::nbatch] for i in range(nbatch)]
+
+def run_tasks(calls):
+    # Run IRAF tasks, given as (task name, args, parameters) tuples, in the
+    # frame pool processes if possible, and return the output of each
+    return map_frames(run_task, calls)
+
+def run_task(task, args=(), pars=None):
+    # Run an IRAF task by name, showing its output as usual, and return
+    # the output as a list of lines
+    from pyraf import iraf
+    output = getattr(iraf, task)(*args, Stdout=1, **(pars or {}))
+    for line in output:
+        sys.stdout.write(line+'\n')
+    sys.stdout.flush()
+    return output
+
+#---------------------------------------------------------------------
+# Functions run in the worker processes
+_worker = {}
+
+def _start_worker(workdir, scratch, init):
+    # Give this process a scratch directory and a private directory for
+    # IRAF task parameters, so simultaneous tasks can't interfere
+    home = os.path.join(scratch, 'worker{}'.format(os.getpid()))
+    uparm = os.path.join(home, 'uparm', '')
+    os.makedirs(uparm)
+    os.environ['uparm'] = uparm
+    _worker.update({'workdir': workdir, 'scratch': scratch, 'home': home,
+                    'uparm': uparm, 'init': init})
+    # Forget anything the parent process was timing when this one started
+    _trace.update(events=[], open=[{'read': 0, 'written': 0}], task=False)
+
+def _serve(conn, workdir, scratch, init, maxtasks, maxmem):
+    # Run jobs sent by a WorkerPool until told to stop, or until this
+    # process should be replaced by a fresh one
+    _start_worker(workdir, scratch, init)
+    ntasks = 0
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:  # the pool has gone away
+            break
+        if job is None:
+            break
+        jobid, func, args = job
+        try:
+            value, error = func(*args), None
+        except Exception:
+            value, error = None, traceback.format_exc()
+        ntasks += 1
+        retiring = ntasks >= maxtasks or _memory_used() > maxmem
+        conn.send((jobid, error, value, retiring, _take_trace()))
+        if retiring:
+            break
+
+def _memory_used():
+    # Return the most memory this process has used, in MB
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1048576. if sys.platform == 'darwin' else 1024.)
+
+def _call_step(func, args, kwargs, label):
+    # Run a step, returning the configuration entries it used
+    _step_config.clear()
+    _trace_iraf()
+    with traced(func.__name__, 'step', step=label):
+        func(*args, **kwargs)
+    return dict(_step_config)
+
+def _run_step(step, func, args, kwargs, label):
+    # Run one step in an empty directory that has links to everything in
+    # the working directory, then move the files it made back. Return the
+    # configuration entries it used
+    workdir, home = _worker['workdir'], _worker['home']
+    tmpdir = os.path.join(home, 'step{}'.format(step))
+    try:
+        os.mkdir(tmpdir)
+        linked = link_files(workdir, tmpdir,
+                            skip=[os.path.basename(_worker['scratch']),
+                                  MEMO_FILE, MEMO_FILE+'.tmp', TRACE_FILE])
+        _chdir(tmpdir)
+        try:
+            _init_worker()
+            return _call_step(func, args, kwargs, label)
+        finally:
+            _chdir(home)
+            keep_files(tmpdir, workdir, linked)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def _run_frame(cwd, func, args):
+    # Run one of the calls from map_frames() in the caller's directory
+    if os.getcwd() != cwd:
+        _chdir(cwd)
+    _init_worker()
+    _trace_iraf()
+    return func(*args)
+
+def _init_worker():
+    # Call the init function the first time the process does anything
+    init = _worker.pop('init', None)
+    if init:
+        with traced(init.__name__, 'init'):
+            init()
+        _set_uparm(_worker['uparm'])
+
+def _chdir(path):
+    # PyRAF must be told, so running IRAF processes also change directory
+    pyraf = sys.modules.get('pyraf')
+    if pyraf is not None:
+        pyraf.iraf.chdir(path)
+    else:
+        os.chdir(path)
+
+def _set_uparm(uparm):
+    # login.cl sets the IRAF parameter directory when PyRAF is loaded
+    pyraf = sys.modules.get('pyraf')
+    if pyraf is not None:
+        pyraf.iraf.set(uparm=uparm)
+
+def link_files(src, dest, skip=()):
+    # Link everything in directory src into directory dest (hard links
+    # for files, so changes made in either place are seen in the other,
+    # and symbolic links for directories). Return the inode of each file
+    linked = {}
+    for name in os.listdir(src):
+        if name in skip:
+            continue
+        path = os.path.join(src, name)
+        if os.path.isdir(path):
+            os.symlink(os.path.abspath(path), os.path.join(dest, name))
+            continue
+        try:
+            os.link(path, os.path.join(dest, name))
+        except OSError:  # e.g., a different filesystem
+            os.symlink(os.path.abspath(path), os.path.join(dest, name))
+        linked[name] = os.stat(path).st_ino
+    return linked
+
+def keep_files(src, dest, linked):
+    # Move new files from directory src to directory dest, and delete
+    # files from dest if they were linked into src and then deleted
+    for name in os.listdir(src):
+        path = os.path.join(src, name)
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode) or linked.get(name) == st.st_ino:
+            continue
+        target = os.path.join(dest, name)
+        if stat.S_ISDIR(st.st_mode) and os.path.isdir(target):
+            keep_files(path, target, {})
+        else:
+            os.rename(path, target)
+    for name, inode in linked.items():
+        target = os.path.join(dest, name)
+        if (not os.path.lexists(os.path.join(src, name)) and
+                os.path.exists(target) and os.stat(target).st_ino == inode):
+            os.remove(target)
@@ -1,83 +1,19 @@
 #!/usr/bin/env python
-import os, yaml
-import numpy as np
-from pyraf import iraf
-from pyraf.iraf import gemini
-from pyraf.iraf import gemtools, niri, f2, gnirs
-from astropy.table import Table, Row, unique
+from collections import OrderedDict
+from coadd import coadd_frames, merge_coadds
+from combine import combine_frames
+from imreduce import make_sky, reduce_frames
+from obstable import ObsLog, find_log
+from pipeline import Scheduler, load_config, release_frames
+from reduction import (TaskPars, filelist, init_iraf, iraf, iraf_packages,
+                       merge_dicts, prepare_frames, print_plan, script_parser)
 #---------------------------------------------------------------------
-class Observation(Row):
-    def __init__(self, table, fname):
-        if fname not in table['File']:
-            raise ValueError('{} not found in Observation Log'.format(fname))
-        self._table = table
-        self._index = np.argmax(table['File']==fname)
+gemini, gemtools, niri, f2, gnirs = iraf_packages('gemini', 'gemtools', 'niri',
+                                                  'f2', 'gnirs')
 
-    def __getitem__(self, item):
-        return self._table[item][self._index]
-
-class ObsLog(object):
-    def __init__(self, fname):
-        # Load observation log and strip trailing spaces from string fields
-        obslog = fname if isinstance(fname, Table) else Table.read(fname)
-        obslog = obslog[obslog['use_me']]
-        for col in obslog.colnames:
-            try:
-                obslog[col] = [v.strip() for v in obslog[col]]
-            except AttributeError:
-                pass
-        self.table = obslog
-
-    def __getitem__(self, fname):
-        # Return table row for a specific filename
-        return Observation(self.table, fname)
-
-    def query(self, qd):
-        # Return obslog rows that match all requirements
-        # Deal with date ranges but don't alter the query dictionary
-        try:
-            date1, date2 = qd['Date'].split(':')
-        except ValueError:  # Only one date
-            good = self.table['Date'] == qd['Date']
-        except KeyError:  # No date constraint
-            good = np.array([True] * len(self.table))
-        else:
-            good = np.logical_and(self.table['Date'] >= date1,
-                                  self.table['Date'] <= date2)
-        # Specific observation range
-        if 'first' in qd:
-            good &= self.table['File'] >= qd['first']
-        if 'last' in qd:
-            good &= self.table['File'] <= qd['last']
-        # Other constraints
-        good &= np.logical_and.reduce([self.table[k]==v for k,v in qd.items()
-                                       if (k in self.table.colnames and
-                                           k != 'Date')])
-        return self.table[good]
-
-    def file_query(self, qd):
-        # Return a list of filenames matching the query
-        return list(self.query(qd)['File'])
-#---------------------------------------------------------------------
-def filelist(prefix, fileList):
-    # Transform python list to comma-separated string
-    return ','.join(str(prefix+f) for f in fileList)
-
-def merge_dicts(dict1, dict2, allow_new=True):
-    # Merge two dicts; possibly prevent new keys being added
-    d = dict1.copy()
-    d.update({k: v for k, v in dict2.items() if (k in dict1 or allow_new)})
-    return d
-
-def get_pars(*tasks):
-    # Unlearn tasks and read parameters from yaml file, returning dicts
-    with open('imgTaskPars.yml', 'r') as yf:
-        pars = yaml.safe_load(yf)
-    pkg_dict = {'f2': f2, 'ni': niri, 'ge': gemtools}
-    for task in tasks:
-        pkg = pkg_dict.get(task[:2], iraf)
-        getattr(getattr(pkg, task), 'unlearn')()
-    return [pars[task] for task in tasks]
+task_pars = TaskPars('imgTaskPars.yml',
+                     {'f2': f2, 'ni': niri, 'ge': gemtools}, iraf)
+read_pars, get_pars = task_pars.read, task_pars.get
 
 #----------------------------------------------------------------------
 #---- DON'T EDIT ABOVE THIS LINE UNLESS YOU KNOW WHAT YOU'RE DOING ----
@@ -87,10 +23,7 @@ def get_pars(*tasks):
 def nightlyDarks(obslog):
     dark_dict = {}
     qd = {'ObsType': 'DARK'}
-    configs = unique(obslog.query(qd)['Date', 'Texp'])
-    for (date, t) in configs:
-        darkFiles = obslog.file_query(merge_dicts(qd, {'Date': date,
-                                                       'Texp': t}))
+    for (date, t), darkFiles in obslog.groupby(('Date', 'Texp'), **qd):
         outfile = 'MCdark_'+date.replace('-','')+'_'+str(int(t))
         dark_dict[outfile] = {'input': darkFiles}
     return dark_dict
@@ -98,49 +31,45 @@ def nightlyDarks(obslog):
 def selectDarks(obslog):
     dark_dict = {}
     qd = {'ObsType': 'DARK'}
-    exptimes = set(obslog.query(qd)['Texp'])
-    for t in exptimes:
-        darkFiles = obslog.file_query(merge_dicts(qd, {'Texp': t}))
+    for (t,), darkFiles in obslog.groupby(('Texp',), **qd):
         outfile = 'MCdark_'+str(int(t))
         dark_dict[outfile] = {'input': darkFiles}
     return dark_dict
 
-def reduceDarks(dark_dict):
+def reduceDarks(dark_dict, native=False):
     prepPars, combPars = get_pars('f2prepare', 'gemcombine')
     for outfile, file_dict in dark_dict.items():
         darkFiles = file_dict['input']
-        for f in darkFiles:
-            f2.f2prepare(f, **prepPars)
-        if len(darkFiles) > 1:
+        prepare_frames(darkFiles, prepPars)
+        if len(darkFiles) > 1 and native:
+            combine_frames(['p'+f for f in darkFiles], outfile, **combPars)
+        elif len(darkFiles) > 1:
             gemtools.gemcombine(filelist('p', darkFiles), outfile,
                                 **combPars)
         else:
             iraf.imrename('p'+darkFiles[0], outfile)
-        iraf.imdelete('pS*.fits')
+        release_frames()
 
 #----------------------- FLATS: See Section 4.4 -----------------------
 def selectGcalFlats(obslog):
     # First we need to select the shortest darks
-    qd = {'ObsType': 'DARK'}
-    tshort = min(obslog.query(qd)['Texp'])
-    shortDarks = obslog.file_query(merge_dicts(qd, {'Texp': tshort}))
+    darks = dict((t, darkFiles) for (t,), darkFiles in
+                 obslog.groupby(('Texp',), ObsType='DARK'))
+    shortDarks = darks[min(darks)]
 
     flat_dict = {}
     qd = {'ObsType': 'FLAT'}
     params = ('Filter', 'Texp')
-    flatConfigs = unique(obslog.query(qd)[params])
-    for config in flatConfigs:
-        filt, t = config
-        config_dict = dict(zip(params, config))
+    # Split the flats by shutter position as well, for lamp-on/off
+    shutters = dict(obslog.groupby(params+('GCAL Shutter',), **qd))
+    for (filt, t), flatFiles in obslog.groupby(params, **qd):
         # K/Ks-band flats are made differently
         if filt.startswith('K'):
-            lampsOn = obslog.file_query(merge_dicts(qd, config_dict))
-            lampsOff = obslog.file_query({'ObsType': 'DARK', 'Texp': t})
+            lampsOn = flatFiles
+            lampsOff = darks.get(t, [])
         else:
-            config_dict['GCAL Shutter'] = 'OPEN'
-            lampsOn = obslog.file_query(merge_dicts(qd, config_dict))
-            config_dict['GCAL Shutter'] = 'CLOSED'
-            lampsOff = obslog.file_query(merge_dicts(qd, config_dict))
+            lampsOn = shutters.get((filt, t, 'OPEN'), [])
+            lampsOff = shutters.get((filt, t, 'CLOSED'), [])
         outfile = 'MCflat_'+filt
         flat_dict[outfile] = {'bpm': 'MCbpm_'+filt+'.pl',
                               'lampsOn': lampsOn, 'lampsOff': lampsOff,
@@ -149,19 +78,15 @@ def selectGcalFlats(obslog):
 
 def selectSkyFlats(obslog):
     # First we need to select the shortest darks
-    qd = {'ObsType': 'DARK'}
-    tshort = min(obslog.query(qd)['Texp'])
-    shortDarks = obslog.file_query(merge_dicts(qd, {'Texp': tshort}))
+    darks = dict((t, darkFiles) for (t,), darkFiles in
+                 obslog.groupby(('Texp',), ObsType='DARK'))
+    shortDarks = darks[min(darks)]
 
     flat_dict = {}
     qd = {'Object': 'Twilight'}
     params = ('Filter', 'Texp')
-    flatConfigs = unique(obslog.query(qd)[params])
-    for config in flatConfigs:
-        filt, t = config
-        config_dict = dict(zip(params, config))
-        lampsOn = obslog.file_query(merge_dicts(qd, config_dict))
-        lampsOff = obslog.file_query({'ObsType': 'DARK', 'Texp': t})
+    for (filt, t), lampsOn in obslog.groupby(params, **qd):
+        lampsOff = darks.get(t, [])
         outfile = 'MCflat_'+filt
         flat_dict[outfile] = {'bpm': 'MCbpm_'+filt+'.pl',
                               'lampsOn': lampsOn, 'lampsOff': lampsOff,
@@ -180,23 +105,23 @@ def reduceFlats(flat_dict, gcal=True):
         lampsOn = file_dict['lampsOn']
         lampsOff = file_dict['lampsOff']
         shortDarks = file_dict['shortDarks']
-        # Don't waste time trying to re-prepare files
-        for f in shortDarks+lampsOn+lampsOff:
-            if not os.path.exists('p'+f+'.fits'):
-                f2.f2prepare(f, **prepPars)
+        # Don't try to prepare the same file twice at once
+        allFiles = OrderedDict.fromkeys(shortDarks+lampsOn+lampsOff)
+        prepare_frames(list(allFiles), prepPars)
         flatPars.update({'darks': filelist('p', shortDarks),
                            'lampsoff': filelist('p', lampsOff),
                            'flatfile': outfile, 'bpmfile': bpmFile})
         niri.niflat(filelist('p', lampsOn), **flatPars)
-        iraf.imdelete('pS*.fits')
+        release_frames()
 
 #---------------------- TARGETS: See Section 4.5 ----------------------
 def selectTargets(obslog):
     # Configuation file: see Section 4.2.1
-    with open('imgTargets.yml', 'r') as yf:
-        targets = yaml.safe_load(yf)
+    targets = load_config('imgTargets.yml')
 
     sci_dict = {}
+    # The groups of each target that has a groupsize, in order
+    groups = OrderedDict()
     qd = {'ObsClass': 'science'}
     for outfile, pars in targets.items():
         sciFiles = obslog.file_query(merge_dicts(qd, pars))
@@ -205,15 +130,20 @@ def selectTargets(obslog):
                      'bpm': pars.get('bpm', 'MCbpm_'+filt+'.pl'),
                      'flat': pars.get('flat', 'MCflat_'+filt),
                      'sky': pars.get('sky', 'self')}
+        if 'skywindow' in pars:
+            file_dict['skywindow'] = pars['skywindow']
         try:
             groupsize = pars['groupsize']
         except:
             sci_dict[outfile] = merge_dicts(file_dict, {'input': sciFiles})
         else:
             index = 1
+            groups[outfile] = []
             while len(sciFiles) > 0:
-                sci_dict['{}_{:03d}'.format(outfile, index)] = merge_dicts(
+                group = '{}_{:03d}'.format(outfile, index)
+                sci_dict[group] = merge_dicts(
                     file_dict, {'input': sciFiles[:groupsize]})
+                groups[outfile].append(group)
                 del sciFiles[:groupsize]
                 index += 1
 
@@ -221,11 +151,17 @@ def selectTargets(obslog):
     sky_list = [v['sky'] for v in sci_dict.values()]
     # Make a reduction dict of bespoke skies
     sky_dict = {k: v for k, v in sci_dict.items() if k in sky_list}
+    # which can't be running skies
+    for file_dict in sky_dict.values():
+        file_dict.pop('skywindow', None)
     # And then remove these from the science reduction dict
     sci_dict = {k: v for k, v in sci_dict.items() if k not in sky_list}
-    return sky_dict, sci_dict
+    # Only the groups that are coadded can be merged
+    groups = OrderedDict((outfile, [k for k in names if k in sci_dict])
+                         for outfile, names in groups.items())
+    return sky_dict, sci_dict, groups
 
-def reduceSkies(sky_dict):
+def reduceSkies(sky_dict, native=False):
     prepPars, arithPars, skyPars, redPars = get_pars('f2prepare', 'gemarith',
                                                      'nisky', 'nireduce')
     for outfile, file_dict in sky_dict.items():
@@ -233,9 +169,22 @@ def reduceSkies(sky_dict):
         prepPars['bpm'] = file_dict['bpm']
         flatFile = file_dict['flat']
         skyFiles = file_dict['input']
-        for f in skyFiles:
-            f2.f2prepare(f, **prepPars)
-            gemtools.gemarith('p'+f, '-', darkFile, 'dp'+f, **arithPars)
+        skyWindow = file_dict.get('skywindow')
+        if native:
+            # The dark is subtracted while making the sky
+            prepare_frames(skyFiles, prepPars)
+            inputs = ['p'+f for f in skyFiles]
+        else:
+            prepare_frames(skyFiles, prepPars, darkFile, arithPars)
+            inputs, darkFile = ['dp'+f for f in skyFiles], None
+        if native or skyWindow:
+            # Make the flatfielded sky in one go (or, with a running sky,
+            # one for each frame from the skywindow frames nearest to it)
+            if skyWindow:
+                outfile = [outfile+'_'+f for f in skyFiles]
+            make_sky(inputs, outfile, dark=darkFile, flat=flatFile,
+                     window=skyWindow, **skyPars)
+            continue
         # Make (non-flatfielded) sky
         skyPars['outimage'] = 'nf_'+outfile
         niri.nisky(filelist('dp', skyFiles), **skyPars)
@@ -243,9 +192,9 @@ def reduceSkies(sky_dict):
         redPars.update({'flatimage': flatFile, 'outimage': outfile})
         niri.nireduce('nf_'+outfile, **redPars)
         iraf.imdelete('nf_'+outfile)
-    iraf.imdelete('pS*.fits')
+    release_frames()
 
-def reduceScience(sci_dict):
+def reduceScience(sci_dict, native=False):
     prepPars, arithPars, redPars, coaddPars = get_pars('f2prepare', 'gemarith',
                                                        'nireduce', 'imcoadd')
     for outfile, file_dict in sci_dict.items():
@@ -256,56 +205,139 @@ def reduceScience(sci_dict):
         sciFiles = file_dict['input']
         prepPars['bpm'] = bpmFile
         if skyFile == 'self':
-            # Make the sky (also leaves dark-subtracted files on disk)
+            # Make the sky
             skyFile = outfile+'_sky'
-            reduceSkies({skyFile: file_dict})
+            reduceSkies({skyFile: file_dict}, native=native)
+            if file_dict.get('skywindow'):
+                # A running sky, one for each frame
+                skyFile = [skyFile+'_'+f for f in sciFiles]
 
-        # Flatfield
-        redPars.update({'outprefix': 'f', 'fl_sky': 'no',
-                        'fl_flat': 'yes', 'flatimage': flatFile})
-        niri.nireduce(filelist('dp', sciFiles), **redPars)
-        imcoadd_infiles = filelist('fdp', sciFiles)
+        if native:
+            # Dark-subtract, flatfield, and sky-subtract each frame in one go
+            prefix = 'fdp' if skyFile == 'none' else 'rfdp'
+            prepare_frames(sciFiles, prepPars)
+            reduce_frames(['p'+f for f in sciFiles],
+                          [prefix+f for f in sciFiles], dark=darkFile,
+                          flat=flatFile,
+                          sky=None if skyFile == 'none' else skyFile,
+                          **redPars)
+            imcoadd_infiles = filelist(prefix, sciFiles)
+        else:
+            # Dark-subtract (the frames are only prepared again if they
+            # aren't in the frame cache), then flatfield
+            prepare_frames(sciFiles, prepPars, darkFile, arithPars)
+            redPars.update({'outprefix': 'f', 'fl_sky': 'no',
+                            'fl_flat': 'yes', 'flatimage': flatFile})
+            niri.nireduce(filelist('dp', sciFiles), **redPars)
+            imcoadd_infiles = filelist('fdp', sciFiles)
 
-        # Sky-subtract if required
-        if skyFile != 'none':
-            redPars.update({'outprefix': 'r', 'fl_flat': 'no',
-                            'fl_sky': 'yes', 'skyimage': skyFile})
-            niri.nireduce(filelist('fdp', sciFiles), **redPars)
-            imcoadd_infiles = filelist('rfdp', sciFiles)
+            # Sky-subtract if required
+            if skyFile != 'none':
+                redPars.update({'outprefix': 'r', 'fl_flat': 'no',
+                                'fl_sky': 'yes'})
+                if isinstance(skyFile, list):
+                    for f, sky in zip(sciFiles, skyFile):
+                        redPars['skyimage'] = sky
+                        niri.nireduce('fdp'+f, **redPars)
+                else:
+                    redPars['skyimage'] = skyFile
+                    niri.nireduce(filelist('fdp', sciFiles), **redPars)
+                imcoadd_infiles = filelist('rfdp', sciFiles)
 
         coaddPars.update({'badpixfile': bpmFile, 'outimage': outfile})
-        gemtools.imcoadd(imcoadd_infiles, **coaddPars)
-    iraf.imdelete('pS*.fits,dpS*.fits,rdpS*.fits,rfdpS*.fits,fdpS*.fits')
+        if native:
+            # The bad pixels are already flagged in the DQ extensions
+            coadd_frames(imcoadd_infiles.split(','), outfile, **coaddPars)
+        else:
+            gemtools.imcoadd(imcoadd_infiles, **coaddPars)
+        if isinstance(skyFile, list):
+            iraf.imdelete(','.join(skyFile))
+    release_frames()
+    iraf.imdelete('rdpS*.fits,rfdpS*.fits,fdpS*.fits')
 
-def coaddScience(sci_dict):
+def coaddScience(sci_dict, native=False):
     (coaddPars,) = get_pars('imcoadd')
     for outfile, file_dict in sci_dict.items():
         sciFiles = file_dict['input']
         prefix = 'fdp' if file_dict['sky'] == 'none' else 'rfdp'
         coaddPars.update({'badpixfile': file_dict['bpm'],
                           'outimage': outfile})
-        gemtools.imcoadd(filelist(prefix, sciFiles), **coaddPars)
+        if native:
+            coadd_frames([prefix+f for f in sciFiles], outfile, **coaddPars)
+        else:
+            gemtools.imcoadd(filelist(prefix, sciFiles), **coaddPars)
                            
+def selectMerges(group_dict, nmerge=4):
+    # Merge the coadds of the groups of each target that has a groupsize
+    # (from selectTargets()) into one, nmerge at a time, so that the
+    # merges at each level of the tree can be run at the same time
+
+    # Each merge has to come after the ones it needs
+    merge_dict = OrderedDict()
+    for outfile, groups in group_dict.items():
+        level = 1
+        while len(groups) > nmerge:
+            merged = []
+            for i in range(0, len(groups), nmerge):
+                if len(groups[i:i+nmerge]) == 1:
+                    merged.append(groups[i])
+                    continue
+                name = '{}_m{}_{:03d}'.format(outfile, level, i//nmerge + 1)
+                merge_dict[name] = {'input': groups[i:i+nmerge]}
+                merged.append(name)
+            groups = merged
+            level += 1
+        if len(groups) > 1:
+            merge_dict[outfile] = {'input': groups}
+    return merge_dict
+
+def mergeScience(merge_dict):
+    for outfile, file_dict in merge_dict.items():
+        merge_coadds(file_dict['input'], outfile)
+
 
 ########################################################################
-def reduce_images():
-    iraf.imtype = 'fits'
-    rawpath = get_pars('f2prepare')[0]['rawpath']
+def reduce_images(plan=False, nproc=1, nprep=1, redo=False, trace=True,
+                  native=False, merge=False, logfile=None):
+    rawpath = read_pars('f2prepare')[0]['rawpath']
     # Get observations log and remove unwanted files
-    obslog = ObsLog(os.path.join(rawpath, 'obslog.fits'))
-
-    gnirs.nsheaders('f2')
+    obslog = ObsLog(logfile or find_log(rawpath))
 
     dark_dict = selectDarks(obslog)
-    reduceDarks(dark_dict)
-    flat_dict = selectGcalFlats(obslog)
-    reduceFlats(flat_dict)
-    flat_dict = selectSkyFlats(obslog)
-    reduceFlats(flat_dict, gcal=False)
-    sky_dict, sci_dict = selectTargets(obslog)
-    reduceSkies(sky_dict)
-    reduceScience(sci_dict)
+    gcal_flat_dict = selectGcalFlats(obslog)
+    sky_flat_dict = selectSkyFlats(obslog)
+    sky_dict, sci_dict, group_dict = selectTargets(obslog)
+    merge_dict = selectMerges(group_dict) if merge else {}
+    if plan:
+        print_plan([('darks', dark_dict), ('GCAL flats', gcal_flat_dict),
+                    ('sky flats', sky_flat_dict), ('skies', sky_dict),
+                    ('science', sci_dict)] +
+                   ([('merged coadds', dict(merge_dict))] if merge else []))
+        return
+
+    # Each entry in a reduction dictionary is reduced as soon as the
+    # calibrations it needs have been made, unless nothing it depends on
+    # has changed since it was last reduced
+    schedule = Scheduler(paths=[rawpath])
+    schedule.add_stage(reduceDarks, dark_dict, native=native)
+    schedule.add_stage(reduceFlats, gcal_flat_dict, makes=('bpm',))
+    schedule.add_stage(reduceFlats, sky_flat_dict, makes=('bpm',), gcal=False)
+    schedule.add_stage(reduceSkies, sky_dict, native=native)
+    schedule.add_stage(reduceScience, sci_dict, native=native)
+    schedule.add_stage(mergeScience, merge_dict)
+    schedule.run(nproc, init=init_iraf, nprep=nprep, redo=redo,
+                 trace=trace)
 
 
 if __name__ == '__main__':
-    reduce_images()
+    parser = script_parser('Reduce F2 imaging data',
+                           'Combine the darks, make the skies, and reduce '
+                           'and coadd the science frames in python rather '
+                           'than with IRAF')
+    parser.add_argument('--merge', action='store_true',
+                        help='Merge the coadds of the groups of frames of '
+                        'each target with a groupsize')
+    args = parser.parse_args()
+    reduce_images(plan=args.plan, nproc=args.nproc, nprep=args.nprep,
+                  redo=args.redo, trace=args.trace, native=args.native,
+                  merge=args.merge, logfile=args.obslog)
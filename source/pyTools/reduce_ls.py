@@ -1,98 +1,37 @@
 #!/usr/bin/env python
-import os, yaml
 import numpy as np
-from pyraf import iraf
-from pyraf.iraf import images, onedspec, gemini
-from pyraf.iraf import gemtools, gnirs, f2
-from astropy.table import Table, Row, unique
+from combine import combine_frames
+import obstable
+from obstable import find_log
+from pipeline import Scheduler, load_config, release_frames, run_tasks
+from reduction import (TaskPars, filelist, init_iraf, iraf, iraf_packages,
+                       merge_dicts, prepare_frames, print_plan, script_parser)
 from astropy.io import fits
 #---------------------------------------------------------------------
-class Observation(Row):
-    def __init__(self, table, fname):
-        if fname not in table['File']:
-            raise ValueError('{} not found in Observation Log'.format(fname))
-        self._table = table
-        self._index = np.argmax(table['File']==fname)
-
-    def __getitem__(self, item):
-        return self._table[item][self._index]
-
-class ObsLog(object):
-    def __init__(self, fname):
-        # Load observation log and strip trailing spaces from string fields
-        obslog = fname if isinstance(fname, Table) else Table.read(fname)
-        obslog = obslog[obslog['use_me']]
-        obslog = obslog[np.logical_or(obslog['Disperser'] != 'Open',
-                                      obslog['ObsType'] == 'DARK')]
-        for col in obslog.colnames:
-            try:
-                obslog[col] = [v.strip() for v in obslog[col]]
-            except AttributeError:
-                pass
-        self.table = obslog
-
-    def __getitem__(self, fname):
-        # Return table row for a specific filename
-        return Observation(self.table, fname)
-
-    def query(self, qd):
-        # Return obslog rows that match all requirements
-        # Deal with date ranges but don't alter the query dictionary
-        try:
-            date1, date2 = qd['Date'].split(':')
-        except ValueError:  # Only one date
-            good = self.table['Date'] == qd['Date']
-        except KeyError:  # No date constraint
-            good = np.array([True] * len(self.table))
-        else:
-            good = np.logical_and(self.table['Date'] >= date1,
-                                  self.table['Date'] <= date2)
-        # Specific observation range
-        if 'first' in qd:
-            good &= self.table['File'] >= qd['first']
-        if 'last' in qd:
-            good &= self.table['File'] <= qd['last']
-        # Other constraints
-        good &= np.logical_and.reduce([self.table[k]==v for k,v in qd.items()
-                                       if (k in self.table.colnames and
-                                           k != 'Date')])
-        return self.table[good]
-
-    def file_query(self, qd):
-        # Return a list of filenames matching the query
-        return list(self.query(qd)['File'])
+class ObsLog(obstable.ObsLog):
+    # Imaging frames are not used, other than darks
+    sql_filter = ('"use_me" AND ("Disperser" != \'Open\' OR '
+                  '"ObsType" = \'DARK\')')
+
+    def select(self, obslog):
+        return (super(ObsLog, self).select(obslog) &
+                np.logical_or(obslog['Disperser'] != 'Open',
+                              obslog['ObsType'] == 'DARK'))
 #---------------------------------------------------------------------
-def filelist(prefix, fileList):
-    # Transform python list to comma-separated string
-    return ','.join(str(prefix+f) for f in fileList)
-
-def merge_dicts(dict1, dict2, allow_new=True):
-    # Merge two dicts, optionally allowing/forbidding new keys
-    d = dict1.copy()
-    d.update({k: v for k, v in dict2.items() if (allow_new or k in dict1)})
-    return d
-
-def get_pars(*tasks):
-    # Unlearn tasks and read parameters from yaml file, returning dicts
-    with open('lsTaskPars.yml', 'r') as yf:
-        pars = yaml.safe_load(yf)
-    pkg_dict = {'f2': f2, 'ns': gnirs, 'ge': gemtools}
-    for task in tasks:
-        pkg = pkg_dict.get(task[:2], onedspec)
-        getattr(getattr(pkg, task), 'unlearn')()
-    return [pars[task] for task in tasks]
+images, onedspec, gemini, gemtools, gnirs, f2 = iraf_packages(
+    'images', 'onedspec', 'gemini', 'gemtools', 'gnirs', 'f2')
+
+task_pars = TaskPars('lsTaskPars.yml',
+                     {'f2': f2, 'ns': gnirs, 'ge': gemtools}, onedspec)
+read_pars, get_pars = task_pars.read, task_pars.get
 #----------------------------------------------------------------------
 #---- DON'T EDIT ABOVE THIS LINE UNLESS YOU KNOW WHAT YOU'RE DOING ----
 #----------------------------------------------------------------------
-
 #----------------------- DARKS: See Section 4.3 -----------------------
 def nightlyDarks(obslog):
     dark_dict = {}
     qd = {'ObsType': 'DARK'}
-    configs = unique(obslog.query(qd)['Date', 'Texp'])
-    for (date, t) in configs:
-        darkFiles = obslog.file_query(merge_dicts(qd, {'Date': date,
-                                                       'Texp': t}))
+    for (date, t), darkFiles in obslog.groupby(('Date', 'Texp'), **qd):
         outfile = 'MCdark_'+date.replace('-','')+'_'+str(int(t))
         dark_dict[outfile] = {'input': darkFiles}
     return dark_dict
@@ -100,35 +39,29 @@ def nightlyDarks(obslog):
 def selectDarks(obslog):
     dark_dict = {}
     qd = {'ObsType': 'DARK'}
-    exptimes = set(obslog.query(qd)['Texp'])
-    for t in exptimes:
-        darkFiles = obslog.file_query(merge_dicts(qd, {'Texp': t}))
+    for (t,), darkFiles in obslog.groupby(('Texp',), **qd):
         outfile = 'MCdark_'+str(int(t))
         dark_dict[outfile] = {'input': darkFiles}
     return dark_dict
 
-def reduceDarks(dark_dict):
+def reduceDarks(dark_dict, native=False):
     prepPars, combPars = get_pars('f2prepare', 'gemcombine')
     for outfile, file_dict in dark_dict.items():
         darkFiles = file_dict['input']
-        for f in darkFiles:
-            f2.f2prepare(f, **prepPars)
-        if len(darkFiles) > 1:
+        prepare_frames(darkFiles, prepPars)
+        if len(darkFiles) > 1 and native:
+            combine_frames(['p'+f for f in darkFiles], outfile, **combPars)
+        elif len(darkFiles) > 1:
             gemtools.gemcombine(filelist('p', darkFiles), outfile, **combPars)
         else:
             iraf.imrename('p'+darkFiles[0], outfile)
-    iraf.imdelete('pS*.fits')
-
+    release_frames()
 #----------------------- FLATS: See Section 5.4 -----------------------
 def selectFlats(obslog):
     flat_dict = {}
     qd = {'ObsType': 'FLAT'}
     params = ('Texp', 'Disperser')
-    flatConfigs = unique(obslog.query(qd)[params])
-    for config in flatConfigs:
-        t, grism = config
-        config_dict = dict(zip(params, config))
-        flatFiles = obslog.file_query(merge_dicts(qd, config_dict))
+    for (t, grism), flatFiles in obslog.groupby(params, **qd):
         outfile = 'MCflat_'+grism
         flat_dict[outfile] = {'dark': 'MCdark_'+str(int(t)),
                               'bpm': 'MCbpm_'+grism+'.pl',
@@ -142,22 +75,20 @@ def reduceFlats(flat_dict):
         darkFile = file_dict['dark']
         bpmFile = file_dict['bpm']
         flatFiles = file_dict['input']
-        for f in flatFiles:
-            f2.f2prepare(f, **prepPars)
-            gemtools.gemarith('p'+f, '-', darkFile, 'dp'+f, **arithPars)
-            f2.f2cut('dp'+f, **cutPars)
+        prepare_frames(flatFiles, prepPars, darkFile, arithPars)
+        run_tasks([('f2cut', (filelist('dp', batch),), cutPars)
+                   for batch in frame_batches(flatFiles)])
         flatPars.update({'flatfile': outfile, 'bpmfile': bpmFile})
         gnirs.nsflat(filelist('cdp', flatFiles), **flatPars)
-    iraf.imdelete('pS*.fits,dpS*.fits,cdpS*.fits')
-
+    release_frames()
+    iraf.imdelete('cdpS*.fits')
 #------------------------ ARCS: See Section 5.5 -----------------------
 def selectArcs(obslog):
     arc_dict = {}
     arcFiles = obslog.file_query({'ObsType': 'ARC'})
     params = ('Texp', 'Disperser')
     # Do not stack arcs; reduce each separately
-    for f in arcFiles:
-        t, grism = obslog[f][params]
+    for f, (t, grism) in zip(arcFiles, obslog.lookup(arcFiles, params)):
         outfile = 'arc_'+f
         arc_dict[outfile] = {'dark': 'MCdark_'+str(int(t)),
                              'flat': 'MCflat_'+grism,
@@ -173,9 +104,7 @@ def reduceArcs(arc_dict):
         prepPars['bpm'] = file_dict['bpm']
         flatFile = file_dict['flat']
         arcFiles = file_dict['input']
-        for f in arcFiles:
-            f2.f2prepare(f, **prepPars)
-            gemtools.gemarith('p'+f, '-', darkFile, 'dp'+f, **arithPars)
+        prepare_frames(arcFiles, prepPars, darkFile, arithPars)
         # Flatfields not required for arcs
         if flatFile:
             redPars.update({'fl_flat': 'yes', 'flatimage': flatFile})
@@ -188,13 +117,12 @@ def reduceArcs(arc_dict):
         else:
             gnirs.nswavelength('rdp'+arcFiles[0], outspectra=outfile,
                                **wavePars)
-    iraf.imdelete('*pS*.fits,dpS*.fits')
-
+    release_frames()
+    iraf.imdelete('rdpS*.fits')
 #---------------------- TARGETS: See Section 5.6 ----------------------
 def selectTargets(obslog):
     # Configuation file: see Section 5.2.1
-    with open('lsTargets.yml', 'r') as yf:
-        config = yaml.safe_load(yf)
+    config = load_config('lsTargets.yml')
 
     std_dict = {}
     sci_dict = {}
@@ -222,22 +150,18 @@ def reduceStandards(std_dict):
     redPars['fl_sky'] = 'yes'
     combPars['fl_cross'] = 'yes'
 
-    # Reopen configuation file for additional task parameters
-    with open('lsTargets.yml', 'r') as yf:
-        config = yaml.safe_load(yf)
-
     for outfile, file_dict in std_dict.items():
+        # Additional task parameters for this target, from the config file
+        (config,) = read_config('lsTargets.yml', outfile)
         darkFile = file_dict['dark']
         prepPars['bpm'] = file_dict['bpm']
         flatFile = file_dict['flat']
         arcFile = file_dict['arc']
         stdFiles = file_dict['input']
-        for f in stdFiles:
-            f2.f2prepare(f, **prepPars)
-            gemtools.gemarith('p'+f, '-', darkFile, 'dp'+f, **arithPars)
+        prepare_frames(stdFiles, prepPars, darkFile, arithPars)
 
         # Pull in any additional parameters from config (e.g., skyrange)
-        pars = merge_dicts(redPars, config[outfile].get('nsreduce', {}))
+        pars = merge_dicts(redPars, config.get('nsreduce', {}))
         gnirs.nsreduce(filelist('dp', stdFiles), flatimage=flatFile, **pars)
         gnirs.nscombine(filelist('rdp', stdFiles), output=outfile, **combPars)
 
@@ -245,8 +169,8 @@ def reduceStandards(std_dict):
         gnirs.nstransform('f'+outfile, **transPars)
         gnirs.nsextract('tf'+outfile, **extrPars)
         iraf.imdelete('f'+outfile+',tf'+outfile)
-    iraf.imdelete('pS*.fits,dpS*.fits,rdpS*.fits')
-
+    release_frames()
+    iraf.imdelete('rdpS*.fits')
 #------------------ SCIENCE TARGETS: See Section 5.7 ------------------
 def reduceScience(sci_dict):
     (prepPars, arithPars, fitcooPars, transPars, extrPars, redPars, combPars,
@@ -254,23 +178,19 @@ def reduceScience(sci_dict):
                           'nsextract', 'nsreduce', 'nscombine', 'nstelluric')
     redPars['fl_sky'] = 'yes'
 
-    # Reopen configuation file for additional task parameters
-    with open('lsTargets.yml', 'r') as yf:
-        config = yaml.safe_load(yf)
-
     for outfile, file_dict in sci_dict.items():
+        # Additional task parameters for this target, from the config file
+        (config,) = read_config('lsTargets.yml', outfile)
         darkFile = file_dict['dark']
         prepPars['bpm'] = file_dict['bpm']
         flatFile = file_dict['flat']
         arcFile = file_dict['arc']
         telFile = file_dict['telluric']
         sciFiles = file_dict['input']
-        for f in sciFiles:
-            f2.f2prepare(f, **prepPars)            
-            gemtools.gemarith('p'+f, '-', darkFile, 'dp'+f, **arithPars)
+        prepare_frames(sciFiles, prepPars, darkFile, arithPars)
 
         # Pull in any additional parameters from config (e.g., skyrange)
-        pars = merge_dicts(redPars, config[outfile].get('nsreduce', {}))
+        pars = merge_dicts(redPars, config.get('nsreduce', {}))
         gnirs.nsreduce(filelist('dp', sciFiles), flatimage=flatFile, **pars)
         gnirs.nscombine(filelist('rdp', sciFiles), output=outfile, **combPars)
 
@@ -278,12 +198,12 @@ def reduceScience(sci_dict):
         gnirs.nstransform('f'+outfile, reference='xtf'+telFile, **transPars)
 
         # Pull in any additional parameters from config (e.g., trace)
-        pars = merge_dicts(extrPars, config[outfile].get('nsextract', {}))
+        pars = merge_dicts(extrPars, config.get('nsextract', {}))
         gnirs.nsextract('tf'+outfile, **pars)
         gnirs.nstelluric('xtf'+outfile, 'xtf'+telFile, **telPars)
         iraf.imdelete('f'+outfile+',tf'+outfile)
-    iraf.imdelete('pS*.fits,dpS*.fits,rdpS*.fits')
-
+    release_frames()
+    iraf.imdelete('rdpS*.fits')
 #------------------ FLUX CALIBRATION: See Section 5.8 -----------------
 def fluxCalibrate(sciFile, telFile, spectrum=None,
                   teff=None, jmag=None, hmag=None, kmag=None):
@@ -348,29 +268,47 @@ def fluxCalibrate(sciFile, telFile, spectrum=None,
 
 
 ########################################################################
-def reduce_ls():
-    iraf.imtype = 'fits'
-    rawpath = get_pars('f2prepare')[0]['rawpath']
+def reduce_ls(plan=False, nproc=1, nprep=1, redo=False, trace=True,
+              native=False, logfile=None):
+    rawpath = read_pars('f2prepare')[0]['rawpath']
     # Get observations log and remove unwanted files
-    obslog = ObsLog(os.path.join(rawpath, 'obslog.fits'))
-
-    gnirs.nsheaders('f2')
+    obslog = ObsLog(logfile or find_log(rawpath))
 
     #dark_dict = nightlyDarks(obslog)
     dark_dict = selectDarks(obslog)
-    reduceDarks(dark_dict)
     flat_dict = selectFlats(obslog)
-    reduceFlats(flat_dict)
     arc_dict = selectArcs(obslog)
-    reduceArcs(arc_dict)
     std_dict, sci_dict = selectTargets(obslog)
-    reduceStandards(std_dict)
     sci_dict = {k:v for k,v in sci_dict.items() if k=='epoch2'}
-    reduceScience(sci_dict)
+    if plan:
+        print_plan([('darks', dark_dict), ('flats', flat_dict),
+                    ('arcs', arc_dict), ('standards', std_dict),
+                    ('science', sci_dict)])
+        return
+
+    # Each entry in a reduction dictionary is reduced as soon as the
+    # calibrations it needs have been made, unless nothing it depends on
+    # has changed since it was last reduced
+    schedule = Scheduler(paths=[rawpath])
+    schedule.add_stage(reduceDarks, dark_dict, native=native)
+    schedule.add_stage(reduceFlats, flat_dict, makes=('bpm',))
+    schedule.add_stage(reduceArcs, arc_dict)
+    schedule.add_stage(reduceStandards, std_dict)
+    schedule.add_stage(reduceScience, sci_dict)
 
     for outfile in sci_dict.keys():
-        fluxCalibrate(outfile, 'HD30526', 'F7V_HD126660.txt', hmag=8.537)
+        schedule.add(fluxCalibrate, (outfile, 'HD30526', 'F7V_HD126660.txt'),
+                     {'hmag': 8.537}, needs=(outfile, 'HD30526'),
+                     makes=('flux_'+outfile,), label='flux_'+outfile)
+    schedule.run(nproc, init=init_iraf, nprep=nprep, redo=redo,
+                 trace=trace)
 
 if __name__ == '__main__':
-    reduce_ls()
+    parser = script_parser('Reduce F2 longslit data',
+                           'Combine the darks in python rather than with '
+                           'gemcombine')
+    args = parser.parse_args()
+    reduce_ls(plan=args.plan, nproc=args.nproc, nprep=args.nprep,
+              redo=args.redo, trace=args.trace, native=args.native,
+              logfile=args.obslog)
 
@@ -1,125 +1,57 @@
 #!/usr/bin/env python
-import os, yaml
+import os
 import numpy as np
-from pyraf import iraf
-from pyraf.iraf import images, onedspec, gemini
-from pyraf.iraf import gemtools, gnirs, f2
-from astropy.table import Table, Row, unique
+from combine import combine_frames
+import obstable
+from obstable import find_log
+from pipeline import Scheduler, load_config, release_frames, run_tasks
+from reduction import (TaskPars, filelist, init_iraf, iraf, iraf_packages,
+                       merge_dicts, prepare_frames, print_plan, script_parser)
 from astropy.io import fits
 #---------------------------------------------------------------------
-class Observation(Row):
-    def __init__(self, table, fname):
-        if fname not in table['File']:
-            raise ValueError('{} not found in Observation Log'.format(fname))
-        self._table = table
-        self._index = np.argmax(table['File']==fname)
-
-    def __getitem__(self, item):
-        return self._table[item][self._index]
-
-class ObsLog(object):
-    def __init__(self, fname):
-        # Load observation log and strip trailing spaces from string fields
-        obslog = fname if isinstance(fname, Table) else Table.read(fname)
-        obslog = obslog[obslog['use_me']]
-        obslog = obslog[np.logical_or(obslog['Disperser'] != 'Open',
-                                      obslog['ObsType'] == 'DARK')]
-        for col in obslog.colnames:
-            try:
-                obslog[col] = [v.strip() for v in obslog[col]]
-            except AttributeError:
-                pass
-        self.table = obslog
-
-    def __getitem__(self, fname):
-        # Return table row for a specific filename
-        return Observation(self.table, fname)
-
-    def query(self, qd):
-        # Return obslog rows that match all requirements
-        # Deal with date ranges but don't alter the query dictionary
-        try:
-            date1, date2 = str(qd['Date']).split(':')
-        except ValueError:  # Only one date
-            good = self.table['Date'] == str(qd['Date'])
-        except KeyError:  # No date constraint
-            good = np.array([True] * len(self.table))
-        else:
-            good = np.logical_and(self.table['Date'] >= date1,
-                                  self.table['Date'] <= date2)
-        # Specific observation range
-        if 'first' in qd:
-            good &= self.table['File'] >= qd['first']
-        if 'last' in qd:
-            good &= self.table['File'] <= qd['last']
-        # Other constraints
-        good &= np.logical_and.reduce([self.table[k]==v for k,v in qd.items()
-                                       if (k in self.table.colnames and
-                                           k != 'Date')])
-        return self.table[good]
-
-    def file_query(self, qd):
-        # Return a list of filenames matching the query
-        return list(self.query(qd)['File'])
+class ObsLog(obstable.ObsLog):
+    # Imaging frames are not used, other than darks
+    sql_filter = ('"use_me" AND ("Disperser" != \'Open\' OR '
+                  '"ObsType" = \'DARK\')')
+
+    def select(self, obslog):
+        return (super(ObsLog, self).select(obslog) &
+                np.logical_or(obslog['Disperser'] != 'Open',
+                              obslog['ObsType'] == 'DARK'))
 #---------------------------------------------------------------------
-def filelist(prefix, fileList):
-    # Transform python list to comma-separated string
-    return ','.join(str(prefix+f) for f in fileList)
-
-def merge_dicts(dict1, dict2, allow_new=True):
-    # Merge two dicts, optionally allowing/forbidding new keys
-    d = dict1.copy()
-    d.update({k: v for k, v in dict2.items() if (allow_new or k in dict1)})
-    return d
-
-def get_pars(*tasks):
-    # Unlearn tasks and read parameters from yaml file, returning dicts
-    with open('mosTaskPars.yml', 'r') as yf:
-        pars = yaml.safe_load(yf)
-    pkg_dict = {'f2': f2, 'ns': gnirs, 'ge': gemtools}
-    for task in tasks:
-        pkg = pkg_dict.get(task[:2], onedspec)
-        getattr(getattr(pkg, task), 'unlearn')()
-    return [pars[task] for task in tasks]
+images, onedspec, gemini, gemtools, gnirs, f2 = iraf_packages(
+    'images', 'onedspec', 'gemini', 'gemtools', 'gnirs', 'f2')
+
+task_pars = TaskPars('mosTaskPars.yml',
+                     {'f2': f2, 'ns': gnirs, 'ge': gemtools}, onedspec)
+read_pars, get_pars = task_pars.read, task_pars.get
+
+def update_header(fname, ext, cards):
+    # Set keywords in one extension of a FITS file, given as (keyword,
+    # value) or (keyword, value, comment) tuples, writing the file once
+    with fits.open(fname, mode='update') as hdulist:
+        hdulist[ext].header.update(cards)
 
 def apply_fitcoords(infile, telFile, database):
     # Copy header keywords from one frame to another
-    gemtools.gemhedit.upfile = ''
-    gemtools.gemhedit(infile+'[0]', 'NSFITCOO', 'N/A',
-                      'UT Time stamp for NSFITCOORDS')
+    update_header(infile+'.fits', 0, [('NSFITCOO', 'N/A',
+                                       'UT Time stamp for NSFITCOORDS')])
     os.rename(infile+'.fits', 'f'+infile+'.fits')
-    infile = 'f'+infile+'[SCI]'
-    gemtools.gemhedit(infile, 'FCDB', database, '')
-    gemtools.gemhedit(infile, 'FCFIT1','f'+telFile+'_SCI_1_lamp', '')
-    gemtools.gemhedit(infile, 'FCX1', 1, '')
-    images.imutil.imgets(infile, 'naxis1')
-    nx = images.imutil.imgets.value
-    gemtools.gemhedit(infile, 'FCX2', nx, '')
-    gemtools.gemhedit(infile, 'FCNX', nx, '')
-
-def make_contiguous_lists(files):
-    # Turn a list of input files into multiple lists of contiguously-named ones
-    lists = []
-    this_list = [files.pop(0)]
-    while files:
-        next_item = files.pop(0)
-        if (next_item[:10] == this_list[-1][:10] and
-            int(next_item[-4:]) == int(this_list[-1][-4:])+1):
-            this_list.append(next_item)
-        else:
-            lists.append(this_list)
-            this_list = [next_item]
-    lists.append(this_list)
-    return lists
-
-def check_cals(input_dict):
-    # Check that calibration files exist
+    infile = 'f'+infile+'.fits'
+    nx = fits.getval(infile, 'NAXIS1', 'SCI')
+    update_header(infile, 'SCI', [('FCDB', database),
+                                  ('FCFIT1', 'f'+telFile+'_SCI_1_lamp'),
+                                  ('FCX1', 1), ('FCX2', nx), ('FCNX', nx)])
+
+def check_cals(input_dict, to_make=()):
+    # Check that calibration files exist (or will be made by earlier steps)
     all_ok = True
     for k1, v1 in input_dict.items():
         for k2, v2 in v1.items():
             if k2 not in ('input', 'slitim', 'bpm'):
                 fname = v2 if '.' in v2 else v2+'.fits'
-                if not (os.path.exists(fname) or fname.startswith('S20')):
+                if not (os.path.exists(fname) or fname.startswith('S20') or
+                        os.path.splitext(fname)[0] in to_make):
                     all_ok = False
                     print "{} does not exist (used for {})".format(fname, k1)
     if not all_ok:
@@ -127,31 +59,28 @@ def check_cals(input_dict):
 #----------------------------------------------------------------------
 #---- DON'T EDIT ABOVE THIS LINE UNLESS YOU KNOW WHAT YOU'RE DOING ----
 #----------------------------------------------------------------------
-
 #----------------------- DARKS: See Section 6.3 -----------------------
 def selectDarks(obslog):
     # Make a dict: key=output dark file; value=input files
     dark_dict = {}
     qd = {'ObsType': 'DARK'}
-    exptimes = set(obslog.query(qd)['Texp'])
-    for t in exptimes:
-        darkFiles = obslog.file_query(merge_dicts(qd, {'Texp': t}))
+    for (t,), darkFiles in obslog.groupby(('Texp',), **qd):
         outfile = 'MCdark_'+str(int(t))
         dark_dict[outfile] = {'input': darkFiles}
     return dark_dict
 
-def reduceDarks(dark_dict):
+def reduceDarks(dark_dict, native=False):
     prepPars, combPars = get_pars('f2prepare', 'gemcombine')
     for outfile, file_dict in dark_dict.items():
         darkFiles = file_dict['input']
-        for f in darkFiles:
-            f2.f2prepare(f, **prepPars)
-        if len(darkFiles) > 1:
+        prepare_frames(darkFiles, prepPars)
+        if len(darkFiles) > 1 and native:
+            combine_frames(['p'+f for f in darkFiles], outfile, **combPars)
+        elif len(darkFiles) > 1:
             gemtools.gemcombine(filelist('p', darkFiles), outfile, **combPars)
         else:
             iraf.imrename('p'+darkFiles[0], outfile)
-    iraf.imdelete('pS*.fits')
-
+    release_frames()
 #----------------------- FLATS: See Section 6.4 -----------------------
 def selectFlats(obslog):
     # key=(output flat, output bpm); value=[dark, [input files]]
@@ -159,11 +88,7 @@ def selectFlats(obslog):
     mos_flat_dict = {}
     qd = {'ObsType': 'FLAT', 'GCAL Shutter': 'OPEN'}
     params = ('Texp', 'Disperser', 'Mask', 'Filter')
-    flatConfigs = unique(obslog.query(qd)[params])
-    for config in flatConfigs:
-        t, grism, mask, filt = config
-        config_dict = dict(zip(params, config))
-        flatFiles = sorted(obslog.file_query(merge_dicts(qd, config_dict)))
+    for (t, grism, mask, filt), flatFiles in obslog.groupby(params, **qd):
         # This format for MCdark files is suitable for nightly darks
         file_dict = {'dark': 'MCdark_'+str(int(t)),
                      'bpm': 'MCbpm_{}_{}.pl'.format(grism, filt)}
@@ -175,7 +100,7 @@ def selectFlats(obslog):
             ls_flat_dict[outfile] = file_dict.copy()
         else:
             # Find groups of flats and combine each group
-            for infiles in make_contiguous_lists(flatFiles):
+            for infiles in obslog.contiguous(flatFiles):
                 file_dict['input'] = infiles
                 seq = infiles[0]
                 if len(infiles) > 1:
@@ -185,7 +110,6 @@ def selectFlats(obslog):
                 mos_flat_dict[outfile] = merge_dicts(file_dict,
                                                      {'slitim': slitFile})
     return ls_flat_dict, mos_flat_dict
-
 #-------------------- LS FLATS: See Section 6.4.1 ----------------------
 def reduceLSFlats(flat_dict):
     prepPars, cutPars, arithPars, flatPars, combPars = get_pars('f2prepare',
@@ -194,14 +118,13 @@ def reduceLSFlats(flat_dict):
         darkFile = file_dict['dark']
         bpmFile = file_dict['bpm']
         flatFiles = file_dict['input']
-        for f in flatFiles:
-            f2.f2prepare(f, **prepPars)
-            gemtools.gemarith('p'+f, '-', darkFile, 'dp'+f, **arithPars)
-            f2.f2cut('dp'+f, **cutPars)
+        prepare_frames(flatFiles, prepPars, darkFile, arithPars)
+        run_tasks([('f2cut', (filelist('dp', batch),), cutPars)
+                   for batch in frame_batches(flatFiles)])
         flatPars.update({'flatfile': outfile, 'bpmfile': bpmFile})
         gnirs.nsflat(filelist('cdp', flatFiles), **flatPars)
-    iraf.imdelete('pS*.fits,dpS*.fits,cdpS*.fits')
-
+    release_frames()
+    iraf.imdelete('cdpS*.fits')
 #------------------- MOS FLATS: See Section 6.4.2 ---------------------
 def reduceMOSFlats(flat_dict):
     prepPars, cutPars, arithPars, flatPars, combPars, sdistPars = get_pars('f2prepare',
@@ -213,9 +136,8 @@ def reduceMOSFlats(flat_dict):
         refImage = file_dict.get('reference', '')
         flatFiles = file_dict['input']
         nsflat_inputs = filelist('cdp', flatFiles)
-        for f in flatFiles:
-            f2.f2prepare(f, **merge_dicts(prepPars, {'bpm': bpmFile}))
-            gemtools.gemarith('p'+f, '-', darkFile, 'dp'+f, **arithPars)
+        prepare_frames(flatFiles, merge_dicts(prepPars, {'bpm': bpmFile}),
+                       darkFile, arithPars)
         if not refImage:
             if len(flatFiles) > 1:
                 # Stack images and use this to make reference
@@ -243,32 +165,29 @@ def reduceMOSFlats(flat_dict):
         gnirs.nsflat(nsflat_inputs, **flatPars)
 
         iraf.imdelete('stack.fits')
-    iraf.imdelete('pS*.fits,dpS*.fits,cdpS*.fits')
-
+    release_frames()
+    iraf.imdelete('cdpS*.fits')
 #------------------------ ARCS: See Section 6.5 -----------------------
 def selectArcs(obslog):
-    with open('mosTargets.yml', 'r') as yf:
-        config = yaml.safe_load(yf)
+    config = load_config('mosTargets.yml')
 
     ls_arc_dict = {}
     mos_arc_dict = {}
     arcFiles = obslog.file_query({'ObsType': 'ARC'})
     params = ('Texp', 'Disperser', 'Mask', 'Filter')
     # Do not stack arcs; reduce each separately
-    for f in arcFiles:
-        t, grism, mask, filt = obslog[f][params]
+    for f, (t, grism, mask, filt) in zip(arcFiles,
+                                         obslog.lookup(arcFiles, params)):
         file_dict = {'dark': 'MCdark_'+str(int(t)),
                      'bpm': 'MCbpm_{}_{}'.format(grism, filt),
                      'input': [f]}
         outfile = 'arc_'+f
 
-        possible_flats = obslog.file_query({'ObsType': 'FLAT',
-                                            'GCAL Shutter': 'CLOSED',
-                                            'Texp': t})
-        for flat in possible_flats:
-            if flat[:10] == f[:10] and abs(int(flat[10:])-int(f[10:])) == 1:
-                file_dict['dark'] = flat
-                break
+        # Use a lamp-off flat taken immediately before or after the arc
+        flats = obslog.adjacent({'ObsType': 'FLAT', 'GCAL Shutter': 'CLOSED',
+                                 'Texp': t}, to=f)
+        if flats:
+            file_dict['dark'] = flats[0]
 
         if 'pix-slit' in mask:
             file_dict['flat'] = 'MCflat_{}_{}'.format(grism, filt)
@@ -297,14 +216,13 @@ def reduceArcs(arc_dict):
         refFile = file_dict.get('reference', '')
         bpmFile = file_dict['bpm']
         arcFiles = file_dict['input']
-        for f in arcFiles:
-            f2.f2prepare(f, **merge_dicts(prepPars, {'bpm': bpmFile}))
-            # K-band arcs may have a single exposure to remove thermal emission
-            # so that exposure will need to be prepared
-            if darkFile.startswith('S20'):
-                f2.f2prepare(darkFile, **merge_dicts(prepPars, {'bpm': bpmFile}))
-                darkFile = 'p'+darkFile
-            gemtools.gemarith('p'+f, '-', darkFile, 'dp'+f, **arithPars)
+        # K-band arcs may have a single exposure to remove thermal emission
+        # so that exposure will need to be prepared
+        if darkFile.startswith('S20'):
+            prepare_frames([darkFile], merge_dicts(prepPars, {'bpm': bpmFile}))
+            darkFile = 'p'+darkFile
+        prepare_frames(arcFiles, merge_dicts(prepPars, {'bpm': bpmFile}),
+                       darkFile, arithPars)
         # Flatfields not required for arcs
         if flatFile:
             redPars.update({'fl_flat': 'yes', 'flatimage': flatFile})
@@ -325,13 +243,12 @@ def reduceArcs(arc_dict):
             wavePars.update({'step': 5})
         gnirs.nswavelength(arc, outspectra=outfile, **wavePars)
         iraf.imdelete(arc)
-    iraf.imdelete('*pS*.fits,dpS*.fits')
-
+    release_frames()
+    iraf.imdelete('rdpS*.fits')
 #---------------------- TARGETS: See Section 6.6 ----------------------
 def selectTargets(obslog):
     # Configuation file: see Section 5.2.1
-    with open('mosTargets.yml', 'r') as yf:
-        config = yaml.safe_load(yf)
+    config = load_config('mosTargets.yml')
 
     # key=output file; value=[dark, flat, bpm, arc, [input files]]
     std_dict = {}
@@ -365,22 +282,18 @@ def reduceStandards(std_dict):
     redPars['fl_sky'] = 'yes'
     combPars['fl_cross'] = 'yes'
 
-    # Reopen configuation file for additional task parameters
-    with open('mosTargets.yml', 'r') as yf:
-        config = yaml.safe_load(yf)
-
     for outfile, file_dict in std_dict.items():
+        # Additional task parameters for this target, from the config file
+        (config,) = read_config('mosTargets.yml', outfile)
         darkFile = file_dict['dark']
         flatFile = file_dict['flat']
         arcFile = file_dict['arc']
         prepPars['bpm'] = file_dict['bpm']
         stdFiles = file_dict['input']
-        for f in stdFiles:
-            f2.f2prepare(f, **prepPars)
-            gemtools.gemarith('p'+f, '-', darkFile, 'dp'+f, **arithPars)
+        prepare_frames(stdFiles, prepPars, darkFile, arithPars)
 
         # Pull in any additional parameters from config (e.g., skyrange)
-        pars = merge_dicts(redPars, config[outfile].get('nsreduce', {}))
+        pars = merge_dicts(redPars, config.get('nsreduce', {}))
         gnirs.nsreduce(filelist('dp', stdFiles), flatimage=flatFile, **pars)
         gnirs.nscombine(filelist('rdp', stdFiles), output=outfile, **combPars)
 
@@ -388,7 +301,8 @@ def reduceStandards(std_dict):
         gnirs.nstransform('f'+outfile, **transPars)
         gnirs.nsextract('tf'+outfile, **extrPars)
         iraf.imdelete('f'+outfile+',tf'+outfile)
-    iraf.imdelete('pS*.fits,dpS*.fits,rdpS*.fits')
+    release_frames()
+    iraf.imdelete('rdpS*.fits')
 
 def reduceScience(sci_dict):
     (prepPars, arithPars, fitcooPars, transPars, extrPars, redPars, combPars,
@@ -396,11 +310,9 @@ def reduceScience(sci_dict):
                           'nsextract', 'nsreduce', 'nscombine', 'nstelluric')
     redPars['fl_sky'] = 'yes'
 
-    # Reopen configuation file for additional task parameters
-    with open('mosTargets.yml', 'r') as yf:
-        config = yaml.safe_load(yf)
-
     for outfile, file_dict in sci_dict.items():
+        # Additional task parameters for this target, from the config file
+        (config,) = read_config('mosTargets.yml', outfile)
         prepPars['bpm'] = file_dict['bpm']
         darkFile = file_dict['dark']
         flatFile = file_dict['flat']
@@ -410,17 +322,17 @@ def reduceScience(sci_dict):
         telFile = file_dict['telluric']
         sciFiles = file_dict['input']
 
-        for f in sciFiles:
-            f2.f2prepare(f, **prepPars)            
-            gemtools.gemarith('p'+f, '-', darkFile, 'dp'+f, **arithPars)
+        prepare_frames(sciFiles, prepPars, darkFile, arithPars)
 
         # Pull in any additional parameters from config (e.g., skyrange)
         redPars.update({'flatimage': flatFile, 'refimage': refFile})
-        pars = merge_dicts(redPars, config[outfile].get('nsreduce', {}))
+        pars = merge_dicts(redPars, config.get('nsreduce', {}))
         gnirs.nsreduce(filelist('dp', sciFiles), **pars)
 
         # If nodding off slit, you need to select only the on-source frames!
-        sciFiles = [f for f in sciFiles if abs(obslog[f]['Dec Offset']) < 20]
+        offsets = obslog.lookup(sciFiles, 'Dec Offset')
+        sciFiles = [f for f, offset in zip(sciFiles, offsets)
+                    if abs(offset) < 20]
         gnirs.nscombine(filelist('rdp', sciFiles), output=outfile, **combPars)
 
         fitcooPars.update({'lamptransf': arcFile, 'sdisttransf': slitsFile,
@@ -430,11 +342,12 @@ def reduceScience(sci_dict):
         gnirs.nstransform('f'+outfile, **transPars)
 
         # Pull in any additional parameters from config (e.g., trace)
-        pars = merge_dicts(extrPars, config[outfile].get('nsextract', {}))
+        pars = merge_dicts(extrPars, config.get('nsextract', {}))
         gnirs.nsextract('tf'+outfile, **pars)
         gnirs.nstelluric('xtf'+outfile, 'xtf'+telFile, **telPars)
         iraf.imdelete('f'+outfile+',tf'+outfile)
-    iraf.imdelete('pS*.fits,dpS*.fits,rdpS*.fits')
+    release_frames()
+    iraf.imdelete('rdpS*.fits')
 
 def reduceABBAScience(sci_dict):
     (prepPars, arithPars, fitcooPars, transPars, extrPars, redPars, combPars,
@@ -442,11 +355,9 @@ def reduceABBAScience(sci_dict):
                           'nsextract', 'nsreduce', 'gemcombine', 'nscombine', 'nstelluric')
     redPars['fl_sky'] = 'yes'
 
-    # Reopen configuation file for additional task parameters
-    with open('mosTargets.yml', 'r') as yf:
-        config = yaml.safe_load(yf)
-
     for outfile, file_dict in sci_dict.items():
+        # Additional task parameters for this target, from the config file
+        (config,) = read_config('mosTargets.yml', outfile)
         prepPars['bpm'] = file_dict['bpm']
         darkFile = file_dict['dark']
         flatFile = file_dict['flat']
@@ -456,13 +367,11 @@ def reduceABBAScience(sci_dict):
         telFile = file_dict['telluric']
         sciFiles = file_dict['input']
 
-        for f in sciFiles:
-            f2.f2prepare(f, **prepPars)            
-            gemtools.gemarith('p'+f, '-', darkFile, 'dp'+f, **arithPars)
+        prepare_frames(sciFiles, prepPars, darkFile, arithPars)
 
         # Pull in any additional parameters from config (e.g., skyrange)
         redPars.update({'flatimage': flatFile, 'refimage': refFile})
-        pars = merge_dicts(redPars, config[outfile].get('nsreduce', {}))
+        pars = merge_dicts(redPars, config.get('nsreduce', {}))
         gnirs.nsreduce(filelist('dp', sciFiles), **pars)
 
         # Make A and B stacks and subtract
@@ -476,10 +385,9 @@ def reduceABBAScience(sci_dict):
         gemtools.gemcombine('@offsetlist', 'Bpos', **combPars)
         gemtools.gemarith('Apos', '-', 'Bpos', outfile, **arithPars)
         iraf.delete('targetlist,offsetlist')
-        images.imutil.imgets('Bpos[0]', 'xoffset')
-        xoffset = float(images.imutil.imgets.value)
-        images.imutil.imgets('Bpos[0]', 'yoffset')
-        yoffset = float(images.imutil.imgets.value)
+        header = fits.getheader('Bpos.fits')
+        xoffset = float(header['XOFFSET'])
+        yoffset = float(header['YOFFSET'])
         iraf.imdelete('Apos,Bpos')
 
         fitcooPars.update({'lamptransf': arcFile, 'sdisttransf': slitsFile,
@@ -488,15 +396,15 @@ def reduceABBAScience(sci_dict):
         transPars['reference'] = 'xtf'+telFile
         gnirs.nstransform('f'+outfile, **transPars)
         # Pull in any additional parameters from config (e.g., trace)
-        pars = merge_dicts(extrPars, config[outfile].get('nsextract', {}))
+        pars = merge_dicts(extrPars, config.get('nsextract', {}))
 
         # Make inverted image and give it the correct offsets so
         # nscombine will shift it onto the positive image
         if abs(xoffset) < 20:
             negfile = 'neg_tf'+outfile
             gemtools.gemarith('tf'+outfile, '*', -1, negfile, **arithPars)
-            gemtools.gemhedit(negfile+'[0]', 'XOFFSET', xoffset, '')
-            gemtools.gemhedit(negfile+'[0]', 'YOFFSET', yoffset, '')
+            update_header(negfile+'.fits', 0, [('XOFFSET', xoffset),
+                                               ('YOFFSET', yoffset)])
             nscombPars['boundary'] = 'constant'
             gnirs.nscombine('tf'+outfile+','+negfile, **nscombPars)
             gnirs.nsextract('tf'+outfile+'_comb', outspectra='xtf'+outfile,
@@ -505,8 +413,8 @@ def reduceABBAScience(sci_dict):
             gnirs.nsextract('tf'+outfile, **pars)
         gnirs.nstelluric('xtf'+outfile, 'xtf'+telFile, **telPars)
         iraf.imdelete('f'+outfile+',tf'+outfile)
-    iraf.imdelete('pS*.fits,dpS*.fits,rdpS*.fits')
-
+    release_frames()
+    iraf.imdelete('rdpS*.fits')
 #------------------ FLUX CALIBRATION: See Section 6.8 -----------------
 def fluxCalibrate(sciFile, telFile, spectrum=None,
                   teff=None, jmag=None, hmag=None, kmag=None):
@@ -571,39 +479,56 @@ def fluxCalibrate(sciFile, telFile, spectrum=None,
 
 
 ########################################################################
-def reduce_mos():
+def reduce_mos(plan=False, nproc=1, nprep=1, redo=False, trace=True,
+               native=False, logfile=None):
     global obslog
-    iraf.imtype = 'fits'
-    rawpath = get_pars('f2prepare')[0]['rawpath']
+    rawpath = read_pars('f2prepare')[0]['rawpath']
     # Get observations log and remove unwanted files
-    obslog = ObsLog(os.path.join(rawpath, 'obslog.fits'))
-
-    gnirs.nsheaders('f2')
+    obslog = ObsLog(logfile or find_log(rawpath))
 
     dark_dict = selectDarks(obslog)
-    reduceDarks(dark_dict)
-
     ls_flat_dict, mos_flat_dict = selectFlats(obslog)
-    reduceLSFlats(ls_flat_dict)
     # Here's how to remove entries in a reduction dictionary
     #del mos_flat_dict['flat_S20190809S0107_0111']  # too bright
     #del mos_flat_dict['flat_S20190809S0126']       # too bright
     #del mos_flat_dict['flat_S20190702S0693']       # not required
     #del mos_flat_dict['flat_S20190701S0100']       # not required
-    check_cals(mos_flat_dict)
-    reduceMOSFlats(mos_flat_dict)
-    
     ls_arc_dict, mos_arc_dict = selectArcs(obslog)
-    reduceArcs(ls_arc_dict)
-    reduceArcs(mos_arc_dict)
-
     std_dict, sci_dict = selectTargets(obslog)
-    reduceStandards(std_dict)
-    reduceScience(sci_dict)
+    if plan:
+        print_plan([('darks', dark_dict), ('LS flats', ls_flat_dict),
+                    ('MOS flats', mos_flat_dict), ('LS arcs', ls_arc_dict),
+                    ('MOS arcs', mos_arc_dict), ('standards', std_dict),
+                    ('science', sci_dict)])
+        return
+
+    # Each entry in a reduction dictionary is reduced as soon as the
+    # calibrations it needs have been made, unless nothing it depends on
+    # has changed since it was last reduced
+    schedule = Scheduler(paths=[rawpath])
+    schedule.add_stage(reduceDarks, dark_dict, native=native)
+
+    schedule.add_stage(reduceLSFlats, ls_flat_dict, makes=('bpm',))
+    check_cals(mos_flat_dict, schedule.outputs())
+    schedule.add_stage(reduceMOSFlats, mos_flat_dict, makes=('slitim',))
+    
+    schedule.add_stage(reduceArcs, ls_arc_dict)
+    schedule.add_stage(reduceArcs, mos_arc_dict)
+
+    schedule.add_stage(reduceStandards, std_dict)
+    schedule.add_stage(reduceScience, sci_dict)
+    schedule.run(nproc, init=init_iraf, nprep=nprep, redo=redo,
+                 trace=trace)
     # If you want to call nstelluric separately
     #(telPars,) = get_pars('nstelluric')
     #gnirs.nstelluric('xtfS5_K', 'xtfHD152602K', **telPars)
 
 if __name__ == '__main__':
-    reduce_mos()
+    parser = script_parser('Reduce F2 MOS data',
+                           'Combine the darks in python rather than with '
+                           'gemcombine')
+    args = parser.parse_args()
+    reduce_mos(plan=args.plan, nproc=args.nproc, nprep=args.nprep,
+               redo=args.redo, trace=args.trace, native=args.native,
+               logfile=args.obslog)
 
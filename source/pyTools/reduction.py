@@ -0,0 +1,142 @@
+# Helpers shared by the reduce_*.py scripts: loading IRAF when it is first
+# needed, reading task parameters, preparing frames, and the command line.
+# This file must be in the same directory as the reduce_*.py scripts.
+import argparse
+import yaml
+from pipeline import (cache_key, cached_frames, frame_batches, map_frames,
+                      read_config)
+
+class IRAFPackage(object):
+    # Stand-in for the iraf module or one of its packages. PyRAF is only
+    # imported, and the packages used by the script loaded (see
+    # iraf_packages()), when something is first needed from IRAF, so the
+    # selection functions can be used without it
+    packages = ()
+    loaded = set()
+    iraf = None
+
+    def __init__(self, name=None):
+        self.__dict__['_name'] = name
+
+    def _load(self):
+        if IRAFPackage.iraf is None:
+            from pyraf import iraf
+            IRAFPackage.iraf = iraf
+        for pkg in self.packages + ((self._name,) if self._name else ()):
+            if pkg not in IRAFPackage.loaded:
+                __import__('pyraf.iraf', fromlist=[pkg])
+                IRAFPackage.loaded.add(pkg)
+        if self._name is None:
+            return IRAFPackage.iraf
+        return getattr(IRAFPackage.iraf, self._name)
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+def iraf_packages(*names):
+    # Return stand-ins for the IRAF packages used by a script, which are
+    # all loaded, in this order, when something is first needed from IRAF
+    for name in names:
+        if name not in IRAFPackage.packages:
+            IRAFPackage.packages += (name,)
+    return [IRAFPackage(name) for name in names]
+
+# The packages used here, which the scripts also use
+iraf = IRAFPackage()
+gemtools, gnirs, f2 = [IRAFPackage(pkg) for pkg in ('gemtools', 'gnirs', 'f2')]
+
+def filelist(prefix, fileList):
+    # Transform python list to comma-separated string
+    return ','.join(str(prefix+f) for f in fileList)
+
+def merge_dicts(dict1, dict2, allow_new=True):
+    # Merge two dicts, optionally allowing/forbidding new keys
+    d = dict1.copy()
+    d.update({k: v for k, v in dict2.items() if (allow_new or k in dict1)})
+    return d
+
+# Tasks that have been unlearned by this process
+unlearned = set()
+
+class TaskPars(object):
+    # The parameters of the IRAF tasks used by a script, from its yaml
+    # file. Each task is in the package given by the first two letters of
+    # its name in the packages dict, or else in the default package
+    def __init__(self, fname, packages, default):
+        self.fname = fname
+        self.packages = packages
+        self.default = default
+
+    def read(self, *tasks):
+        # Read parameters from yaml file, returning dicts
+        return read_config(self.fname, *tasks)
+
+    def get(self, *tasks):
+        # Unlearn tasks (the first time they're used) and read parameters
+        # from yaml file, returning dicts
+        for task in set(tasks) - unlearned:
+            pkg = self.packages.get(task[:2], self.default)
+            getattr(getattr(pkg, task), 'unlearn')()
+            unlearned.add(task)
+        return self.read(*tasks)
+
+def prepare_batch(files, prepPars, darkFile=None, arithPars=None):
+    # Prepare a list of raw frames and subtract a dark from them, if one is
+    # given, with one call to each task for all the frames that aren't in
+    # the cache already (from earlier steps with the same inputs)
+    def prepare(indices):
+        f2.f2prepare(filelist('', [files[i] for i in indices]), **prepPars)
+
+    def subtract(indices):
+        inputs = [files[i] for i in indices]
+        gemtools.gemarith(filelist('p', inputs), '-', darkFile,
+                          filelist('dp', inputs), **arithPars)
+
+    keys = [cache_key([f, prepPars], files=[f, prepPars.get('bpm')],
+                      paths=[prepPars['rawpath']]) for f in files]
+    cached_frames(['p'+f for f in files], keys, prepare)
+    if darkFile:
+        keys = [cache_key([key, darkFile, arithPars], files=[darkFile])
+                for key in keys]
+        cached_frames(['dp'+f for f in files], keys, subtract)
+
+def prepare_frames(files, prepPars, darkFile=None, arithPars=None):
+    # Run prepare_batch() on a list of frames, split between processes if
+    # possible
+    map_frames(prepare_batch, [(batch, prepPars, darkFile, arithPars)
+                               for batch in frame_batches(files)])
+
+def init_iraf():
+    # Settings needed before running any IRAF tasks
+    iraf.imtype = 'fits'
+    gnirs.nsheaders('f2')
+
+def print_plan(stages):
+    # Print the reduction dictionaries that would be passed to each step
+    for name, red_dict in stages:
+        print('# {}'.format(name))
+        print(yaml.safe_dump(red_dict, default_flow_style=False))
+
+def script_parser(description, native_help):
+    # Return a parser for the command-line options that all the scripts
+    # have, to which a script can add its own
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--plan', action='store_true',
+                        help='Show what would be reduced, without using IRAF')
+    parser.add_argument('-j', '--nproc', type=int, default=1,
+                        help='Number of reduction steps to run at once')
+    parser.add_argument('-p', '--nprep', type=int, default=1,
+                        help='Number of frames to prepare at once, when '
+                        'the steps are run one at a time')
+    parser.add_argument('--obslog', help='Observation log to use (default: '
+                        'obslog.fits, or else obslog.db, in the rawpath '
+                        'directory)')
+    parser.add_argument('--redo', action='store_true',
+                        help='Run every step, even if it is up to date')
+    parser.add_argument('--no-trace', dest='trace', action='store_false',
+                        help='Do not time the steps and IRAF tasks')
+    parser.add_argument('--native', action='store_true', help=native_help)
+    return parser
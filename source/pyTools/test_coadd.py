@@ -0,0 +1,42 @@
+# Tests for coadd.py. Run with: python -m pytest
+import numpy as np
+from astropy.io import fits
+
+import coadd
+
+def write_frames(n, shape=(12, 10)):
+    # Write n MEF frames of noise, with the same WCS and no VAR or DQ
+    rng = np.random.RandomState(2)
+    header = fits.Header()
+    header.update({'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN',
+                   'CRVAL1': 10., 'CRVAL2': -20., 'CRPIX1': 5.,
+                   'CRPIX2': 6., 'CDELT1': -4e-5, 'CDELT2': 4e-5})
+    fileList = []
+    for i in range(n):
+        sci = rng.normal(100., 10., shape).astype(np.float32)
+        fname = 'frame{}.fits'.format(i)
+        fits.HDUList([fits.PrimaryHDU(),
+                      fits.ImageHDU(sci, header=header,
+                                    name='SCI')]).writeto(fname)
+        fileList.append(fname)
+    return fileList
+
+def strip_coadd(fname):
+    # Remove the VAR and DQ extensions from a coadd, like those of imcoadd
+    with fits.open(fname) as hdulist:
+        fits.HDUList(hdulist[:2]).writeto(fname, overwrite=True)
+
+def test_merge_without_var(tmpdir):
+    # Merging coadds of groups of different sizes with no variances gives
+    # the same image as coadding all the frames at once
+    tmpdir.chdir()
+    fileList = write_frames(7)
+    coadd.coadd_frames(fileList, 'all', reject='none', nthreads=1)
+    coadd.coadd_frames(fileList[:4], 'group1', reject='none', nthreads=1)
+    coadd.coadd_frames(fileList[4:], 'group2', reject='none', nthreads=1)
+    for fname in ('group1.fits', 'group2.fits'):
+        strip_coadd(fname)
+    coadd.merge_coadds(['group1', 'group2'], 'merged', nthreads=1)
+    merged = fits.getdata('merged.fits', 'SCI')
+    assert np.allclose(merged, fits.getdata('all.fits', 'SCI'), rtol=1e-6)
+    assert fits.getheader('merged.fits')['NCOMBINE'] == 7
@@ -0,0 +1,33 @@
+# Tests for imreduce.py. Run with: python -m pytest
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import imreduce
+
+def write_frames(n, shape=(20, 16)):
+    # Write n MEF frames of noise on a sky level, with a star in each,
+    # dithered from frame to frame
+    rng = np.random.RandomState(1)
+    fileList = []
+    for i in range(n):
+        sci = rng.normal(100. + i, 3., shape).astype(np.float32)
+        sci[2 + 2 * i % (shape[0] - 4), 4:7] += 200.
+        fname = 'frame{}.fits'.format(i)
+        fits.HDUList([fits.PrimaryHDU(),
+                      fits.ImageHDU(sci, name='SCI')]).writeto(fname)
+        fileList.append(fname)
+    return fileList
+
+@pytest.mark.parametrize('niter', [1, 2, 3, 4])
+@pytest.mark.parametrize('n', [5, 7, 12])
+def test_running_skies(tmpdir, n, niter):
+    # Running skies from the nearest frame can be made with any number of
+    # iterations of object masking
+    tmpdir.chdir()
+    fileList = write_frames(n)
+    outfiles = ['sky{}'.format(i) for i in range(n)]
+    imreduce.make_sky(fileList, outfiles, window=1, niter=niter, ngrow=1)
+    for outfile in outfiles:
+        with fits.open(outfile + '.fits') as hdulist:
+            assert hdulist[0].header['NCOMBINE'] == 1
@@ -0,0 +1,47 @@
+# Tests for obslog.py. Run with: python -m pytest
+import pytest
+from astropy.io import fits
+
+import obslog
+
+def write_frame(fname, **cards):
+    # Write a FITS file with only a primary header, with some keywords
+    header = fits.Header()
+    for kw, value in cards.items():
+        header[kw] = value
+    fits.PrimaryHDU(header=header).writeto(fname)
+
+def make_log(fileList):
+    # Make a log of the files from scratch
+    return obslog.make_table(fileList, obslog.scan_files(fileList),
+                             *obslog.file_stats(fileList))
+
+@pytest.mark.parametrize('ext', ['.fits', '.db'])
+@pytest.mark.parametrize('old_cards, new_cards', [
+    # A keyword that is missing from the new files, or only in them
+    ({'AIRMASS': 1.2, 'EXPTIME': 10.}, {'EXPTIME': 10}),
+    ({'OBJECT': 'dark'}, {'OBJECT': 'dark', 'AIRMASS': 1.2, 'EXPTIME': 3.}),
+])
+def test_update_mixed_types(tmpdir, ext, old_cards, new_cards):
+    # An update where the new files give a column a different type gives
+    # the same log as reading all the files at once
+    tmpdir.chdir()
+    oldFiles = ['S20180101S0001.fits', 'S20180101S0002.fits']
+    newFiles = ['S20180101S0003.fits']
+    for fname in oldFiles:
+        write_frame(fname, **old_cards)
+    dbFile = 'obslog' + ext
+    obslog.write_log(make_log(oldFiles), dbFile)
+    for fname in newFiles:
+        write_frame(fname, **new_cards)
+    updated = obslog.update_table(obslog.read_log(dbFile),
+                                  oldFiles + newFiles)
+    obslog.write_log(updated, dbFile)
+    obslog.write_log(make_log(oldFiles + newFiles), 'full' + ext)
+    expected = obslog.read_log('full' + ext)
+    updated = obslog.read_log(dbFile)
+    assert updated.colnames == expected.colnames
+    for c in expected.colnames:
+        if c != 'MTime':
+            assert updated[c].dtype.kind == expected[c].dtype.kind, c
+            assert updated[c].tolist() == expected[c].tolist(), c
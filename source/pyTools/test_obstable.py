@@ -0,0 +1,57 @@
+# Tests for obstable.py. Run with: python -m pytest
+import pytest
+from astropy.table import Table
+
+import obslog
+from obstable import ObsLog
+
+def write_log(dbFile):
+    # Write a small observation log of darks and flats
+    files = ['S20180101S{:04d}'.format(i) for i in range(1, 7)]
+    t = Table({'File': files,
+               'ObsType': ['DARK'] * 3 + ['FLAT'] * 3,
+               'Texp': [10., 10., 3., 10., 10., 3.],
+               'Date': ['20180101'] * 6,
+               'Time': ['01:00:0{}.0'.format(i) for i in range(6)],
+               'use_me': [True] * 6},
+              names=['File', 'ObsType', 'Texp', 'Date', 'Time', 'use_me'])
+    obslog.write_log(t, dbFile)
+    return files
+
+@pytest.mark.parametrize('ext', ['.fits', '.db'])
+def test_table_is_a_copy(tmpdir, ext):
+    # Editing the table of a log doesn't change the log, but set_field()
+    # does, and assigning a table replaces the log with a copy of it
+    tmpdir.chdir()
+    files = write_log('obslog' + ext)
+    log = ObsLog('obslog' + ext)
+    assert log.file_query({'ObsType': 'DARK'}) == files[:3]
+    table = log.table
+    table['use_me'][0] = False
+    table['Texp'][1] = 3.
+    assert log.file_query({'ObsType': 'DARK'}) == files[:3]
+    assert log.table['use_me'].tolist() == [True] * 6
+    assert log.file_query({'Texp': 3.}) == [files[2], files[5]]
+    log.set_field(files[:1], 'use_me', False)
+    assert log.file_query({'ObsType': 'DARK'}) == files[1:3]
+    log.table = table
+    assert log.file_query({'Texp': 3.}) == files[1:3] + [files[5]]
+    table['Texp'][4] = 3.
+    assert log.file_query({'Texp': 3.}) == files[1:3] + [files[5]]
+
+@pytest.mark.parametrize('scan_size', [0, 100])
+def test_query(tmpdir, scan_size):
+    # Queries give the same rows whether the log is indexed or scanned,
+    # and editing the rows returned doesn't change the log
+    tmpdir.chdir()
+    files = write_log('obslog.fits')
+    log = ObsLog('obslog.fits')
+    log.scan_size = scan_size
+    rows = log.query({'ObsType': 'FLAT', 'Texp': 10.})
+    assert rows['File'].tolist() == files[3:5]
+    assert rows['ObsType'].tolist() == ['FLAT', 'FLAT']
+    rows['Texp'][0] = 3.
+    assert log.query({'Texp': 3.})['File'].tolist() == [files[2], files[5]]
+    assert log.file_query({'Date': '20171231:20180101',
+                           'first': files[1], 'last': files[3]}) == files[1:4]
+    assert log.file_query({'ObsType': 'ARC'}) == []
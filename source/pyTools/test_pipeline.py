@@ -0,0 +1,91 @@
+# Tests for pipeline.py. Run with: python -m pytest
+import os, sys
+import pipeline
+from pipeline import Scheduler
+
+# The steps that have been run
+calls = []
+
+def write_file(fname, text):
+    with open(fname, 'w') as f:
+        f.write(text)
+
+def make_file(fname, text):
+    # Like the IRAF tasks, refuse to overwrite an output file
+    assert not os.path.exists(fname), fname
+    write_file(fname, text)
+
+def reduce_flats(red_dict):
+    # Make each flat, and (re)make its bad pixel mask
+    for outfile, file_dict in red_dict.items():
+        calls.append(outfile)
+        text = ''.join(open(f+'.fits').read() for f in file_dict['input'])
+        make_file(outfile+'.fits', text)
+        make_file(file_dict['bpm'], text.upper())
+
+def reduce_science(red_dict):
+    for outfile, file_dict in red_dict.items():
+        calls.append(outfile)
+        make_file(outfile+'.fits', open(file_dict['bpm']).read())
+
+def schedule():
+    # Two flats which both make the same bad pixel mask, which the
+    # science reduction then uses
+    schedule = Scheduler()
+    for stage in ('gcal', 'sky'):
+        flat_dict = {'flat_'+stage: {'input': ['S_'+stage], 'bpm': 'MCbpm.pl'}}
+        schedule.add_stage(reduce_flats, flat_dict, makes=('bpm',))
+    schedule.add_stage(reduce_science, {'target': {'bpm': 'MCbpm.pl'}})
+    return schedule
+
+def test_rerun_skips_steps(tmpdir):
+    # Running a reduction again, with nothing changed, runs nothing
+    tmpdir.chdir()
+    write_file('S_gcal.fits', 'g')
+    write_file('S_sky.fits', 's')
+    del calls[:]
+    schedule().run(trace=False)
+    assert calls == ['flat_gcal', 'flat_sky', 'target']
+    del calls[:]
+    schedule().run(trace=False)
+    assert calls == []
+    # Changing an input file reruns the steps that depend on it
+    write_file('S_sky.fits', 'S')
+    del calls[:]
+    schedule().run(trace=False)
+    assert calls == ['flat_sky', 'target']
+    # Remaking the first flat overwrites the mask, so the second flat is
+    # run again, but it makes the same mask as before
+    write_file('S_gcal.fits', 'G')
+    del calls[:]
+    schedule().run(trace=False)
+    assert calls == ['flat_gcal', 'flat_sky']
+
+def test_source_files():
+    # The code of a step includes the modules alongside it that it uses
+    fnames = [os.path.basename(fname) for fname in
+              pipeline.source_files(sys.modules[__name__])]
+    assert 'test_pipeline.py' in fnames
+    assert 'pipeline.py' in fnames
+
+def test_cached_frames(tmpdir):
+    # Editing a frame taken from the cache doesn't change the cached copy,
+    # and an edited frame is kept when the frames are released
+    tmpdir.chdir()
+    made = []
+    def prepare(indices):
+        for i in indices:
+            made.append(i)
+            make_file('pS{}.fits'.format(i), 'raw{}'.format(i))
+    names = ['pS0', 'pS1']
+    pipeline.cached_frames(names, ['k0', 'k1'], prepare)
+    write_file('pS0.fits', 'edited')
+    pipeline.cached_frames(names, ['k0', 'k1'], prepare)
+    assert made == [0, 1]
+    assert open('pS0.fits').read() == 'raw0'
+    write_file('pS1.fits', 'edited')
+    pipeline.release_frames()
+    assert not os.path.exists('pS0.fits')
+    assert open('pS1.fits').read() == 'edited'
+    assert sorted(os.listdir('frames')) == ['k0_pS0.fits', 'k0_pS0.fits.used',
+                                            'k1_pS1.fits', 'k1_pS1.fits.used']